@@ -86,7 +86,7 @@ class MVSDataset(Dataset):
 
     def read_depth(self, filename):
         # read pfm depth file
-        return np.array(read_pfm(filename)[0], dtype=np.float32)
+        return read_pfm(filename, contiguous=True)[0]
 
     def __getitem__(self, idx):
         meta = self.metas[idx]
@@ -172,7 +172,9 @@ class MVSDataset(Dataset):
         return {"imgs": croped_imgs,
                 "proj_matrices": new_proj_matrices,
                 "depth_values": depth_values,
-                "filename": scan + '/{}/' + '{:0>8}'.format(view_ids[0]) + "{}"}
+                "filename": scan + '/{}/' + '{:0>8}'.format(view_ids[0]) + "{}",
+                "view_ids": np.array(view_ids),
+                "resize_scale": np.float32(resize_scale)}
 
 
 if __name__ == "__main__":
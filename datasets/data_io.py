@@ -1,29 +1,22 @@
 import numpy as np
-import re
 import sys
 
 
-def read_pfm(filename):
-    file = open(filename, 'rb')
-    color = None
-    width = None
-    height = None
-    scale = None
-    endian = None
-
-    header = file.readline().decode('utf-8').rstrip()
-    if header == 'PF':
+# header of an open PFM file, parsed without regular expressions
+# out: color, width, height, scale, endian ('<' or '>'), byte offset of the payload
+def read_pfm_header(file):
+    header = file.readline().rstrip()
+    if header == b'PF':
         color = True
-    elif header == 'Pf':
+    elif header == b'Pf':
         color = False
     else:
         raise Exception('Not a PFM file.')
 
-    dim_match = re.match(r'^(\d+)\s(\d+)\s$', file.readline().decode('utf-8'))
-    if dim_match:
-        width, height = map(int, dim_match.groups())
-    else:
+    dims = file.readline().split()
+    if len(dims) != 2 or not dims[0].isdigit() or not dims[1].isdigit():
         raise Exception('Malformed PFM header.')
+    width, height = int(dims[0]), int(dims[1])
 
     scale = float(file.readline().rstrip())
     if scale < 0:  # little-endian
@@ -31,22 +24,42 @@ def read_pfm(filename):
         scale = -scale
     else:
         endian = '>'  # big-endian
-
-    data = np.fromfile(file, endian + 'f')
-    shape = (height, width, 3) if color else (height, width)
-
-    data = np.reshape(data, shape)
-    data = np.flipud(data)
-    file.close()
+    return color, width, height, scale, endian, file.tell()
+
+
+# PFM image with its rows top to bottom, as a flipped view of the payload:
+#   mmap=True maps the payload read-only instead of reading it, nothing is loaded until it is indexed
+#   contiguous=True returns a C-contiguous native float32 copy instead of the flipped view, read from the mapped
+#   payload in one pass instead of reading, flipping and converting it in separate copies
+def read_pfm(filename, mmap=False, contiguous=False):
+    with open(filename, 'rb') as file:
+        color, width, height, scale, endian, offset = read_pfm_header(file)
+        shape = (height, width, 3) if color else (height, width)
+        if mmap or contiguous:
+            data = np.memmap(filename, dtype=endian + 'f', mode='r', offset=offset, shape=shape)
+        else:
+            data = np.fromfile(file, endian + 'f').reshape(shape)
+    data = data[::-1]
+    if contiguous:
+        data = np.ascontiguousarray(data, dtype=np.float32)
     return data, scale
 
 
-def save_pfm(filename, image, scale=1):
-    file = open(filename, "wb")
-    color = None
+# PFM images of the same shape stacked into one C-contiguous float32 array [N, H, W(, 3)], each file is mapped and
+# copied flipped straight into its slot
+def read_pfm_batch(filenames):
+    images = None
+    for i, filename in enumerate(filenames):
+        data, _ = read_pfm(filename, mmap=True)
+        if images is None:
+            images = np.empty((len(filenames),) + data.shape, dtype=np.float32)
+        elif data.shape != images.shape[1:]:
+            raise Exception('PFM {} is {}, expected {}.'.format(filename, data.shape, images.shape[1:]))
+        np.copyto(images[i], data)
+    return images
 
-    image = np.flipud(image)
 
+def save_pfm(filename, image, scale=1):
     if image.dtype.name != 'float32':
         raise Exception('Image dtype must be float32.')
 
@@ -57,15 +70,15 @@ def save_pfm(filename, image, scale=1):
     else:
         raise Exception('Image must have H x W x 3, H x W x 1 or H x W dimensions.')
 
-    file.write('PF\n'.encode('utf-8') if color else 'Pf\n'.encode('utf-8'))
-    file.write('{} {}\n'.format(image.shape[1], image.shape[0]).encode('utf-8'))
-
     endian = image.dtype.byteorder
 
     if endian == '<' or endian == '=' and sys.byteorder == 'little':
         scale = -scale
 
-    file.write(('%f\n' % scale).encode('utf-8'))
-
-    image.tofile(file)
-    file.close()
+    with open(filename, "wb") as file:
+        file.write('PF\n'.encode('utf-8') if color else 'Pf\n'.encode('utf-8'))
+        file.write('{} {}\n'.format(image.shape[1], image.shape[0]).encode('utf-8'))
+        file.write(('%f\n' % scale).encode('utf-8'))
+        # rows bottom to top, streamed without a flipped copy of the image
+        for row in image[::-1]:
+            file.write(np.ascontiguousarray(row).data)
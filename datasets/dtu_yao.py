@@ -97,7 +97,7 @@ class MVSDataset(Dataset):
 
     def read_depth(self, filename):
         # read pfm depth file
-        return np.array(read_pfm(filename)[0], dtype=np.float32)
+        return read_pfm(filename, contiguous=True)[0]
         
 
     def __getitem__(self, idx):
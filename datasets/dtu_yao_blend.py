@@ -90,7 +90,7 @@ class MVSDataset(Dataset):
 
     def read_depth(self, filename):
         # read pfm depth file
-        depth_image = np.array(read_pfm(filename)[0], dtype=np.float32)
+        depth_image = read_pfm(filename, contiguous=True)[0]
         depth_image = scale_image(depth_image, scale=self.image_scale, interpolation='nearest')
         return depth_image
         
@@ -0,0 +1,16 @@
+from depthfusion.consistency import *
+from depthfusion.cache import *
+from depthfusion.ply import *
+from depthfusion.dedup import *
+from depthfusion.sweep import *
+from depthfusion.manifest import *
+from depthfusion.spill import *
+from depthfusion.schedule import *
+from depthfusion.spatial import *
+from depthfusion.merge import *
+from depthfusion.lod import *
+from depthfusion.container import *
+from depthfusion.outliers import *
+from depthfusion.partition import *
+# depthfusion.store works on torch tensors and is imported explicitly by eval.py
+# depthfusion.evaluation needs scipy and is imported explicitly by the evaluation scripts
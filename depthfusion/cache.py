@@ -0,0 +1,96 @@
+from collections import OrderedDict
+import numpy as np
+
+from datasets.data_io import read_pfm
+from depthfusion.container import DepthMapContainer
+
+
+# bytes held by a cached value (arrays, or tuples/lists/dicts of arrays)
+def entry_nbytes(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    elif isinstance(value, (tuple, list)):
+        return sum(entry_nbytes(v) for v in value)
+    elif isinstance(value, dict):
+        return sum(entry_nbytes(v) for v in value.values())
+    else:
+        return 0
+
+
+def freeze(value):
+    if isinstance(value, np.ndarray):
+        value.setflags(write=False)
+    elif isinstance(value, (tuple, list)):
+        for v in value:
+            freeze(v)
+    elif isinstance(value, dict):
+        for v in value.values():
+            freeze(v)
+    return value
+
+
+# per-scan cache of decoded depth / confidence maps and parsed cameras with LRU eviction
+# every view is used once as reference and ~10 times as source view, so decoding it once saves most of the IO.
+# cached arrays are read-only, copy them before modifying in place.
+class ScanCache(object):
+    def __init__(self, max_bytes=4 * 1024 ** 3):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.containers = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+
+        self.misses += 1
+        value = freeze(load())
+        size = entry_nbytes(value)
+        # entries larger than the whole budget are returned but not kept
+        if size <= self.max_bytes:
+            self.entries[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.nbytes -= evicted_size
+        return value
+
+    # memory mapped PFM map (depth or confidence), its pages are shared with the OS file cache
+    def pfm(self, filename):
+        return self.get(('pfm', filename), lambda: read_pfm(filename, mmap=True)[0])
+
+    # float32 depth ('depth_est') or confidence ('confidence') map of a view of a DepthMapContainer,
+    # the containers are opened once and kept outside the LRU, they only hold a memory map
+    def container_map(self, filename, kind, key):
+        def load():
+            if filename not in self.containers:
+                self.containers[filename] = DepthMapContainer(filename)
+            return self.containers[filename].read_map(kind, key)
+        return self.get((kind, filename, key), load)
+
+    # parsed camera: intrinsics, extrinsics and their float64 inverses
+    # read_camera(filename, *read_args) -> intrinsics, extrinsics
+    def camera(self, filename, read_camera, *read_args):
+        def load():
+            intrinsics, extrinsics = read_camera(filename, *read_args)
+            return (intrinsics, extrinsics, np.linalg.inv(intrinsics.astype(np.float64)),
+                    np.linalg.inv(extrinsics.astype(np.float64)))
+        return self.get(('camera', filename) + tuple(read_args), load)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def clear(self):
+        self.entries.clear()
+        self.containers.clear()
+        self.nbytes = 0
+
+
+# stack cached cameras of the source views into intrinsics [S, 3, 3], extrinsics [S, 4, 4] and their inverses
+def stack_cameras(cameras):
+    return tuple(np.stack([camera[i] for camera in cameras]) for i in range(4))
@@ -0,0 +1,198 @@
+import functools
+import numpy as np
+
+
+# dynamic consistency levels (D2HC): a source view agrees with the reference pixel at level i if the
+# reprojection error is below i/4 pixel and the relative depth difference is below i/1300,
+# the pixel is kept if at least i source views agree at level i for some i.
+# each level is (minimum number of agreeing views, pixel threshold, relative depth threshold)
+DYNAMIC_LEVELS = [(i, i / 4, i / 1300) for i in range(2, 11)]
+
+
+# homogeneous pixel coordinates (x, y, 1) of a [H, W] image, flattened to [3, H*W]
+# all views of a scan share the same size, so the grid is built once and reused (read-only)
+@functools.lru_cache(maxsize=8)
+def pixel_grid(height, width):
+    x, y = np.meshgrid(np.arange(0, width, dtype=np.float32), np.arange(0, height, dtype=np.float32))
+    xyz = np.stack((x.reshape([-1]), y.reshape([-1]), np.ones(height * width, dtype=np.float32)))
+    xyz.setflags(write=False)
+    return xyz
+
+
+# bilinear sampling of a stack of maps, behaves like cv2.remap(INTER_LINEAR) with a zero border
+# images: [S, H, W]; x, y: [S, N]
+# out: [S, N]
+def bilinear_sample_stack(images, x, y):
+    num_images, height, width = images.shape
+    flat_images = images.reshape([-1])
+
+    # non-finite coordinates (points behind / on the camera plane) fall outside the image
+    valid = np.logical_and(np.isfinite(x), np.isfinite(y))
+    x = np.clip(np.where(valid, x, -2), -2, width + 1)
+    y = np.clip(np.where(valid, y, -2), -2, height + 1)
+
+    x0, y0 = np.floor(x), np.floor(y)
+    wx1, wy1 = x - x0, y - y0
+    wx0, wy0 = 1 - wx1, 1 - wy1
+    x0, y0 = x0.astype(np.int64), y0.astype(np.int64)
+    offset = (np.arange(num_images, dtype=np.int64) * height * width).reshape([-1, 1])
+
+    sampled = np.zeros(x.shape, dtype=np.float32)
+    for yy, wy in ((y0, wy0), (y0 + 1, wy1)):
+        for xx, wx in ((x0, wx0), (x0 + 1, wx1)):
+            inside = (xx >= 0) & (xx < width) & (yy >= 0) & (yy < height)
+            index = offset + np.clip(yy, 0, height - 1) * width + np.clip(xx, 0, width - 1)
+            sampled += np.where(inside, flat_images[index] * (wx * wy), 0).astype(np.float32)
+    return sampled
+
+
+# project the reference depth into all source views at once, then project back with the sampled source depths
+# depth_ref: [H, W]; intrinsics_ref: [3, 3]; extrinsics_ref: [4, 4]
+# depths_src: [S, H, W]; intrinsics_src: [S, 3, 3]; extrinsics_src: [S, 4, 4]
+# inverses: optional precomputed (intrinsics_ref^-1, extrinsics_ref^-1, intrinsics_src^-1, extrinsics_src^-1)
+# pixels: optional [P] flat indices of the reference pixels to reproject, all H*W pixels by default
+# out: depth_reprojected, x_reprojected, y_reprojected, x_src, y_src, all [S, P] float32
+def reproject_with_depth_batch(depth_ref, intrinsics_ref, extrinsics_ref, depths_src, intrinsics_src, extrinsics_src,
+                               inverses=None, pixels=None):
+    height, width = depth_ref.shape[0], depth_ref.shape[1]
+    xyz_ref = pixel_grid(height, width)
+    depth_ref = depth_ref.reshape([-1]).astype(np.float32)
+    if pixels is not None:
+        xyz_ref = xyz_ref[:, pixels]
+        depth_ref = depth_ref[pixels]
+    depth_ref = depth_ref.reshape([1, 1, -1])
+
+    # compose the per-pair matrices once in float64, the per-pixel work runs in float32
+    intrinsics_ref = intrinsics_ref.astype(np.float64)
+    intrinsics_src = intrinsics_src.astype(np.float64)
+    extrinsics_ref = extrinsics_ref.astype(np.float64)
+    extrinsics_src = extrinsics_src.astype(np.float64)
+    if inverses is None:
+        inverses = (np.linalg.inv(intrinsics_ref), np.linalg.inv(extrinsics_ref),
+                    np.linalg.inv(intrinsics_src), np.linalg.inv(extrinsics_src))
+    intrinsics_ref_inv, extrinsics_ref_inv, intrinsics_src_inv, extrinsics_src_inv = inverses
+    src_from_ref = np.matmul(extrinsics_src, extrinsics_ref_inv)
+    ref_from_src = np.matmul(extrinsics_ref, extrinsics_src_inv)
+    # reference pixel * depth -> source pixel: K_src * [R|t] * K_ref^-1
+    rot = np.matmul(np.matmul(intrinsics_src, src_from_ref[:, :3, :3]), intrinsics_ref_inv).astype(np.float32)
+    trans = np.matmul(intrinsics_src, src_from_ref[:, :3, 3:4]).astype(np.float32)
+    # source pixel * depth -> reference camera: [R|t]^-1 * K_src^-1
+    rot_back = np.matmul(ref_from_src[:, :3, :3], intrinsics_src_inv).astype(np.float32)
+    trans_back = ref_from_src[:, :3, 3:4].astype(np.float32)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ## step1. project reference pixels to the source views
+        K_xyz_src = np.matmul(rot, xyz_ref) * depth_ref + trans  # [S, 3, H*W]
+        x_src = K_xyz_src[:, 0] / K_xyz_src[:, 2]
+        y_src = K_xyz_src[:, 1] / K_xyz_src[:, 2]
+
+        ## step2. reproject the source view points with source view depth estimation
+        sampled_depth_src = bilinear_sample_stack(depths_src, x_src, y_src)  # [S, H*W]
+        xy1_src = np.stack((x_src, y_src, np.ones_like(x_src)), axis=1)  # [S, 3, H*W]
+        xyz_reprojected = np.matmul(rot_back, xy1_src) * sampled_depth_src[:, np.newaxis] + trans_back
+        depth_reprojected = xyz_reprojected[:, 2]
+        K_xyz_reprojected = np.matmul(intrinsics_ref.astype(np.float32), xyz_reprojected)
+        x_reprojected = K_xyz_reprojected[:, 0] / K_xyz_reprojected[:, 2]
+        y_reprojected = K_xyz_reprojected[:, 1] / K_xyz_reprojected[:, 2]
+
+    return depth_reprojected, x_reprojected, y_reprojected, x_src, y_src
+
+
+# reprojection error |p_reproj-p_1| of the reference pixels through every source view
+# out: dist [S, P], depth_reprojected [S, P], the reference depths depth_flat [P], x_src, y_src [S, P]
+def reprojection_errors(depth_ref, intrinsics_ref, extrinsics_ref, depths_src, intrinsics_src, extrinsics_src,
+                        inverses=None, pixels=None):
+    height, width = depth_ref.shape[0], depth_ref.shape[1]
+    x_ref, y_ref = pixel_grid(height, width)[:2]
+    depth_flat = depth_ref.reshape([-1]).astype(np.float32)
+    if pixels is not None:
+        x_ref, y_ref, depth_flat = x_ref[pixels], y_ref[pixels], depth_flat[pixels]
+    depth_reprojected, x2d_reprojected, y2d_reprojected, x2d_src, y2d_src = reproject_with_depth_batch(
+        depth_ref, intrinsics_ref, extrinsics_ref, depths_src, intrinsics_src, extrinsics_src, inverses, pixels)
+
+    with np.errstate(invalid='ignore'):
+        dist = np.sqrt((x2d_reprojected - x_ref) ** 2 + (y2d_reprojected - y_ref) ** 2)
+    return dist, depth_reprojected, depth_flat, x2d_src, y2d_src
+
+
+# lowest level each (source, pixel) agrees at, len(levels) where it agrees at none
+# the thresholds grow with the level, so one binary search per pixel replaces a mask per level
+# dist, relative_depth_diff: [S, N]
+# out: [S, N] uint8
+def min_consistent_level(dist, relative_depth_diff, levels=DYNAMIC_LEVELS):
+    assert len(levels) < 255
+    dist_thresh = np.array([level[1] for level in levels], dtype=np.float32)
+    relative_thresh = np.array([level[2] for level in levels], dtype=np.float32)
+    assert np.all(np.diff(dist_thresh) >= 0) and np.all(np.diff(relative_thresh) >= 0)
+    # first level whose threshold is strictly above the value, NaN sorts past the last level
+    dist_level = np.searchsorted(dist_thresh, dist, side='right')
+    relative_level = np.searchsorted(relative_thresh, relative_depth_diff, side='right')
+    return np.maximum(dist_level, relative_level).astype(np.uint8)
+
+
+# dynamic geometric mask from the per-source minimum levels, one pass over the levels with a running
+# cumulative histogram (number of sources agreeing at the current level or below) in a single uint8 accumulator
+# min_levels: [S, N] uint8
+# out: geo_mask [N] bool, consistent_count [N] uint8 number of sources agreeing at the last level
+def dynamic_geo_mask(min_levels, levels=DYNAMIC_LEVELS):
+    assert min_levels.shape[0] < 256
+    consistent_count = np.zeros(min_levels.shape[1:], dtype=np.uint8)
+    geo_mask = np.zeros(min_levels.shape[1:], dtype=bool)
+    for i, (min_views, _, _) in enumerate(levels):
+        consistent_count += np.sum(min_levels == i, axis=0, dtype=np.uint8)
+        geo_mask |= consistent_count >= min_views
+    return geo_mask, consistent_count
+
+
+# scatter per-pixel values computed on a subset of the pixels back to full [size] maps
+# fields: (values [P], fill) pairs, fill is a scalar or a full [size] map holding the default values
+def scatter_pixels(pixels, size, *fields):
+    outputs = []
+    for values, fill in fields:
+        if np.isscalar(fill):
+            full = np.full(size, fill, dtype=values.dtype)
+        else:
+            full = np.array(fill, dtype=values.dtype)
+        full[pixels] = values
+        outputs.append(full)
+    return outputs
+
+
+# batched geometric consistency of one reference view against all its source views
+# levels: list of (minimum views, pixel threshold, relative depth threshold) with non-decreasing thresholds,
+#         the last one gates the depth averaging
+# pixels: optional [P] flat indices of the reference pixels to check (e.g. the photometrically valid ones),
+#         the others are reported inconsistent with their depth left unchanged
+# out: geo_mask [H, W] pixels with at least min_views consistent source views at some level,
+#      geo_mask_sum [H, W] number of source views consistent at the last level,
+#      depth_est_averaged [H, W] mean of the reference depth and the consistent reprojected depths
+#      with return_src: also geo_masks [S, P] per source view at the last level and x_src, y_src [S, P]
+def check_geometric_consistency_batch(depth_ref, intrinsics_ref, extrinsics_ref, depths_src, intrinsics_src,
+                                      extrinsics_src, levels=DYNAMIC_LEVELS, inverses=None, return_src=False,
+                                      pixels=None):
+    height, width = depth_ref.shape[0], depth_ref.shape[1]
+    dist, depth_reprojected, depth_flat, x2d_src, y2d_src = reprojection_errors(
+        depth_ref, intrinsics_ref, extrinsics_ref, depths_src, intrinsics_src, extrinsics_src, inverses, pixels)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # check |d_reproj-d_1| / d_1 < relative depth threshold
+        relative_depth_diff = np.abs(depth_reprojected - depth_flat) / depth_flat
+
+    min_levels = min_consistent_level(dist, relative_depth_diff, levels)
+    geo_mask, consistent_count = dynamic_geo_mask(min_levels, levels)
+
+    # the last level gates the depth averaging
+    mask = min_levels < len(levels)
+    geo_mask_sum = consistent_count.astype(np.int32)
+    depth_reprojected[~mask] = 0
+    depth_est_averaged = (depth_reprojected.sum(axis=0) + depth_flat) / (geo_mask_sum + 1)
+
+    depth_est_averaged = depth_est_averaged.astype(np.float32)
+    if pixels is not None:
+        geo_mask, geo_mask_sum, depth_est_averaged = scatter_pixels(
+            pixels, height * width, (geo_mask, False), (geo_mask_sum, 0), (depth_est_averaged, depth_ref.reshape([-1])))
+
+    outputs = (geo_mask.reshape([height, width]), geo_mask_sum.reshape([height, width]),
+               depth_est_averaged.reshape([height, width]))
+    if return_src:
+        outputs = outputs + (mask, x2d_src, y2d_src)
+    return outputs
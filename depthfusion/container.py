@@ -0,0 +1,125 @@
+import json
+import os
+import struct
+import numpy as np
+
+
+# per-scan file of depth and confidence maps:
+#   magic (8 bytes), offset and length of the JSON index (two little endian uint64), then the maps, each aligned
+#   to MAP_ALIGNMENT bytes, and the index at the end. The index maps a view key to the shape and offsets of its maps.
+DEPTH_CONTAINER = 'depth_maps.dmap'
+CONTAINER_MAGIC = b'DMAP0001'
+HEADER_SIZE = len(CONTAINER_MAGIC) + 16
+MAP_ALIGNMENT = 64
+DEPTH_DTYPES = ('f2', 'f4')
+# confidences in [0, 1] are stored as round(confidence * scale), f4 keeps them as is
+CONFIDENCE_SCALES = {'u1': 255, 'u2': 65535, 'f4': 1}
+
+
+# key of a view of eval.py and fusion.py in the container
+def view_key(view):
+    return '{:0>8}'.format(view)
+
+
+# writes the maps of one scan view by view to a temporary file, which becomes the container on close
+class DepthMapWriter(object):
+    def __init__(self, filename, depth_dtype='f4', confidence_dtype='u2'):
+        if depth_dtype not in DEPTH_DTYPES or confidence_dtype not in CONFIDENCE_SCALES:
+            raise ValueError('depth dtype must be one of {} and confidence dtype one of {}'.format(
+                DEPTH_DTYPES, tuple(CONFIDENCE_SCALES)))
+        self.filename = filename
+        self.depth_dtype = np.dtype('<' + depth_dtype)
+        self.confidence_dtype = np.dtype('<' + confidence_dtype)
+        self.confidence_scale = CONFIDENCE_SCALES[confidence_dtype]
+        self.views = {}
+        self.file = open(filename + '.tmp', 'wb')
+        self.file.write(CONTAINER_MAGIC + struct.pack('<QQ', 0, 0))
+
+    def write_map(self, data):
+        offset = -self.file.tell() % MAP_ALIGNMENT
+        self.file.write(b'\0' * offset)
+        offset = self.file.tell()
+        np.ascontiguousarray(data).tofile(self.file)
+        return offset
+
+    def add(self, key, depth, confidence):
+        depth = np.asarray(depth)
+        confidence = np.asarray(confidence, dtype=np.float32)
+        if self.confidence_dtype.kind == 'u':
+            confidence = np.rint(np.clip(confidence, 0, 1) * self.confidence_scale)
+        self.views[key] = {'shape': list(depth.shape),
+                           'depth': self.write_map(depth.astype(self.depth_dtype)),
+                           'confidence': self.write_map(confidence.astype(self.confidence_dtype))}
+
+    def __len__(self):
+        return len(self.views)
+
+    def close(self):
+        if self.file is None:
+            return
+        index = json.dumps({'depth_dtype': self.depth_dtype.str, 'confidence_dtype': self.confidence_dtype.str,
+                            'confidence_scale': self.confidence_scale, 'views': self.views}).encode('utf-8')
+        offset = self.file.tell()
+        self.file.write(index)
+        self.file.seek(len(CONTAINER_MAGIC))
+        self.file.write(struct.pack('<QQ', offset, len(index)))
+        self.file.close()
+        self.file = None
+        os.replace(self.filename + '.tmp', self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# memory mapped container: depth and confidence return read-only views into the file in their stored dtype,
+# no map is read before it is indexed. read_map converts them to float32, without a copy for f4.
+class DepthMapContainer(object):
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+            if header[:len(CONTAINER_MAGIC)] != CONTAINER_MAGIC:
+                raise ValueError('{} is not a depth map container'.format(filename))
+            offset, length = struct.unpack('<QQ', header[len(CONTAINER_MAGIC):])
+            f.seek(offset)
+            index = json.loads(f.read(length).decode('utf-8'))
+        self.depth_dtype = np.dtype(index['depth_dtype'])
+        self.confidence_dtype = np.dtype(index['confidence_dtype'])
+        self.confidence_scale = index['confidence_scale']
+        self.views = index['views']
+        self.data = np.memmap(filename, dtype=np.uint8, mode='r')
+
+    def __contains__(self, key):
+        return key in self.views
+
+    def keys(self):
+        return list(self.views)
+
+    # bytes of one float32 map of a view
+    def map_nbytes(self, key):
+        return int(np.prod(self.views[key]['shape'])) * 4
+
+    def array(self, key, kind, dtype):
+        view = self.views[key]
+        shape = view['shape']
+        offset = view[kind]
+        return self.data[offset:offset + int(np.prod(shape)) * dtype.itemsize].view(dtype).reshape(shape)
+
+    def depth(self, key):
+        return self.array(key, 'depth', self.depth_dtype)
+
+    # stored confidence, divide by confidence_scale for [0, 1]
+    def confidence(self, key):
+        return self.array(key, 'confidence', self.confidence_dtype)
+
+    # float32 depth ('depth_est') or confidence ('confidence') map of a view
+    def read_map(self, kind, key):
+        if kind == 'depth_est':
+            return self.depth(key).astype(np.float32, copy=False)
+        confidence = self.confidence(key)
+        if self.confidence_dtype.kind == 'u':
+            return confidence.astype(np.float32) / np.float32(self.confidence_scale)
+        return confidence.astype(np.float32, copy=False)
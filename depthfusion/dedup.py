@@ -0,0 +1,118 @@
+import numpy as np
+
+
+# voxel coordinates are packed into one int64 key, 21 bits per axis
+VOXEL_KEY_BITS = 21
+VOXEL_KEY_OFFSET = 1 << (VOXEL_KEY_BITS - 1)
+
+
+# hash key of the voxel containing each point
+# vertices: [N, 3]
+# out: [N] int64
+def voxel_keys(vertices, voxel_size):
+    return pack_voxel_index(np.floor(vertices / voxel_size).astype(np.int64), voxel_size)
+
+
+# hash key of integer voxel coordinates [N, 3]
+def pack_voxel_index(index, voxel_size=None):
+    index = index + VOXEL_KEY_OFFSET
+    if len(index) > 0 and (index.min() < 0 or index.max() >= 1 << VOXEL_KEY_BITS):
+        raise ValueError('points span more than {} voxels of size {}, increase the voxel size'.format(
+            1 << VOXEL_KEY_BITS, voxel_size))
+    return (index[:, 0] << (2 * VOXEL_KEY_BITS)) | (index[:, 1] << VOXEL_KEY_BITS) | index[:, 2]
+
+
+# integer voxel coordinates [N, 3] of hash keys
+def unpack_voxel_keys(keys):
+    mask = (1 << VOXEL_KEY_BITS) - 1
+    index = np.stack((keys >> (2 * VOXEL_KEY_BITS), (keys >> VOXEL_KEY_BITS) & mask, keys & mask), axis=1)
+    return index - VOXEL_KEY_OFFSET
+
+
+# voxel hash that merges points falling into the same voxel, averaging their positions and colors.
+# points are buffered and merged in batches at least as large as the grid, so merging stays amortized
+# O(N log N) and memory follows the number of occupied voxels instead of the number of fused points.
+class VoxelGrid(object):
+    def __init__(self, voxel_size, flush_points=1 << 20):
+        self.voxel_size = voxel_size
+        self.flush_points = flush_points
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.xyz_sum = np.zeros((0, 3), dtype=np.float64)
+        self.rgb_sum = np.zeros((0, 3), dtype=np.float64)
+        self.count = np.zeros(0, dtype=np.float64)
+        self.pending = []
+        self.pending_points = 0
+
+    def add(self, vertices, colors):
+        if len(vertices) == 0:
+            return
+        self.pending.append((voxel_keys(vertices, self.voxel_size), vertices, colors))
+        self.pending_points += len(vertices)
+        if self.pending_points >= max(self.flush_points, len(self.keys)):
+            self.flush()
+
+    def flush(self):
+        if self.pending_points == 0:
+            return
+        keys = np.concatenate([self.keys] + [p[0] for p in self.pending])
+        xyz = np.concatenate([self.xyz_sum] + [p[1].astype(np.float64) for p in self.pending])
+        rgb = np.concatenate([self.rgb_sum] + [p[2].astype(np.float64) for p in self.pending])
+        count = np.concatenate([self.count, np.ones(self.pending_points, dtype=np.float64)])
+        self.pending = []
+        self.pending_points = 0
+
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        inverse = inverse.reshape([-1])
+        num_voxels = len(self.keys)
+        self.xyz_sum = np.stack([np.bincount(inverse, weights=xyz[:, i], minlength=num_voxels) for i in range(3)], axis=1)
+        self.rgb_sum = np.stack([np.bincount(inverse, weights=rgb[:, i], minlength=num_voxels) for i in range(3)], axis=1)
+        self.count = np.bincount(inverse, weights=count, minlength=num_voxels)
+
+    def __len__(self):
+        self.flush()
+        return len(self.keys)
+
+    # averaged points in voxel key order, in chunks of vertices [n, 3] float32 and colors [n, 3] uint8
+    def chunks(self, chunk_size=1 << 20):
+        self.flush()
+        for start in range(0, len(self.keys), chunk_size):
+            count = self.count[start:start + chunk_size, np.newaxis]
+            vertices = (self.xyz_sum[start:start + chunk_size] / count).astype(np.float32)
+            colors = np.round(self.rgb_sum[start:start + chunk_size] / count).astype(np.uint8)
+            yield vertices, colors
+
+
+# flat pixel index in each source view of the reference pixels in the given columns, -1 where the source view
+# is not geometrically consistent or the point falls outside the source image
+# geo_masks, x_src, y_src: [S, P] over the checked reference pixels; columns: [N]
+# out: [S, N] int64
+def source_pixels(geo_masks, x_src, y_src, columns, height, width):
+    x = np.floor(x_src[:, columns] + 0.5)
+    y = np.floor(y_src[:, columns] + 0.5)
+    inside = geo_masks[:, columns] & (x >= 0) & (x < width) & (y >= 0) & (y < height)
+    return np.where(inside, y * width + x, -1).astype(np.int64)
+
+
+# vectorized used_mask bookkeeping: once a reference view is fused, the pixels of its source views that were
+# consistent with it are marked used and skipped when those views become reference views later on.
+# the mask of a view is released as soon as the view has been fused.
+class UsedMask(object):
+    def __init__(self):
+        self.masks = {}
+        self.fused_views = set()
+
+    # visibility: (ref_view, ref_pixels [N], src_views, src_pixels [S, N], height * width)
+    # out: [N] bool, the fused points to keep
+    def update(self, visibility):
+        ref_view, ref_pixels, src_views, src_pixels, size = visibility
+        used = self.masks.pop(ref_view, None)
+        keep = np.ones(len(ref_pixels), dtype=bool) if used is None else ~used[ref_pixels]
+        self.fused_views.add(ref_view)
+
+        for src_view, pixels in zip(src_views, src_pixels):
+            if src_view in self.fused_views:
+                continue
+            if src_view not in self.masks:
+                self.masks[src_view] = np.zeros(size, dtype=bool)
+            self.masks[src_view][pixels[pixels >= 0]] = True
+        return keep
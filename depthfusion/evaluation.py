@@ -0,0 +1,166 @@
+import json
+import numpy as np
+from scipy.spatial import cKDTree
+import scipy.io
+
+from depthfusion.dedup import VoxelGrid
+from depthfusion.ply import ply_vertices
+
+
+# distance thresholds of the Tanks and Temples training scenes with public ground truth, in meters
+TANKS_THRESHOLDS = {'Barn': 0.01, 'Caterpillar': 0.005, 'Church': 0.025, 'Courthouse': 0.025, 'Ignatius': 0.003,
+                    'Meetingroom': 0.01, 'Truck': 0.005}
+
+
+# distance from each query point [N, 3] to its nearest reference point, inf beyond max_distance. The KD-tree is
+# queried chunk_points queries at a time over workers threads (-1 for all cores), so memory follows one chunk.
+def nearest_distances(tree, queries, max_distance=np.inf, workers=1, chunk_points=1 << 20):
+    distances = np.empty(len(queries))
+    for start in range(0, len(queries), chunk_points):
+        chunk = np.asarray(queries[start:start + chunk_points], dtype=np.float64)
+        distances[start:start + chunk_points] = tree.query(chunk, distance_upper_bound=max_distance,
+                                                           workers=workers)[0]
+    return distances
+
+
+# greedy downsampling to a minimum point distance as the DTU MATLAB code (reducePts_haa): the points are visited
+# in a random order and every kept point removes its unvisited neighbours closer than min_distance
+def downsample_points(points, min_distance, workers=1, chunk_points=1 << 18, seed=0):
+    points = points[np.random.RandomState(seed).permutation(len(points))]
+    tree = cKDTree(points)
+    keep = np.ones(len(points), dtype=bool)
+    for start in range(0, len(points), chunk_points):
+        neighbors = tree.query_ball_point(points[start:start + chunk_points], min_distance, workers=workers)
+        for i, neighbor in enumerate(neighbors, start):
+            if keep[i]:
+                keep[neighbor] = False
+                keep[i] = True
+    return points[keep]
+
+
+# which points an evaluation counts, the base class counts every point. Subclasses implement the observation
+# masks of a benchmark, each method maps points [N, 3] to a boolean mask [N]
+class EvaluationFilter(object):
+    # reconstructed points whose distance to the ground truth counts for accuracy
+    def accuracy(self, data):
+        return np.ones(len(data), dtype=bool)
+
+    # reconstructed points the ground truth is matched against for completeness
+    def data_region(self, data):
+        return np.ones(len(data), dtype=bool)
+
+    # ground truth points whose distance to the reconstruction counts for completeness
+    def completeness(self, gt):
+        return np.ones(len(gt), dtype=bool)
+
+
+# DTU observability: accuracy counts the reconstructed points in observed voxels of ObsMask (resolution res
+# within the bounding box BB), completeness matches the ground truth points above the table plane P against the
+# reconstruction within the bounding box grown by margin, as the official evaluation
+class DTUFilter(EvaluationFilter):
+    def __init__(self, obs_mask, bounding_box, resolution, plane, margin=60):
+        self.obs_mask = obs_mask.astype(bool)
+        self.bounding_box = np.asarray(bounding_box, dtype=np.float64).reshape([2, 3])
+        self.resolution = float(resolution)
+        self.plane = np.asarray(plane, dtype=np.float64).reshape([4])
+        self.margin = margin
+
+    # ObsMask<scan>_10.mat (ObsMask, BB, Res) and Plane<scan>.mat (P) of the DTU evaluation data
+    @classmethod
+    def from_mat(cls, obs_mask_file, plane_file, margin=60):
+        obs = scipy.io.loadmat(obs_mask_file)
+        return cls(obs['ObsMask'], obs['BB'], np.asarray(obs['Res']).item(), scipy.io.loadmat(plane_file)['P'], margin)
+
+    def data_region(self, data):
+        return np.all((data >= self.bounding_box[0] - self.margin) & (data < self.bounding_box[1] + 2 * self.margin),
+                      axis=1)
+
+    def accuracy(self, data):
+        grid = np.around((data - self.bounding_box[0]) / self.resolution).astype(np.int64)
+        inside = self.data_region(data) & np.all((grid >= 0) & (grid < np.array(self.obs_mask.shape)), axis=1)
+        observed = np.zeros(len(data), dtype=bool)
+        observed[inside] = self.obs_mask[grid[inside, 0], grid[inside, 1], grid[inside, 2]]
+        return observed
+
+    def completeness(self, gt):
+        return np.matmul(gt, self.plane[:3]) + self.plane[3] > 0
+
+
+# DTU accuracy (mean distance of the counted reconstructed points to the ground truth), completeness (mean distance
+# of the counted ground truth points to the reconstruction) and overall (their mean); distances of max_distance
+# and beyond are left out as outliers
+# data: reconstructed points [N, 3], already downsampled; gt: ground truth points [M, 3]
+def dtu_scores(data, gt, evaluation_filter, max_distance=20, workers=1, chunk_points=1 << 20):
+    data_in = data[evaluation_filter.data_region(data)]
+    accuracy = nearest_distances(cKDTree(gt), data_in[evaluation_filter.accuracy(data_in)], max_distance, workers,
+                                 chunk_points)
+    completeness = nearest_distances(cKDTree(data_in), gt[evaluation_filter.completeness(gt)], max_distance, workers,
+                                     chunk_points)
+    mean_accuracy = accuracy[accuracy < max_distance].mean() if np.any(accuracy < max_distance) else np.nan
+    mean_completeness = completeness[completeness < max_distance].mean() if np.any(completeness < max_distance) else np.nan
+    return mean_accuracy, mean_completeness, (mean_accuracy + mean_completeness) / 2
+
+
+# Tanks and Temples crop volume (<scene>.json, an Open3D SelectionPolygonVolume): points between axis_min and
+# axis_max along the orthogonal axis and inside the bounding polygon in the other two. It applies to the
+# reconstruction and the ground truth alike.
+class CropVolume(EvaluationFilter):
+    def __init__(self, polygon, orthogonal_axis, axis_min, axis_max):
+        self.axis = 'XYZ'.index(orthogonal_axis.upper())
+        self.plane_axes = [i for i in range(3) if i != self.axis]
+        self.polygon = np.asarray(polygon, dtype=np.float64)[:, self.plane_axes]
+        self.axis_min, self.axis_max = axis_min, axis_max
+
+    @classmethod
+    def from_json(cls, filename):
+        with open(filename) as f:
+            volume = json.load(f)
+        return cls(volume['bounding_polygon'], volume['orthogonal_axis'], volume['axis_min'], volume['axis_max'])
+
+    def __call__(self, points):
+        inside = (points[:, self.axis] >= self.axis_min) & (points[:, self.axis] <= self.axis_max)
+        x, y = points[:, self.plane_axes[0]], points[:, self.plane_axes[1]]
+        # even-odd rule, one polygon edge at a time
+        crossings = np.zeros(len(points), dtype=bool)
+        for (x0, y0), (x1, y1) in zip(self.polygon, np.roll(self.polygon, -1, axis=0)):
+            if y0 == y1:
+                continue
+            straddles = (y0 > y) != (y1 > y)
+            crossings ^= straddles & (x < x0 + (y - y0) * (x1 - x0) / (y1 - y0))
+        return inside & crossings
+
+    def accuracy(self, data):
+        return self(data)
+
+    def data_region(self, data):
+        return self(data)
+
+    def completeness(self, gt):
+        return self(gt)
+
+
+# points of a PLY file [N, 3] transformed by a 4x4 transform, filtered by point_filter and averaged per voxel of
+# voxel_size, streamed chunk_points vertices at a time, so memory follows the downsampled cloud
+def stream_evaluation_cloud(filename, voxel_size, point_filter=None, transform=None, chunk_points=1 << 22):
+    vertices = ply_vertices(filename)
+    voxels = VoxelGrid(voxel_size)
+    for start in range(0, len(vertices), chunk_points):
+        chunk = vertices[start:start + chunk_points]
+        xyz = np.stack([chunk['x'], chunk['y'], chunk['z']], axis=1).astype(np.float64)
+        if transform is not None:
+            xyz = np.matmul(xyz, transform[:3, :3].T) + transform[:3, 3]
+        if point_filter is not None:
+            xyz = xyz[point_filter(xyz)]
+        voxels.add(xyz, np.zeros(xyz.shape, dtype=np.uint8))
+    return np.concatenate([np.zeros((0, 3))] + [vertices.astype(np.float64) for vertices, _ in voxels.chunks()])
+
+
+# Tanks and Temples precision (share of reconstructed points closer than threshold to the ground truth), recall
+# (share of ground truth points closer than threshold to the reconstruction) and F-score
+def tanks_scores(data, gt, threshold, workers=1, chunk_points=1 << 20):
+    precision = np.mean(nearest_distances(cKDTree(gt), data, threshold, workers, chunk_points) < threshold) \
+        if len(data) > 0 and len(gt) > 0 else 0.0
+    recall = np.mean(nearest_distances(cKDTree(data), gt, threshold, workers, chunk_points) < threshold) \
+        if len(data) > 0 and len(gt) > 0 else 0.0
+    fscore = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+    return precision, recall, fscore
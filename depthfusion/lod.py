@@ -0,0 +1,89 @@
+import json
+import os
+import numpy as np
+
+from depthfusion.dedup import pack_voxel_index, voxel_keys
+from depthfusion.ply import PlyStreamWriter, ply_vertex_memmap, VERTEX_DTYPE
+
+
+LOD_INDEX = 'index.json'
+
+
+# name of the octree nodes with integer coordinates [N, 3] at level: 'r' followed by one octant digit
+# (4 * x + 2 * y + z bit) per level from the root down, as in Potree
+def node_names(level, index):
+    bits = [(index >> (level - 1 - k)) & 1 for k in range(level)]
+    digits = np.stack([4 * b[:, 0] + 2 * b[:, 1] + b[:, 2] for b in bits], axis=1) if level > 0 else \
+        np.zeros([len(index), 0], dtype=np.int64)
+    return ['r' + ''.join(map(str, row)) for row in digits.tolist()]
+
+
+# multi-resolution octree of a point cloud in folder: every node keeps one point per cell of a grid_cells^3 grid
+# over its cube and hands the others down to its 8 children, nodes of at most node_points points (or at max_depth)
+# keep all their points. Each point is stored once, so the nodes of levels 0..L together give the cloud at a
+# spacing of about size / grid_cells / 2^L. Nodes are written to <name>.ply, index.json lists the cube, the levels
+# and every node with its point count, the points of its subtree and its bounding cube.
+# the whole cloud is loaded, about 40 bytes per point
+def write_octree_lod(plyfilenames, folder, node_points=1 << 16, grid_cells=128, max_depth=10):
+    vertices = np.concatenate([np.asarray(ply_vertex_memmap(filename)) for filename in plyfilenames])
+    xyz = np.stack([vertices['x'], vertices['y'], vertices['z']], axis=1).astype(np.float64)
+    os.makedirs(folder, exist_ok=True)
+    for filename in os.listdir(folder):
+        if filename.endswith('.ply'):
+            os.remove(os.path.join(folder, filename))
+
+    origin = xyz.min(axis=0) if len(xyz) > 0 else np.zeros(3)
+    size = float((xyz.max(axis=0) - origin).max()) if len(xyz) > 0 else 0.0
+    # the farthest points must stay inside the root cube
+    size = max(size * (1 + 1e-6), 1e-6)
+
+    nodes = []
+    remaining = np.arange(len(vertices))
+    for level in range(max_depth + 1):
+        if len(remaining) == 0:
+            break
+        node_size = size / 2 ** level
+        index = np.clip(np.floor((xyz[remaining] - origin) / node_size).astype(np.int64), 0, 2 ** level - 1)
+        keys = pack_voxel_index(index)
+        order = np.argsort(keys, kind='stable')
+        remaining, keys, index = remaining[order], keys[order], index[order]
+        _, starts, counts = np.unique(keys, return_index=True, return_counts=True)
+        owner = np.repeat(np.arange(len(starts)), counts)
+
+        # first point of every sampling cell, all points of the leaves
+        selected = np.repeat((counts <= node_points) | (level == max_depth), counts)
+        _, first = np.unique(voxel_keys(xyz[remaining] - origin, node_size / grid_cells), return_index=True)
+        selected[first] = True
+
+        node_counts = np.bincount(owner[selected], minlength=len(starts))
+        names = node_names(level, index[starts])
+        for name, points, node_count, subtree_count, node_index in zip(
+                names, np.split(remaining[selected], np.cumsum(node_counts)[:-1]), node_counts, counts, index[starts]):
+            with PlyStreamWriter(os.path.join(folder, name + '.ply')) as writer:
+                writer.write_vertex(vertices[points])
+            low = origin + node_index * node_size
+            nodes.append({'name': name, 'level': level, 'count': int(node_count), 'subtree': int(subtree_count),
+                          'bbox_min': low.tolist(), 'bbox_max': (low + node_size).tolist()})
+        remaining = remaining[~selected]
+
+    levels = max(node['level'] for node in nodes) + 1 if nodes else 0
+    with open(os.path.join(folder, LOD_INDEX), 'w') as f:
+        json.dump({'count': len(vertices), 'origin': origin.tolist(), 'size': size, 'grid_cells': grid_cells,
+                   'levels': levels, 'spacing': [size / grid_cells / 2 ** level for level in range(levels)],
+                   'nodes': nodes}, f)
+    return nodes
+
+
+# points of the nodes of an octree written by write_octree_lod up to max_level (all levels if None) whose cube
+# intersects [low, high] (all nodes if None), only those node files are read
+def read_octree_lod(folder, max_level=None, low=None, high=None):
+    with open(os.path.join(folder, LOD_INDEX)) as f:
+        nodes = json.load(f)['nodes']
+    parts = [np.zeros(0, dtype=VERTEX_DTYPE)]
+    for node in nodes:
+        if max_level is not None and node['level'] > max_level:
+            continue
+        if low is not None and (np.any(np.asarray(node['bbox_max']) < low) or np.any(np.asarray(node['bbox_min']) > high)):
+            continue
+        parts.append(np.asarray(ply_vertex_memmap(os.path.join(folder, node['name'] + '.ply'))))
+    return np.concatenate(parts)
@@ -0,0 +1,83 @@
+import json
+import os
+import numpy as np
+
+
+FUSION_MANIFEST = 'manifest.json'
+
+
+# (size, modification time) of an input file, None if it is missing
+def file_signature(filename):
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+# manifest entry of one reference view: signatures of all the files it reads and the parameters it was fused with
+def view_entry(input_files, params):
+    return {'inputs': {filename: file_signature(filename) for filename in input_files}, 'params': params}
+
+
+# per-scan manifest of incremental fusion: the fused (vertices, colors, visibility) chunk of every reference view
+# is kept next to the manifest, and a view is only recomputed when the signature of one of its inputs (its own
+# depth, confidence, image and camera, the depths and cameras of its source views) or its parameters changed
+class FusionManifest(object):
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.entries = {}
+        filename = os.path.join(cache_dir, FUSION_MANIFEST)
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.entries = json.load(f)
+
+    def chunk_filename(self, ref_view):
+        return os.path.join(self.cache_dir, '{:0>8}.npz'.format(ref_view))
+
+    def is_current(self, ref_view, entry):
+        return self.entries.get(str(ref_view)) == entry and os.path.exists(self.chunk_filename(ref_view))
+
+    def load_chunk(self, ref_view):
+        with np.load(self.chunk_filename(ref_view)) as data:
+            visibility = None
+            if 'ref_pixels' in data:
+                visibility = (ref_view, data['ref_pixels'], data['src_views'].tolist(), data['src_pixels'],
+                              int(data['size']))
+            return data['vertices'], data['colors'], visibility
+
+    def save_chunk(self, ref_view, chunk, entry):
+        vertices, colors, visibility = chunk
+        arrays = {'vertices': vertices, 'colors': colors}
+        if visibility is not None:
+            _, arrays['ref_pixels'], src_views, arrays['src_pixels'], size = visibility
+            arrays['src_views'] = np.array(src_views, dtype=np.int64)
+            arrays['size'] = np.array(size, dtype=np.int64)
+        filename = self.chunk_filename(ref_view)
+        with open(filename + '.tmp', 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(filename + '.tmp', filename)
+        self.entries[str(ref_view)] = entry
+
+    # chunks of all reference views in order, cached ones are read back and the stale ones are taken from computed
+    # (the chunks of the stale views, in the same order) and cached. The manifest is written once all are through.
+    def assemble(self, ref_views, entries, stale, computed):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for ref_view, entry, is_stale in zip(ref_views, entries, stale):
+            if is_stale:
+                chunk = next(computed)
+                self.save_chunk(ref_view, chunk, entry)
+            else:
+                chunk = self.load_chunk(ref_view)
+            yield chunk
+        # run a generator source to its end so its own bookkeeping completes
+        for _ in computed:
+            pass
+        self.entries = {str(ref_view): self.entries[str(ref_view)] for ref_view in ref_views}
+        self.write()
+
+    def write(self):
+        filename = os.path.join(self.cache_dir, FUSION_MANIFEST)
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(filename + '.tmp', filename)
@@ -0,0 +1,143 @@
+import json
+import os
+import numpy as np
+
+from depthfusion.dedup import voxel_keys
+from depthfusion.ply import VERTEX_DTYPE, PlyStreamWriter, ply_vertex_memmap
+from depthfusion.spatial import GridIndex, cells_in_box, concatenate_ranges
+
+
+# spilled points remember the scan they come from, earlier scans win over later ones
+MERGE_DTYPE = np.dtype(VERTEX_DTYPE.descr + [('scan', '<u2')])
+CELL_DTYPE = np.dtype([('key', '<i8'), ('start', '<i8'), ('count', '<i8')])
+MERGE_INDEX = 'index.json'
+
+
+def record_xyz(records):
+    return np.stack([records['x'], records['y'], records['z']], axis=1).astype(np.float64)
+
+
+# merge the fused point clouds of several scans into one spatially indexed cloud in index_folder:
+#   points.ply  the merged points, sorted by cell of size cell_size (a plain binary PLY)
+#   cells.npy   key, first point and point count of every non-empty cell
+#   index.json  cell size, tolerance, inputs, point count and bounding box
+# a point is dropped when a point of an earlier scan lies within tolerance of it. The clouds are streamed from
+# their PLY files into slabs of slab_cells cells along x on disk (spill_bytes buffered in memory), and the slabs
+# are deduplicated one at a time with a tolerance margin from their neighbours, so memory follows one slab.
+def merge_clouds(plyfilenames, index_folder, tolerance, cell_size, slab_cells=16, spill_bytes=512 * 1024 ** 2,
+                 chunk_size=1 << 20):
+    assert 0 <= tolerance <= cell_size
+    spill_folder = os.path.join(index_folder, 'spill')
+    os.makedirs(spill_folder, exist_ok=True)
+    slab_width = slab_cells * cell_size
+
+    def slab_filename(slab):
+        return os.path.join(spill_folder, 'slab_{}.bin'.format(slab))
+
+    def read_slab(slab):
+        if not os.path.exists(slab_filename(slab)):
+            return np.zeros(0, dtype=MERGE_DTYPE)
+        return np.fromfile(slab_filename(slab), dtype=MERGE_DTYPE)
+
+    # pass 1: stream every cloud into its slabs
+    buffers, buffered_bytes, slabs = {}, 0, set()
+    for scan, plyfilename in enumerate(plyfilenames):
+        vertices = ply_vertex_memmap(plyfilename)
+        for start in range(0, len(vertices), chunk_size):
+            chunk = vertices[start:start + chunk_size]
+            records = np.empty(len(chunk), dtype=MERGE_DTYPE)
+            for name in VERTEX_DTYPE.names:
+                records[name] = chunk[name]
+            records['scan'] = scan
+            slab_index = np.floor(records['x'] / slab_width).astype(np.int64)
+            order = np.argsort(slab_index, kind='stable')
+            slab_ids, starts = np.unique(slab_index[order], return_index=True)
+            for slab, part in zip(slab_ids.tolist(), np.split(records[order], starts[1:])):
+                buffers.setdefault(slab, []).append(part)
+            buffered_bytes += records.nbytes
+            if buffered_bytes >= spill_bytes:
+                for slab, parts in buffers.items():
+                    with open(slab_filename(slab), 'ab') as f:
+                        np.concatenate(parts).tofile(f)
+                    slabs.add(slab)
+                buffers, buffered_bytes = {}, 0
+    for slab, parts in buffers.items():
+        with open(slab_filename(slab), 'ab') as f:
+            np.concatenate(parts).tofile(f)
+        slabs.add(slab)
+
+    # pass 2: deduplicate and index the slabs in x order, which is also cell key order
+    cells = []
+    bbox = [np.full(3, np.inf), np.full(3, -np.inf)]
+    with PlyStreamWriter(os.path.join(index_folder, 'points.ply')) as writer:
+        for slab in sorted(slabs):
+            records = read_slab(slab)
+            keep = np.ones(len(records), dtype=bool)
+            if tolerance > 0:
+                # points of the neighbouring slabs within tolerance of the slab boundaries
+                previous, following = read_slab(slab - 1), read_slab(slab + 1)
+                margin = np.concatenate([previous[previous['x'] >= slab * slab_width - tolerance],
+                                         following[following['x'] < (slab + 1) * slab_width + tolerance]])
+                reference = np.concatenate([records, margin])
+                for scan in np.unique(records['scan']):
+                    earlier = reference[reference['scan'] < scan]
+                    if len(earlier) == 0:
+                        continue
+                    current = np.flatnonzero(records['scan'] == scan)
+                    keep[current] = ~GridIndex(record_xyz(earlier), tolerance).any_within(
+                        record_xyz(records[current]), tolerance)
+            records = records[keep]
+            if len(records) == 0:
+                continue
+
+            xyz = record_xyz(records)
+            keys = voxel_keys(xyz, cell_size)
+            order = np.argsort(keys, kind='stable')
+            slab_keys, starts, counts = np.unique(keys[order], return_index=True, return_counts=True)
+            slab_cells_table = np.empty(len(slab_keys), dtype=CELL_DTYPE)
+            slab_cells_table['key'], slab_cells_table['start'], slab_cells_table['count'] = \
+                slab_keys, starts + writer.count, counts
+            cells.append(slab_cells_table)
+            bbox = [np.minimum(bbox[0], xyz.min(axis=0)), np.maximum(bbox[1], xyz.max(axis=0))]
+            writer.write_vertex(np.ascontiguousarray(records[order][list(VERTEX_DTYPE.names)]).astype(VERTEX_DTYPE))
+            print("merged slab {}: {} points kept, {} duplicates".format(slab, len(records), len(keep) - len(records)))
+        count = writer.count
+
+    for slab in slabs:
+        os.remove(slab_filename(slab))
+    os.rmdir(spill_folder)
+
+    np.save(os.path.join(index_folder, 'cells.npy'), np.concatenate(cells) if cells else np.zeros(0, dtype=CELL_DTYPE))
+    with open(os.path.join(index_folder, MERGE_INDEX), 'w') as f:
+        json.dump({'cell_size': cell_size, 'tolerance': tolerance, 'inputs': list(plyfilenames), 'count': count,
+                   'bbox_min': bbox[0].tolist(), 'bbox_max': bbox[1].tolist()}, f)
+    return count
+
+
+# read-only access to a merged cloud: only the cell table is loaded, the points stay memory mapped and a query
+# reads the cells overlapping its box
+class PointCloudIndex(object):
+    def __init__(self, index_folder):
+        with open(os.path.join(index_folder, MERGE_INDEX)) as f:
+            self.meta = json.load(f)
+        self.cell_size = self.meta['cell_size']
+        self.cells = np.load(os.path.join(index_folder, 'cells.npy'))
+        self.points = ply_vertex_memmap(os.path.join(index_folder, 'points.ply'))
+
+    def __len__(self):
+        return len(self.points)
+
+    # points with low <= xyz <= high, as a VERTEX_DTYPE array
+    def query_box(self, low, high):
+        low, high = np.asarray(low, dtype=np.float64), np.asarray(high, dtype=np.float64)
+        starts, counts = cells_in_box(self.cells['key'], self.cells['start'], self.cells['count'],
+                                      np.floor(low / self.cell_size), np.floor(high / self.cell_size), self.cell_size)
+        points = np.asarray(self.points[concatenate_ranges(starts, counts)])
+        xyz = record_xyz(points)
+        return points[np.all((xyz >= low) & (xyz <= high), axis=1)]
+
+    # points closer than radius to center, as a VERTEX_DTYPE array
+    def query_radius(self, center, radius):
+        center = np.asarray(center, dtype=np.float64)
+        points = self.query_box(center - radius, center + radius)
+        return points[np.sum((record_xyz(points) - center) ** 2, axis=1) < radius ** 2]
@@ -0,0 +1,62 @@
+import multiprocessing
+import numpy as np
+
+from depthfusion.spatial import GridIndex
+
+
+# neighbour statistic of the first num_points points of a slab, whose remaining points are the margin of the
+# neighbouring slabs within radius: the number of other points closer than radius ('radius'), or the mean distance
+# to the k nearest other points within radius ('statistical', inf with fewer)
+def slab_statistic(task):
+    points, num_points, mode, radius, k = task
+    index = GridIndex(points, radius)
+    if mode == 'radius':
+        return index.count_within(points[:num_points], radius) - 1
+    # the closest point of every query is itself
+    return index.knn_distances(points[:num_points], k + 1, radius)[:, 1:].mean(axis=1)
+
+
+# neighbour statistic of every point [N, 3] as slab_statistic, over x slabs of about equal point counts with
+# their margins, computed by workers processes
+def neighbor_statistics(points, mode, radius, k=0, workers=1, slab_points=1 << 20):
+    points = np.asarray(points, dtype=np.float64)
+    order = np.argsort(points[:, 0], kind='stable')
+    x = points[order, 0]
+    num_slabs = max(workers * 4, -(-len(points) // slab_points), 1)
+    bounds = np.linspace(0, len(points), num_slabs + 1).astype(np.int64)
+
+    def tasks():
+        for begin, end in zip(bounds[:-1], bounds[1:]):
+            if begin == end:
+                continue
+            low = np.searchsorted(x, x[begin] - radius, side='left')
+            high = np.searchsorted(x, x[end - 1] + radius, side='right')
+            margin = np.concatenate([order[low:begin], order[end:high]])
+            yield points[np.concatenate([order[begin:end], margin])], end - begin, mode, radius, k
+
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            statistics = list(pool.imap(slab_statistic, tasks()))
+    else:
+        statistics = [slab_statistic(task) for task in tasks()]
+    result = np.empty(len(points), dtype=np.float64)
+    result[order] = np.concatenate(statistics) if statistics else np.zeros(0)
+    return result
+
+
+# points to keep [N] bool after outlier removal:
+#   'radius'       points with at least min_neighbors other points closer than radius
+#   'statistical'  points whose mean distance to their k nearest other points is at most the mean of all points
+#                  plus std_ratio standard deviations; neighbours are searched within radius, points with fewer
+#                  than k of them are outliers
+def remove_outliers(points, mode, radius, min_neighbors=0, k=0, std_ratio=2.0, workers=1):
+    if mode == 'radius':
+        return neighbor_statistics(points, mode, radius, workers=workers) >= min_neighbors
+    elif mode == 'statistical':
+        mean_distances = neighbor_statistics(points, mode, radius, k, workers)
+        finite = np.isfinite(mean_distances)
+        if not np.any(finite):
+            return finite
+        threshold = mean_distances[finite].mean() + std_ratio * mean_distances[finite].std()
+        return finite & (mean_distances <= threshold)
+    raise ValueError('unknown outlier removal mode {}'.format(mode))
@@ -0,0 +1,95 @@
+import os
+import shutil
+import numpy as np
+
+from depthfusion.dedup import VOXEL_KEY_OFFSET
+from depthfusion.merge import merge_clouds
+from depthfusion.ply import ply_vertex_memmap
+
+
+# camera centers [N, 3] of world to camera extrinsics [N, 4, 4]
+def camera_centers(extrinsics):
+    extrinsics = np.asarray(extrinsics, dtype=np.float64)
+    return -np.einsum('nji,nj->ni', extrinsics[:, :3, :3], extrinsics[:, :3, 3])
+
+
+# views whose depth maps fusing some reference views reads: the reference views and their source views, sorted
+# src_views: {ref_view: [src_view, ...]}
+def chunk_views(ref_views, src_views):
+    views = set(ref_views)
+    for ref_view in ref_views:
+        views.update(src_views[ref_view])
+    return sorted(views)
+
+
+# split the reference views of a scan into spatial chunks of at most max_views views (reference views and their
+# source views): the camera centers are bisected recursively across their widest axis, at the split within the
+# middle half that cuts the fewest pair.txt edges. Every reference view is fused in exactly one chunk, neighbouring
+# chunks overlap in the source views they share.
+# pair_data: [(ref_view, [src_view, ...])] as read_pair_file; centers: {ref_view: [3]}
+# out: [(ref_views, views)] in bisection order, the reference views of a chunk in pair.txt order
+def partition_views(pair_data, centers, max_views):
+    position = {ref_view: i for i, (ref_view, _) in enumerate(pair_data)}
+    src_views = dict(pair_data)
+    chunks = []
+
+    def bisect(ref_views):
+        views = chunk_views(ref_views, src_views)
+        if len(ref_views) <= 1 or len(views) <= max_views:
+            chunks.append((sorted(ref_views, key=position.get), views))
+            return
+        xyz = np.array([centers[ref_view] for ref_view in ref_views])
+        axis = np.argmax(xyz.max(axis=0) - xyz.min(axis=0))
+        order = [ref_views[i] for i in np.argsort(xyz[:, axis], kind='stable')]
+        rank = {ref_view: i for i, ref_view in enumerate(order)}
+        # cut[s]: pair edges between order[:s] and order[s:]
+        cut = np.zeros(len(order) + 1, dtype=np.int64)
+        for ref_view in order:
+            for src_view in src_views[ref_view]:
+                if src_view in rank:
+                    low, high = sorted((rank[ref_view], rank[src_view]))
+                    cut[low + 1] += 1
+                    cut[high + 1] -= 1
+        cut = np.cumsum(cut)
+        n = len(order)
+        split = min(range(max(1, n // 4), min(n - 1, n - n // 4) + 1), key=lambda s: (cut[s], abs(2 * s - n)))
+        bisect(order[:split])
+        bisect(order[split:])
+
+    bisect([ref_view for ref_view, _ in pair_data])
+    return chunks
+
+
+# views in the order the chunks first need them, e.g. to infer the depth maps of a scan chunk by chunk
+def inference_order(chunks):
+    order, seen = [], set()
+    for _, views in chunks:
+        order += [view for view in views if view not in seen]
+        seen.update(views)
+    return order
+
+
+# index of the last chunk reading each view, its depth map can be dropped once that chunk is fused
+def last_chunk_uses(chunks):
+    return {view: i for i, (_, views) in enumerate(chunks) for view in views}
+
+
+# merge the point clouds fused per chunk into plyfilename with merge_clouds, dropping the points of a later chunk
+# within tolerance of a point of an earlier one along the chunk boundaries. The merge cells are 1/1024 of the
+# widest extent of the clouds (at least tolerance), so memory follows one merge slab of about 1/64 of the scene.
+def merge_partitions(part_files, plyfilename, tolerance):
+    low, high = np.full(3, np.inf), np.full(3, -np.inf)
+    for part_file in part_files:
+        vertices = ply_vertex_memmap(part_file)
+        if len(vertices) > 0:
+            for axis, name in enumerate('xyz'):
+                low[axis] = min(low[axis], vertices[name].min())
+                high[axis] = max(high[axis], vertices[name].max())
+    cell_size = tolerance
+    if np.all(low <= high):
+        cell_size = max(cell_size, np.max(high - low) / 1024, np.max(np.abs([low, high])) / (VOXEL_KEY_OFFSET // 2))
+    index_folder = os.path.splitext(plyfilename)[0] + '_merge'
+    count = merge_clouds(part_files, index_folder, tolerance, cell_size if cell_size > 0 else 1.0)
+    os.replace(os.path.join(index_folder, 'points.ply'), plyfilename)
+    shutil.rmtree(index_folder)
+    return count
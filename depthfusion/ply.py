@@ -0,0 +1,174 @@
+import json
+import os
+import numpy as np
+
+
+VERTEX_DTYPE = np.dtype([('x', '<f4'), ('y', '<f4'), ('z', '<f4'), ('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
+PLY_TYPE_NAMES = {'f4': 'float', 'f8': 'double', 'u1': 'uchar', 'i4': 'int', 'u4': 'uint'}
+PLY_NUMPY_TYPES = {'char': 'i1', 'uchar': 'u1', 'short': 'i2', 'ushort': 'u2', 'int': 'i4', 'uint': 'u4',
+                   'float': 'f4', 'double': 'f8', 'int8': 'i1', 'uint8': 'u1', 'int16': 'i2', 'uint16': 'u2',
+                   'int32': 'i4', 'uint32': 'u4', 'float32': 'f4', 'float64': 'f8'}
+# the vertex count is zero padded to a fixed width so it can be patched in place once all chunks are written
+COUNT_WIDTH = 12
+
+
+def ply_header(count, dtype=VERTEX_DTYPE):
+    lines = ['ply', 'format binary_little_endian 1.0', 'element vertex {:0>{}d}'.format(count, COUNT_WIDTH)]
+    for name in dtype.names:
+        lines.append('property {} {}'.format(PLY_TYPE_NAMES[dtype[name].str[1:]], name))
+    lines.append('end_header')
+    return ('\n'.join(lines) + '\n').encode('ascii')
+
+
+# header of a binary little endian PLY whose first element is the vertex
+# out: vertex dtype, vertex count, byte offset of the vertex data
+def read_ply_header(filename):
+    with open(filename, 'rb') as f:
+        if f.readline().strip() != b'ply':
+            raise ValueError('{} is not a PLY file'.format(filename))
+        names, types, count, element = [], [], None, None
+        for line in iter(f.readline, b''):
+            words = line.decode('ascii').split()
+            if len(words) == 0 or words[0] in ('comment', 'obj_info'):
+                continue
+            if words[0] == 'format' and words[1] != 'binary_little_endian':
+                raise ValueError('{}: only binary_little_endian PLY files are supported'.format(filename))
+            elif words[0] == 'element':
+                element = words[1]
+                if element == 'vertex':
+                    count = int(words[2])
+                elif count is None:
+                    raise ValueError('{}: the vertex element must come first'.format(filename))
+            elif words[0] == 'property' and element == 'vertex':
+                if words[1] == 'list':
+                    raise ValueError('{}: list properties are not supported for vertices'.format(filename))
+                names.append(words[2])
+                types.append('<' + PLY_NUMPY_TYPES[words[1]])
+            elif words[0] == 'end_header':
+                return np.dtype(list(zip(names, types))), count, f.tell()
+    raise ValueError('{}: missing end_header'.format(filename))
+
+
+# read-only memory map of the vertices of a binary PLY, nothing is loaded until it is indexed
+def ply_vertex_memmap(filename):
+    dtype, count, offset = read_ply_header(filename)
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(count,))
+
+
+# vertices of any PLY file as a structured array: binary little endian ones are memory mapped, other encodings
+# (ascii, big endian ground truth clouds) are read through plyfile
+def ply_vertices(filename):
+    try:
+        return ply_vertex_memmap(filename)
+    except ValueError:
+        from plyfile import PlyData
+        return PlyData.read(filename)['vertex'].data
+
+
+# float64 xyz [N, 3] of the vertices of any PLY file
+def read_ply_xyz(filename):
+    vertices = ply_vertices(filename)
+    return np.stack([vertices['x'], vertices['y'], vertices['z']], axis=1).astype(np.float64)
+
+
+# PLY files of a point cloud written by PlyStreamWriter (the file itself) or ChunkedPlyWriter (its folder)
+def ply_files(path):
+    if not os.path.isdir(path):
+        return [path]
+    with open(os.path.join(path, 'index.json')) as f:
+        return [os.path.join(path, chunk['file']) for chunk in json.load(f)['chunks']]
+
+
+# structured vertex array from xyz [N, 3] and colors [N, 3] uint8, without going through python tuples
+def vertex_array(vertices, colors):
+    vertex_all = np.empty(len(vertices), dtype=VERTEX_DTYPE)
+    for i, prop in enumerate(('x', 'y', 'z')):
+        vertex_all[prop] = vertices[:, i]
+    for i, prop in enumerate(('red', 'green', 'blue')):
+        vertex_all[prop] = colors[:, i]
+    return vertex_all
+
+
+# binary PLY writer that streams vertex chunks to disk, the header count is patched on close.
+# peak memory is one chunk, whatever the size of the final point cloud.
+class PlyStreamWriter(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'wb')
+        self.file.write(ply_header(0))
+        self.count = 0
+
+    def write(self, vertices, colors):
+        self.write_vertex(vertex_array(vertices, colors))
+
+    # write an already structured VERTEX_DTYPE array
+    def write_vertex(self, vertex_all):
+        np.ascontiguousarray(vertex_all, dtype=VERTEX_DTYPE).tofile(self.file)
+        self.count += len(vertex_all)
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.seek(0)
+        self.file.write(ply_header(self.count))
+        self.file.close()
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# point cloud split into PLY files of at most chunk_points vertices, with an index.json listing the chunks,
+# their vertex counts and bounding boxes so a reader can pick chunks without opening them
+class ChunkedPlyWriter(object):
+    def __init__(self, folder, chunk_points=1 << 22):
+        self.folder = folder
+        self.chunk_points = chunk_points
+        self.chunks = []
+        self.writer = None
+        self.count = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def write(self, vertices, colors):
+        self.write_vertex(vertex_array(vertices, colors))
+
+    def write_vertex(self, vertex_all):
+        start = 0
+        while start < len(vertex_all):
+            if self.writer is None or self.writer.count >= self.chunk_points:
+                self.close_chunk()
+                self.writer = PlyStreamWriter(os.path.join(self.folder, '{:0>6}.ply'.format(len(self.chunks))))
+                self.bbox = [np.full(3, np.inf), np.full(3, -np.inf)]
+            part = vertex_all[start:start + self.chunk_points - self.writer.count]
+            xyz = np.stack([part['x'], part['y'], part['z']], axis=1)
+            self.bbox = [np.minimum(self.bbox[0], xyz.min(axis=0)), np.maximum(self.bbox[1], xyz.max(axis=0))]
+            self.writer.write_vertex(part)
+            self.count += len(part)
+            start += len(part)
+
+    def close_chunk(self):
+        if self.writer is None:
+            return
+        self.writer.close()
+        self.chunks.append({'file': os.path.basename(self.writer.filename), 'count': self.writer.count,
+                            'bbox_min': self.bbox[0].tolist(), 'bbox_max': self.bbox[1].tolist()})
+        self.writer = None
+
+    def close(self):
+        if self.chunks is None:
+            return
+        self.close_chunk()
+        with open(os.path.join(self.folder, 'index.json'), 'w') as f:
+            json.dump({'count': self.count, 'chunks': self.chunks}, f)
+        self.chunks = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
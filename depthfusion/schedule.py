@@ -0,0 +1,126 @@
+from collections import OrderedDict
+
+
+# cached camera: float32 intrinsics and extrinsics and their float64 inverses
+CAMERA_BYTES = (9 + 16) * 4 + (9 + 16) * 8
+
+
+# cache accesses of fusion.py filter_view for one reference view, in order: (key, bytes)
+def view_accesses(ref_view, src_views, map_bytes):
+    accesses = [(('depth', ref_view), map_bytes), (('confidence', ref_view), map_bytes),
+                (('camera', ref_view), CAMERA_BYTES)]
+    accesses += [(('camera', src_view), CAMERA_BYTES) for src_view in src_views]
+    accesses += [(('depth', src_view), map_bytes) for src_view in src_views]
+    return accesses
+
+
+# feature cache accesses of eval.py --feature_cache_mb for one sample: the feature maps of its reference and source
+# images, in order: (key, bytes)
+def feature_accesses(ref_view, src_views, feature_bytes):
+    return [(('feature', view), feature_bytes) for view in [ref_view] + list(src_views)]
+
+
+# LRU with the eviction rule of ScanCache, tracking keys and sizes only
+class LRUSimulator(object):
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def access(self, key, size):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return
+        self.misses += 1
+        if size <= self.max_bytes:
+            self.entries[key] = size
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, evicted_size = self.entries.popitem(last=False)
+                self.nbytes -= evicted_size
+
+    # the accesses of one reference view in order as ScanCache.get, or with lookup_first all lookups before the
+    # misses are inserted, as eval.py --feature_cache_mb assembles a sample from its cached features
+    def access_all(self, accesses, lookup_first=False):
+        if not lookup_first:
+            for key, size in accesses:
+                self.access(key, size)
+            return
+        missing = [(key, size) for key, size in accesses if key not in self.entries]
+        for key, size in accesses:
+            if key in self.entries:
+                self.access(key, size)
+        for key, size in missing:
+            self.access(key, size)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+
+# expected hit rate of the per-worker caches when segment i of reference views runs on worker i % num_workers
+# segments: lists of reference views; src_views: {ref_view: [src_view, ...]}
+# accesses, lookup_first: access model of one reference view, view_accesses or feature_accesses, as access_all
+def expected_hit_rate(segments, src_views, map_bytes, max_bytes, num_workers=1, accesses=view_accesses,
+                      lookup_first=False):
+    caches = [LRUSimulator(max_bytes) for _ in range(num_workers)]
+    for i, segment in enumerate(segments):
+        for ref_view in segment:
+            caches[i % num_workers].access_all(accesses(ref_view, src_views[ref_view], map_bytes), lookup_first)
+    hits = sum(cache.hits for cache in caches)
+    total = hits + sum(cache.misses for cache in caches)
+    return hits / total if total > 0 else 0.0
+
+
+# order the reference views so consecutive views share their source depth maps: starting from the first view of
+# pair.txt, always take the view with the most depth maps (its own and its source views') in the simulated cache,
+# breaking ties by its pair score with the previous view, then by pair.txt order
+# pair_data: [(ref_view, [src_view, ...])] as read_pair_file; scores: [[score, ...]] as read_score_file
+# accesses, kind, lookup_first: access model of one reference view as in expected_hit_rate and the key kind of its
+# per-view maps ('depth' of view_accesses or 'feature' of feature_accesses)
+def schedule_views(pair_data, scores, map_bytes, max_bytes, accesses=view_accesses, kind='depth', lookup_first=False):
+    position = {ref_view: i for i, (ref_view, _) in enumerate(pair_data)}
+    needed = {ref_view: [ref_view] + list(src_views) for ref_view, src_views in pair_data}
+    pair_score = {}
+    for (ref_view, src_views), view_scores in zip(pair_data, scores):
+        for src_view, score in zip(src_views, view_scores):
+            pair_score[(ref_view, src_view)] = score
+            pair_score[(src_view, ref_view)] = max(score, pair_score.get((src_view, ref_view), score))
+    # reference views reading each depth map
+    users = {}
+    for ref_view, views in needed.items():
+        for view in views:
+            users.setdefault(view, []).append(ref_view)
+
+    # every map fits in the cache, any order only misses once per map
+    if 2 * map_bytes * len(pair_data) <= max_bytes:
+        return [ref_view for ref_view, _ in pair_data]
+
+    cache = LRUSimulator(max_bytes)
+    unvisited = set(position)
+    order = []
+    previous = None
+    while unvisited:
+        cached = [key[1] for key in cache.entries if key[0] == kind]
+        candidates = {ref_view for view in cached for ref_view in users.get(view, []) if ref_view in unvisited}
+        if candidates:
+            def rank(ref_view):
+                in_cache = sum((kind, view) in cache.entries for view in needed[ref_view])
+                return in_cache, pair_score.get((previous, ref_view), 0.0), -position[ref_view]
+            current = max(candidates, key=rank)
+        else:
+            current = min(unvisited, key=position.get)
+        unvisited.remove(current)
+        order.append(current)
+        previous = current
+        cache.access_all(accesses(current, needed[current][1:], map_bytes), lookup_first)
+    return order
+
+
+# split an ordering into about segments_per_worker contiguous segments per worker, each run by one worker
+def split_segments(order, num_workers, segments_per_worker=4):
+    segment_views = max(1, -(-len(order) // (num_workers * segments_per_worker)))
+    return [order[i:i + segment_views] for i in range(0, len(order), segment_views)]
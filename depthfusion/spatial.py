@@ -0,0 +1,142 @@
+import itertools
+import numpy as np
+
+from depthfusion.dedup import voxel_keys, pack_voxel_index, unpack_voxel_keys, VOXEL_KEY_BITS, VOXEL_KEY_OFFSET
+
+
+NEIGHBOR_OFFSETS = np.array(list(itertools.product((-1, 0, 1), repeat=3)), dtype=np.int64)
+
+
+# in-memory uniform grid over a point set for fixed-radius queries. Points are sorted by cell key, so every
+# query only looks at the points of its 27 neighbouring cells; the radius must not exceed the cell size.
+# (query, candidate) pairs are expanded vectorized, at most max_pairs at a time.
+class GridIndex(object):
+    def __init__(self, points, cell_size, max_pairs=1 << 22):
+        self.cell_size = cell_size
+        self.max_pairs = max_pairs
+        points = np.asarray(points, dtype=np.float64).reshape([-1, 3])
+        keys = voxel_keys(points, cell_size)
+        # index of each sorted point in the input
+        self.order = np.argsort(keys, kind='stable')
+        self.points = points[self.order]
+        self.cell_keys, self.cell_starts, self.cell_counts = np.unique(keys[self.order], return_index=True,
+                                                                       return_counts=True)
+
+    def __len__(self):
+        return len(self.points)
+
+    # start and count of the sorted points in the cells with the given integer coordinates [N, 3], 0 if empty
+    def cell_ranges(self, index):
+        keys = pack_voxel_index(index, self.cell_size)
+        if len(self.cell_keys) == 0:
+            return np.zeros(len(keys), dtype=np.int64), np.zeros(len(keys), dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.cell_keys, keys), len(self.cell_keys) - 1)
+        found = self.cell_keys[pos] == keys
+        return np.where(found, self.cell_starts[pos], 0), np.where(found, self.cell_counts[pos], 0)
+
+    # (queries [B], owners [P] indexing them, sorted candidate positions [P], squared distances [P]) of the
+    # indexed points in the 27 cells around each query point [N, 3], grouped by query, at most max_pairs at a time
+    # (a single query may exceed it)
+    def neighbor_pairs(self, queries):
+        index = np.floor(queries / self.cell_size).astype(np.int64)
+        for offset in NEIGHBOR_OFFSETS:
+            starts, counts = self.cell_ranges(index + offset)
+            active = np.flatnonzero(counts > 0)
+            bounds = np.searchsorted(np.cumsum(counts[active]), np.arange(0, counts.sum(), self.max_pairs),
+                                     side='right')
+            for begin, end in zip(bounds, np.append(bounds[1:], len(active))):
+                batch = active[begin:end]
+                if len(batch) == 0:
+                    continue
+                candidates = concatenate_ranges(starts[batch], counts[batch])
+                owners = np.repeat(np.arange(len(batch)), counts[batch])
+                squared = np.sum((self.points[candidates] - queries[batch[owners]]) ** 2, axis=1)
+                yield batch, owners, candidates, squared
+
+    # distance from each query point [N, 3] to its nearest indexed point, max_distance where none is closer
+    # out: distances [N], indices [N] of the nearest points in the input order (-1 where none is closer)
+    def nearest(self, queries, max_distance):
+        assert max_distance <= self.cell_size
+        queries = np.asarray(queries, dtype=np.float64).reshape([-1, 3])
+        best = np.full(len(queries), max_distance ** 2)
+        nearest = np.full(len(queries), -1, dtype=np.int64)
+        for batch, owners, candidates, squared in self.neighbor_pairs(queries):
+            # closest candidate of every query, the first one on ties
+            first = np.searchsorted(owners, np.arange(len(batch)))
+            closest = np.lexsort((squared, owners))[first]
+            closer = squared[closest] < best[batch]
+            best[batch[closer]] = squared[closest[closer]]
+            nearest[batch[closer]] = candidates[closest[closer]]
+        found = nearest >= 0
+        nearest[found] = self.order[nearest[found]]
+        return np.sqrt(best), nearest
+
+    # number of indexed points closer than radius to each query point [N, 3]
+    def count_within(self, queries, radius):
+        assert radius <= self.cell_size
+        queries = np.asarray(queries, dtype=np.float64).reshape([-1, 3])
+        counts = np.zeros(len(queries), dtype=np.int64)
+        for batch, owners, _, squared in self.neighbor_pairs(queries):
+            counts += np.bincount(batch[owners[squared < radius ** 2]], minlength=len(queries))
+        return counts
+
+    # ascending distances [N, k] from each query point [N, 3] to its k nearest indexed points closer than
+    # max_distance, inf where there are fewer
+    def knn_distances(self, queries, k, max_distance):
+        assert max_distance <= self.cell_size
+        queries = np.asarray(queries, dtype=np.float64).reshape([-1, 3])
+        best = np.full((len(queries), k), np.inf)
+        for batch, owners, _, squared in self.neighbor_pairs(queries):
+            # the k closest candidates of every query in this batch, merged into the k best so far
+            order = np.lexsort((squared, owners))
+            rank = np.arange(len(order)) - np.searchsorted(owners, owners[order])
+            closest = np.full((len(batch), k), np.inf)
+            kept = rank < k
+            closest[owners[order[kept]], rank[kept]] = squared[order[kept]]
+            best[batch] = np.sort(np.concatenate([best[batch], closest], axis=1), axis=1)[:, :k]
+        best[best >= max_distance ** 2] = np.inf
+        return np.sqrt(best)
+
+    # whether each query point has an indexed point closer than radius
+    def any_within(self, queries, radius):
+        return self.nearest(queries, radius)[1] >= 0
+
+    # indices (input order) of the points closer than radius to center, any radius
+    def query_radius(self, center, radius):
+        center = np.asarray(center, dtype=np.float64).reshape([3])
+        low = np.floor((center - radius) / self.cell_size).astype(np.int64)
+        high = np.floor((center + radius) / self.cell_size).astype(np.int64)
+        candidates = self.query_cells(low, high)
+        inside = np.sum((self.points[candidates] - center) ** 2, axis=1) < radius ** 2
+        return np.sort(self.order[candidates[inside]])
+
+    # sorted point positions of all cells with integer coordinates within [low, high]
+    def query_cells(self, low, high):
+        starts, counts = cells_in_box(self.cell_keys, self.cell_starts, self.cell_counts, low, high, self.cell_size)
+        return concatenate_ranges(starts, counts)
+
+
+# start and count of the non-empty cells (sorted keys, starts, counts) with integer coordinates within [low, high].
+# small boxes look their cells up, large ones scan the cell table
+def cells_in_box(cell_keys, cell_starts, cell_counts, low, high, cell_size=None):
+    # coordinates beyond the key range hold no cells
+    low = np.maximum(np.asarray(low, dtype=np.int64), -VOXEL_KEY_OFFSET)
+    high = np.minimum(np.asarray(high, dtype=np.int64), (1 << VOXEL_KEY_BITS) - 1 - VOXEL_KEY_OFFSET)
+    if np.any(high < low) or len(cell_keys) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    if np.prod(high - low + 1) < len(cell_keys):
+        index = np.stack(np.meshgrid(*[np.arange(l, h + 1) for l, h in zip(low, high)], indexing='ij'), axis=-1)
+        keys = pack_voxel_index(index.reshape([-1, 3]), cell_size)
+        pos = np.minimum(np.searchsorted(cell_keys, keys), len(cell_keys) - 1)
+        found = pos[cell_keys[pos] == keys]
+    else:
+        index = unpack_voxel_keys(cell_keys)
+        found = np.flatnonzero(np.all((index >= low) & (index <= high), axis=1))
+    return cell_starts[found], cell_counts[found]
+
+
+# positions of the concatenated ranges [start, start + count)
+def concatenate_ranges(starts, counts):
+    if len(starts) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
@@ -0,0 +1,76 @@
+import os
+import numpy as np
+
+from depthfusion.dedup import VoxelGrid
+
+
+# spilled points keep the float64 positions of the fused points so merging matches the in-memory VoxelGrid
+SPILL_DTYPE = np.dtype([('x', '<f8'), ('y', '<f8'), ('z', '<f8'), ('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
+
+
+# out-of-core VoxelGrid: points are bucketed into slabs of slab_voxels voxels along x and appended to one file per
+# slab whenever the buffered points exceed buffer_bytes. Slabs are merged one at a time at the end, so memory
+# follows the largest slab instead of the whole scene. Voxel keys are x-major, so walking the slabs in order
+# yields the merged points in the same key order as VoxelGrid.
+class SpilledVoxelGrid(object):
+    def __init__(self, folder, voxel_size, buffer_bytes=512 * 1024 ** 2, slab_voxels=256):
+        self.folder = folder
+        self.voxel_size = voxel_size
+        self.buffer_bytes = buffer_bytes
+        self.slab_voxels = slab_voxels
+        self.buffers = {}
+        self.buffered_bytes = 0
+        self.slabs = set()
+        os.makedirs(folder, exist_ok=True)
+        # slab files left behind by an interrupted run would be appended to
+        for filename in os.listdir(folder):
+            if filename.startswith('slab_'):
+                os.remove(os.path.join(folder, filename))
+
+    def slab_filename(self, slab):
+        return os.path.join(self.folder, 'slab_{}.bin'.format(slab))
+
+    def add(self, vertices, colors):
+        if len(vertices) == 0:
+            return
+        records = np.empty(len(vertices), dtype=SPILL_DTYPE)
+        for i, prop in enumerate(('x', 'y', 'z')):
+            records[prop] = vertices[:, i]
+        for i, prop in enumerate(('red', 'green', 'blue')):
+            records[prop] = colors[:, i]
+
+        slab_index = np.floor(vertices[:, 0] / self.voxel_size).astype(np.int64) // self.slab_voxels
+        order = np.argsort(slab_index, kind='stable')
+        slabs, starts = np.unique(slab_index[order], return_index=True)
+        for slab, part in zip(slabs.tolist(), np.split(records[order], starts[1:])):
+            self.buffers.setdefault(slab, []).append(part)
+        self.buffered_bytes += records.nbytes
+        if self.buffered_bytes >= self.buffer_bytes:
+            self.spill()
+
+    # append the buffered points to their slab files
+    def spill(self):
+        for slab, parts in self.buffers.items():
+            with open(self.slab_filename(slab), 'ab') as f:
+                np.concatenate(parts).tofile(f)
+            self.slabs.add(slab)
+        self.buffers = {}
+        self.buffered_bytes = 0
+
+    # averaged points in voxel key order, the slab files are removed once merged
+    def chunks(self, chunk_size=1 << 20):
+        self.spill()
+        for slab in sorted(self.slabs):
+            filename = self.slab_filename(slab)
+            records = np.memmap(filename, dtype=SPILL_DTYPE, mode='r')
+            voxels = VoxelGrid(self.voxel_size)
+            for start in range(0, len(records), voxels.flush_points):
+                part = records[start:start + voxels.flush_points]
+                voxels.add(np.stack([part['x'], part['y'], part['z']], axis=1),
+                           np.stack([part['red'], part['green'], part['blue']], axis=1))
+            del records
+            for chunk in voxels.chunks(chunk_size):
+                yield chunk
+            os.remove(filename)
+        self.slabs = set()
+        os.rmdir(self.folder)
@@ -0,0 +1,142 @@
+from collections import OrderedDict
+import numpy as np
+import torch
+
+from models.module import reproject_with_depth
+
+
+# 4x4 projection matrix of the network, intrinsics applied to the top 3 rows of the extrinsics, in float64
+def projection_matrix(intrinsics, extrinsics):
+    proj = extrinsics.astype(np.float64)
+    proj[:3, :4] = np.matmul(intrinsics.astype(np.float64), proj[:3, :4])
+    return proj
+
+
+# number of thresholds [L] (ascending) each value is at or above, NaN is above all of them
+def levels_above(values, thresholds):
+    values = torch.where(torch.isnan(values), torch.full_like(values, float('inf')), values)
+    return (values.unsqueeze(-1) >= thresholds).sum(dim=-1)
+
+
+# depth and confidence maps of the views of one scan, kept as tensors on the inference device until the last
+# reference view of the scan is inferred and the scan is fused, instead of a PFM round trip
+class DepthStore(object):
+    def __init__(self, num_views):
+        self.num_views = num_views
+        self.maps = {}
+
+    def add(self, view, depth, confidence):
+        self.maps[view] = (depth, confidence)
+
+    def complete(self):
+        return len(self.maps) >= self.num_views
+
+    # whether the maps of all given views are stored
+    def contains(self, views):
+        return all(view in self.maps for view in views)
+
+    # drop the maps of views no later fusion reads
+    def release(self, views):
+        for view in views:
+            self.maps.pop(view, None)
+
+    # geometric consistency of one reference view on the device, levels as in check_geometric_consistency_batch
+    # ref_proj: [4, 4]; src_projs: [S, 4, 4] as projection_matrix
+    # out: numpy ref depth [H, W], confidence [H, W], geo_mask [H, W], geo_mask_sum [H, W], depth_est_averaged [H, W]
+    def check_geometric_consistency(self, ref_view, src_views, ref_proj, src_projs, levels):
+        depth_ref, confidence = self.maps[ref_view]
+        height, width = depth_ref.shape
+        depths_src = torch.stack([self.maps[src_view][0] for src_view in src_views]).float()
+        ref_proj = torch.from_numpy(ref_proj).to(depth_ref.device)
+        src_projs = torch.from_numpy(src_projs).to(depth_ref.device)
+        with torch.no_grad():
+            depth_ref = depth_ref.float()
+            depth_reprojected, x2d_reprojected, y2d_reprojected, _, _ = reproject_with_depth(
+                depth_ref, ref_proj, depths_src, src_projs)
+
+            y_ref, x_ref = torch.meshgrid([torch.arange(0, height, dtype=torch.float32, device=depth_ref.device),
+                                           torch.arange(0, width, dtype=torch.float32, device=depth_ref.device)])
+            depth_flat = depth_ref.reshape(1, -1)
+            # check |p_reproj-p_1| < pixel threshold and |d_reproj-d_1| / d_1 < relative depth threshold
+            dist = torch.sqrt((x2d_reprojected - x_ref.reshape(1, -1)) ** 2 + (y2d_reprojected - y_ref.reshape(1, -1)) ** 2)
+            relative_depth_diff = torch.abs(depth_reprojected - depth_flat) / depth_flat
+
+            # lowest satisfied level per source view and running cumulative histogram, as min_consistent_level
+            # and dynamic_geo_mask; NaN fails every level
+            dist_thresh = torch.tensor([level[1] for level in levels], dtype=torch.float32, device=depth_ref.device)
+            relative_thresh = torch.tensor([level[2] for level in levels], dtype=torch.float32, device=depth_ref.device)
+            min_levels = torch.max(levels_above(dist, dist_thresh), levels_above(relative_depth_diff, relative_thresh))
+            consistent_count = torch.zeros_like(depth_flat[0], dtype=torch.uint8)
+            # uint8 masks, torch.bool needs torch 1.2
+            geo_mask = torch.zeros_like(depth_flat[0], dtype=torch.uint8)
+            for i, (min_views, _, _) in enumerate(levels):
+                consistent_count += (min_levels == i).sum(dim=0).to(torch.uint8)
+                geo_mask = geo_mask | (consistent_count >= min_views).to(torch.uint8)
+
+            # the last level gates the depth averaging
+            depth_reprojected = torch.where(min_levels < len(levels), depth_reprojected, torch.zeros_like(depth_reprojected))
+            depth_est_averaged = (depth_reprojected.sum(dim=0) + depth_flat[0]) / (consistent_count.float() + 1)
+
+        outputs = (depth_ref, confidence.float(), geo_mask, consistent_count.int(), depth_est_averaged)
+        depth_ref, confidence, geo_mask, geo_mask_sum, depth_est_averaged = (
+            output.reshape(height, width).cpu().numpy() for output in outputs)
+        return depth_ref, confidence, geo_mask.astype(np.bool_), geo_mask_sum, depth_est_averaged
+
+    def clear(self):
+        self.maps = {}
+
+
+# bytes held by a cached feature map (a tensor, or a list of them for the multi-scale feature networks)
+def tensor_nbytes(value):
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    elif isinstance(value, (tuple, list)):
+        return sum(tensor_nbytes(v) for v in value)
+    return 0
+
+
+# copy of a feature map (or list of them) with its own storage, so a cached slice of a batch does not hold the batch
+def tensor_copy(value):
+    if isinstance(value, torch.Tensor):
+        return value.clone()
+    return [tensor_copy(v) for v in value]
+
+
+# LRU cache of the feature maps of the images of a scan on the inference device, with the eviction rule of ScanCache.
+# Every image is a reference view once and a source view of ~10 samples, so featurizing it once saves most of the
+# feature network. Keys are (scan, view, preprocessing) so images resized or cropped differently are not shared.
+class FeatureCache(object):
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    # cached features of key, None on a miss
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+        self.misses += 1
+        return None
+
+    def add(self, key, value):
+        size = tensor_nbytes(value)
+        # entries larger than the whole budget are not kept
+        if key in self.entries or size > self.max_bytes:
+            return
+        self.entries[key] = (tensor_copy(value), size)
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.nbytes -= evicted_size
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def clear(self):
+        self.entries = OrderedDict()
+        self.nbytes = 0
@@ -0,0 +1,94 @@
+import json
+import os
+import numpy as np
+
+from depthfusion.consistency import min_consistent_level, dynamic_geo_mask
+from depthfusion.ply import PlyStreamWriter
+
+
+SWEEP_INDEX = 'index.json'
+
+
+# dynamic consistency levels with the pixel and relative depth thresholds i/pixel_denominator and
+# i/depth_denominator, fusion.py uses 4 and 1300
+def sweep_levels(pixel_denominator, depth_denominator):
+    return [(i, i / pixel_denominator, i / depth_denominator) for i in range(2, 11)]
+
+
+# one record per cached reference pixel: flat pixel index, confidence, depth, color and, for each source view,
+# the reprojection error and the signed relative depth difference (d_reproj - d) / d quantized to float16
+def sweep_dtype(num_src):
+    return np.dtype([('pixel', '<i4'), ('confidence', '<f4'), ('depth', '<f4'), ('color', 'u1', (3,)),
+                     ('dist', '<f2', (num_src,)), ('relative_diff', '<f2', (num_src,))])
+
+
+def sweep_view_filename(cache_dir, ref_view):
+    return os.path.join(cache_dir, '{:0>8}.npy'.format(ref_view))
+
+
+# cached reprojection of one reference view
+# world_from_pixel: [4, 4] maps (x*d, y*d, d, 1) of a reference pixel to world coordinates
+# dist, relative_diff: [S, P] over the cached pixels
+def write_sweep_view(cache_dir, ref_view, pixels, confidence, depth, colors, dist, relative_diff):
+    records = np.empty(len(pixels), dtype=sweep_dtype(dist.shape[0]))
+    records['pixel'] = pixels
+    records['confidence'] = confidence
+    records['depth'] = depth
+    records['color'] = colors
+    # float16 saturates to inf beyond 65504, which fails every threshold like the exact value would
+    with np.errstate(over='ignore'):
+        records['dist'] = dist.T
+        records['relative_diff'] = relative_diff.T
+    np.save(sweep_view_filename(cache_dir, ref_view), records)
+
+
+# index of a scan cache: one entry per reference view, in pair.txt order
+# views: list of {'ref_view', 'width', 'world_from_pixel'}; photo_threshold: lowest threshold the cache can serve
+# inputs: {filename: file_signature} of the files the cache was computed from
+def write_sweep_index(cache_dir, views, photo_threshold, inputs):
+    with open(os.path.join(cache_dir, SWEEP_INDEX), 'w') as f:
+        json.dump({'photo_threshold': photo_threshold, 'views': views, 'inputs': inputs}, f)
+
+
+def read_sweep_index(cache_dir):
+    filename = os.path.join(cache_dir, SWEEP_INDEX)
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        return json.load(f)
+
+
+# fused points of one cached reference view for the given thresholds, same rules as fusion.py filter_view
+# out: vertices [N, 3] float32, colors [N, 3] uint8
+def sweep_view_points(records, width, world_from_pixel, photo_threshold, levels):
+    records = records[records['confidence'] > photo_threshold]
+    dist = records['dist'].T.astype(np.float32)
+    relative_diff = records['relative_diff'].T.astype(np.float32)
+
+    # |d_reproj - d| / d takes the sign of d, as in check_geometric_consistency_batch
+    depth = records['depth']
+    min_levels = min_consistent_level(dist, np.copysign(np.abs(relative_diff), depth), levels)
+    geo_mask, consistent_count = dynamic_geo_mask(min_levels, levels)
+
+    # the last level gates the depth averaging
+    depth_reprojected = np.where(min_levels < len(levels), depth * (1 + relative_diff), 0)
+    depth_averaged = (depth_reprojected.sum(axis=0) + depth) / (consistent_count.astype(np.int32) + 1)
+
+    pixels = records['pixel'][geo_mask]
+    depth_averaged = depth_averaged[geo_mask].astype(np.float32)
+    x, y = (pixels % width).astype(np.float32), (pixels // width).astype(np.float32)
+    xyzw = np.stack((x * depth_averaged, y * depth_averaged, depth_averaged, np.ones_like(depth_averaged)))
+    xyz_world = np.matmul(np.asarray(world_from_pixel, dtype=np.float64), xyzw)[:3]
+    return xyz_world.T.astype(np.float32), records['color'][geo_mask]
+
+
+# fuse a scan from its sweep cache with one threshold combination, the cached views are memory mapped
+# out: number of fused points
+def fuse_sweep(cache_dir, plyfilename, photo_threshold, pixel_denominator, depth_denominator):
+    index = read_sweep_index(cache_dir)
+    levels = sweep_levels(pixel_denominator, depth_denominator)
+    with PlyStreamWriter(plyfilename) as writer:
+        for view in index['views']:
+            records = np.load(sweep_view_filename(cache_dir, view['ref_view']), mmap_mode='r')
+            writer.write(*sweep_view_points(records, view['width'], view['world_from_pixel'], photo_threshold, levels))
+        return writer.count
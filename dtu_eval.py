@@ -0,0 +1,65 @@
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+from depthfusion import read_ply_xyz
+from depthfusion.evaluation import DTUFilter, downsample_points, dtu_scores
+
+parser = argparse.ArgumentParser(description='Evaluate fused DTU point clouds: accuracy, completeness and overall, '
+                                 'as the official MATLAB evaluation')
+parser.add_argument('--plydir', nargs='+', required=True, help='fusion.py output dirs, e.g. one per checkpoint')
+parser.add_argument('--gtpath', required=True, help='DTU evaluation data with Points/stl and ObsMask')
+parser.add_argument('--testlist', default='./lists/dtu/test.txt', help='testing scan list')
+parser.add_argument('--ply_name', default='mvsnet_{:0>3}_l3.ply', help='point cloud name of a scan id in --plydir')
+
+parser.add_argument('--downsample', type=float, default=0.2, help='reduce the point clouds to this density first, in mm')
+parser.add_argument('--max_dist', type=float, default=20, help='distances of at least this are outliers, in mm')
+parser.add_argument('--margin', type=float, default=60, help='margin of the bounding box around the ObsMask, in mm')
+parser.add_argument('--workers', type=int, default=-1, help='KD-tree query threads, -1 for all cores')
+parser.add_argument('--chunk_points', type=int, default=1 << 20, help='points queried per chunk')
+
+# parse arguments and check
+args = parser.parse_args()
+print("argv:", sys.argv[1:])
+
+
+# accuracy, completeness and overall of one fused point cloud
+def evaluate_scan(plyfilename, scan_id):
+    data = downsample_points(read_ply_xyz(plyfilename), args.downsample, args.workers)
+    gt = read_ply_xyz(os.path.join(args.gtpath, 'Points/stl/stl{:0>3}_total.ply'.format(scan_id)))
+    evaluation_filter = DTUFilter.from_mat(os.path.join(args.gtpath, 'ObsMask/ObsMask{}_10.mat'.format(scan_id)),
+                                           os.path.join(args.gtpath, 'ObsMask/Plane{}.mat'.format(scan_id)), args.margin)
+    return dtu_scores(data, gt, evaluation_filter, args.max_dist, args.workers, args.chunk_points)
+
+
+if __name__ == '__main__':
+    with open(args.testlist) as f:
+        scans = [line.rstrip() for line in f.readlines() if line.strip()]
+
+    summary = {}
+    for plydir in args.plydir:
+        results = {}
+        for scan in scans:
+            scan_id = int(scan[4:])
+            plyfilename = os.path.join(plydir, args.ply_name.format(scan_id))
+            if not os.path.exists(plyfilename):
+                print("missing", plyfilename)
+                continue
+            time_s = time.time()
+            accuracy, completeness, overall = evaluate_scan(plyfilename, scan_id)
+            results[scan] = {'accuracy': accuracy, 'completeness': completeness, 'overall': overall}
+            print("{} {}: acc {:.4f} comp {:.4f} overall {:.4f} ({:.1f}s)".format(
+                plydir, scan, accuracy, completeness, overall, time.time() - time_s))
+
+        if results:
+            results['mean'] = {key: float(np.mean([result[key] for result in results.values()]))
+                               for key in ('accuracy', 'completeness', 'overall')}
+            summary[plydir] = results['mean']
+        with open(os.path.join(plydir, 'dtu_scores.json'), 'w') as f:
+            json.dump(results, f, indent=2)
+
+    print("| plydir | Acc. | Comp. | Overall. |")
+    for plydir, mean in summary.items():
+        print("| {} | {:.4f} | {:.4f} | {:.4f} |".format(plydir, mean['accuracy'], mean['completeness'], mean['overall']))
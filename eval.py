@@ -15,11 +15,18 @@ from models import *
 from utils import *
 import sys
 from datasets.data_io import read_pfm, save_pfm
+from depthfusion import check_geometric_consistency_batch, ScanCache, stack_cameras, PlyStreamWriter
+from depthfusion import DepthMapWriter, DEPTH_CONTAINER, view_key
+from depthfusion import camera_centers, partition_views, inference_order, last_chunk_uses, merge_partitions
+from depthfusion import schedule_views, expected_hit_rate, feature_accesses
+from depthfusion.store import DepthStore, FeatureCache, projection_matrix
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
 import cv2
-from plyfile import PlyData, PlyElement
 from PIL import Image
 import ast
 import gc
+import shutil
 
 
 cudnn.benchmark = True
@@ -44,6 +51,22 @@ parser.add_argument('--save_depth', help='True or False flag, input should be ei
     type=ast.literal_eval, default=False)
 parser.add_argument('--fusion', help='True or False flag, input should be either "True" or "False".',
     type=ast.literal_eval, default=False)
+parser.add_argument('--pipeline', help='infer the depth maps, keep those of a scan in memory and fuse it as soon as its '
+    'last view is inferred, instead of --save_depth then --fusion through PFM files; implies the inference step and '
+    'skips the --fusion pass. True or False.',
+    type=ast.literal_eval, default=False)
+parser.add_argument('--save_pfm', help='with --pipeline, also write the depth and confidence PFMs in the background. '
+    'True or False.', type=ast.literal_eval, default=True)
+parser.add_argument('--partition_mb', type=int, default=0, help='with --pipeline, infer and fuse each scan in spatial '
+    'chunks of views whose max_h x max_w depth and confidence maps fit in this many MB, 0 keeps whole scans')
+parser.add_argument('--partition_tolerance', type=float, default=0, help='drop points of a chunk closer than this to '
+    'a point of an earlier chunk when merging --partition_mb chunks, in scene units')
+parser.add_argument('--container', help='write the depth and confidence maps of each scan to one memory mapped '
+    '<scan>/depth_maps.dmap instead of PFM files, --fusion and fusion.py read it when present. True or False.',
+    type=ast.literal_eval, default=False)
+parser.add_argument('--container_depth', default='f4', choices=['f2', 'f4'], help='depth dtype of --container')
+parser.add_argument('--container_confidence', default='u2', choices=['u1', 'u2', 'f4'],
+    help='confidence dtype of --container, u1 and u2 quantize [0, 1] to 255 and 65535 steps')
 parser.add_argument('--syncbn', help='True or False flag, input should be either "True" or "False".',
     type=ast.literal_eval, default=False)
 parser.add_argument('--return_depth', help='True or False flag, input should be either "True" or "False".',
@@ -77,6 +100,14 @@ parser.add_argument('--outdir', default='./outputs', help='output dir')
 parser.add_argument('--display', action='store_true', help='display depth images and masks')
 
 parser.add_argument('--img_ext', type=str, help='The ext for the image to be saved and read')
+parser.add_argument('--depth_chunk_mb', type=int, default=0, help='DrMVSNet: compute the cost slices of as many depth '
+    'planes per batched pass as fit in this many MB ahead of the recurrence, 0 computes one plane at a time')
+parser.add_argument('--feature_batch', type=int, default=0, help='images per feature network call, the views of a '
+    'sample are folded into its batch; 0 runs all of them in one call')
+parser.add_argument('--feature_cache_mb', type=int, default=0, help='keep the feature maps of the images of a scan in '
+    'a device LRU cache of this many MB and featurize each image once instead of once per sample it is a view of, '
+    'the reference views are reordered for its locality; 0 disables')
+parser.add_argument('--cache_mb', type=int, default=4096, help='memory cap of the per-scan depth/camera cache in MB')
 
 # parse arguments and check
 args = parser.parse_args()
@@ -135,7 +166,157 @@ def read_pair_file(filename):
     return data
 
 
+# read the scores of a pair file, [[score1-1, ...], [score2-1, ...], ...] in the order of read_pair_file
+def read_score_file(filename):
+    data = []
+    with open(filename) as f:
+        num_viewpoint = int(f.readline())
+        for view_idx in range(num_viewpoint):
+            f.readline()
+            data.append([float(x) for x in f.readline().rstrip().split()[2::2]])
+    return data
+
+
+# depth map containers of the scans being written with --container, each is closed after its last view
+depth_containers = {}
+
+
+# save the depth map and confidence map of one reference view, as PFMs or into the container of its scan
+# (num_views reference views) with --container
+def save_depth_maps(filename, depth_est, photometric_confidence, num_views):
+    if args.container:
+        # filename: scan/{}/00000000{}
+        scan, view = filename.rsplit('/', 2)[0], int(filename.rsplit('/', 1)[1][:8])
+        if scan not in depth_containers:
+            os.makedirs(os.path.join(save_dir, scan), exist_ok=True)
+            depth_containers[scan] = DepthMapWriter(os.path.join(save_dir, scan, DEPTH_CONTAINER),
+                                                    args.container_depth, args.container_confidence)
+        depth_containers[scan].add(view_key(view), depth_est, photometric_confidence)
+        if len(depth_containers[scan]) >= num_views:
+            depth_containers.pop(scan).close()
+        return
+    depth_filename = os.path.join(save_dir, filename.format('depth_est', '.pfm'))
+    confidence_filename = os.path.join(save_dir, filename.format('confidence', '.pfm'))
+    os.makedirs(depth_filename.rsplit('/', 1)[0], exist_ok=True)
+    os.makedirs(confidence_filename.rsplit('/', 1)[0], exist_ok=True)
+    # save depth maps
+    save_pfm(depth_filename, depth_est)
+    # save confidence maps
+    save_pfm(confidence_filename, photometric_confidence)
+
+
+# spatial chunks of the views of every scan of metas [(scan, ref_view, src_views)] for --partition_mb, as fusion.py:
+# the depth and confidence maps of the views of a chunk fit in the budget at max_h x max_w float32
+def partition_scans(metas):
+    pair_data = {}
+    for scan, ref_view, src_views in metas:
+        pair_data.setdefault(scan, []).append((ref_view, src_views))
+    max_views = args.partition_mb * 1024 ** 2 // (2 * 4 * args.max_h * args.max_w)
+    partitions = {}
+    for scan, scan_pairs in pair_data.items():
+        extrinsics = [read_camera_parameters(os.path.join(args.testpath, scan, 'cams/{:0>8}_cam.txt'.format(ref_view)))[1]
+                      for ref_view, _ in scan_pairs]
+        centers = dict(zip([ref_view for ref_view, _ in scan_pairs], camera_centers(np.stack(extrinsics))))
+        partitions[scan] = partition_views(scan_pairs, centers, max_views)
+        print("partitioned {}: {} chunks of at most {} views".format(scan, len(partitions[scan]), max_views))
+    return partitions
+
+
+# --partition_mb: fuse the next chunks of a scan whose views are all inferred into <scan>/partitions and drop the
+# maps no later chunk reads. Once the last chunk is fused the chunks are merged into plyfilename
+# out: whether the scan is done
+def fuse_ready_chunks(scan, depth_store, chunks, part_files, plyfilename):
+    scan_folder, out_folder = os.path.join(args.testpath, scan), os.path.join(save_dir, scan)
+    part_folder = os.path.join(out_folder, 'partitions')
+    last_use = last_chunk_uses(chunks)
+    while len(part_files) < len(chunks) and depth_store.contains(chunks[len(part_files)][1]):
+        i = len(part_files)
+        os.makedirs(part_folder, exist_ok=True)
+        part_files.append(os.path.join(part_folder, 'part{:0>3}.ply'.format(i)))
+        filter_depth(scan_folder, out_folder, part_files[i], depth_store, chunks[i][0])
+        depth_store.release([view for view in chunks[i][1] if last_use[view] == i])
+    if len(part_files) < len(chunks):
+        return False
+    count = merge_partitions(part_files, plyfilename, args.partition_tolerance)
+    shutil.rmtree(part_folder)
+    print("merged {} chunks into {}, points: {}".format(len(chunks), plyfilename, count))
+    return True
+
+
+# reorder the reference views of every scan of metas [(scan, ref_view, src_views)] for the locality of the
+# --feature_cache_mb cache with schedule_views, as fusion.py --schedule does for its depth map cache. The samples read
+# their first nviews - 1 source views; the features are estimated at max_h x max_w as 32 float32 channels at
+# image_scale (DrMVSNet) or 1/4 (MVSNet) resolution.
+# out: [(scan, ref_view)] in inference order, scan by scan
+def schedule_features(metas, nviews):
+    pair_data = {}
+    for scan, ref_view, src_views in metas:
+        pair_data.setdefault(scan, []).append((ref_view, src_views[:nviews - 1]))
+    feature_scale = args.image_scale if args.model == 'drmvsnet' else 0.25
+    feature_bytes = 32 * 4 * int(args.max_h * feature_scale) * int(args.max_w * feature_scale)
+    max_bytes = args.feature_cache_mb * 1024 ** 2
+    order = []
+    for scan, scan_pairs in pair_data.items():
+        pair_file = os.path.join(args.testpath, scan, 'pair.txt')
+        score_of = {ref_view: scores
+                    for (ref_view, _), scores in zip(read_pair_file(pair_file), read_score_file(pair_file))}
+        scores = [score_of[ref_view][:nviews - 1] for ref_view, _ in scan_pairs]
+        scan_order = schedule_views(scan_pairs, scores, feature_bytes, max_bytes, feature_accesses, 'feature', True)
+        src_views = dict(scan_pairs)
+        print("scheduled {}: expected feature cache hit rate {:.3f}, {:.3f} in pair.txt order".format(
+            scan, expected_hit_rate([scan_order], src_views, feature_bytes, max_bytes, 1, feature_accesses, True),
+            expected_hit_rate([[ref_view for ref_view, _ in scan_pairs]], src_views, feature_bytes, max_bytes, 1,
+                              feature_accesses, True)))
+        order += [(scan, ref_view) for ref_view in scan_order]
+    return order
+
+
+# concatenate the features of one view of the samples of a batch, feature maps or lists of them per scale
+def batch_features(values):
+    if isinstance(values[0], (list, tuple)):
+        return [torch.cat(scale, 0) for scale in zip(*values)]
+    return torch.cat(values, 0)
+
+
+# features of the views of a batch from the --feature_cache_mb cache, keyed by (scan, view, resize scale, image
+# size) as the datasets scale and crop the images of a sample together. The images missing from the cache are
+# featurized in one extract_features pass and cached, once per batch when several samples read them.
+# imgs: [B, V, 3, H, W] on the device
+# out: per view the features of the batch as extract_features, for the features argument of the model; the number
+# of images featurized
+def cached_features(model, feature_cache, sample, imgs):
+    batch = imgs.shape[0]
+    resize_scales = sample['resize_scale'] if 'resize_scale' in sample else [1.0] * batch
+    keys = []
+    for filename, view_ids, resize_scale in zip(sample['filename'], sample['view_ids'], resize_scales):
+        # filename: scan/{}/00000000{}
+        scan = filename.rsplit('/', 2)[0]
+        keys.append([(scan, int(view), float(resize_scale), tuple(imgs.shape[3:])) for view in view_ids])
+
+    features, missing = {}, {}
+    for b, sample_keys in enumerate(keys):
+        for v, key in enumerate(sample_keys):
+            if key in features or key in missing:
+                continue
+            value = feature_cache.get(key)
+            if value is None:
+                missing[key] = imgs[b, v:v + 1]
+            else:
+                features[key] = value
+    if missing:
+        for key, value in zip(missing, model.module.extract_features(list(missing.values()))):
+            features[key] = value
+            feature_cache.add(key, value)
+    view_features = [batch_features([features[sample_keys[v]] for sample_keys in keys]) for v in range(imgs.shape[1])]
+    return view_features, len(missing)
+
+
 # run MVS model to save depth maps and confidence maps
+# with --pipeline the maps stay on the device in a per-scan DepthStore and each scan is fused (filter_depth) as soon
+# as its last reference view is inferred, the PFMs are optional and written by a background thread. With
+# --partition_mb the views are inferred chunk by chunk and each chunk is fused as soon as its views are inferred.
+# With --feature_cache_mb the samples are assembled from cached features, in the schedule_features order unless
+# --partition_mb orders them
 def save_depth():
     # dataset, dataloader
     
@@ -147,25 +328,39 @@ def save_depth():
         test_dataset = MVSDataset(args.testpath, args.testlist, "test", 7, args.numdepth, args.interval_scale, args.inverse_depth, 
                     adaptive_scaling=True, max_h=args.max_h, max_w=args.max_w, sample_scale=1, base_image_size=8, pyramid=args.pyramid, img_ext = arg.img_ext)
                     #args.pyramid)
+    partitions, part_files = None, {}
+    if args.pipeline and args.partition_mb > 0:
+        partitions = partition_scans(test_dataset.metas)
+        position = {(meta[0], meta[1]): i for i, meta in enumerate(test_dataset.metas)}
+        order = [position[(scan, view)] for scan, chunks in partitions.items() for view in inference_order(chunks)
+                 if (scan, view) in position]
+        test_dataset.metas = [test_dataset.metas[i] for i in order]
+    elif args.feature_cache_mb > 0:
+        position = {(meta[0], meta[1]): i for i, meta in enumerate(test_dataset.metas)}
+        test_dataset.metas = [test_dataset.metas[position[key]]
+                              for key in schedule_features(test_dataset.metas, test_dataset.nviews)]
     TestImgLoader = DataLoader(test_dataset, args.batch_size, shuffle=False, num_workers=0, drop_last=False)
 
     # model
     if args.model == 'mvsnet':
         print('use MVSNet')
         model = MVSNet(refine=args.refine, fea_net=args.fea_net, cost_net=args.cost_net,
-                refine_net=args.refine_net, origin_size=args.origin_size, cost_aggregation=args.cost_aggregation, dp_ratio=args.dp_ratio)
+                refine_net=args.refine_net, origin_size=args.origin_size, cost_aggregation=args.cost_aggregation, dp_ratio=args.dp_ratio,
+                feature_batch=args.feature_batch)
     elif args.model == 'drmvsnet':
         print('use Dense Multi-scale MVSNet')
         if 'transform' in args.dataset:
             model = DrMVSNet(refine=args.refine, fea_net=args.fea_net, cost_net=args.cost_net,
                 refine_net=args.refine_net, origin_size=args.origin_size, cost_aggregation=args.cost_aggregation,
                 dp_ratio=args.dp_ratio, image_scale=args.image_scale, 
-                max_h=args.max_h, max_w=args.max_w, reg_loss=args.reg_loss, return_depth=args.return_depth, gn=args.gn)
+                max_h=args.max_h, max_w=args.max_w, reg_loss=args.reg_loss, return_depth=args.return_depth, gn=args.gn,
+                depth_chunk_mb=args.depth_chunk_mb, feature_batch=args.feature_batch)
         else:
             model = DrMVSNet(refine=args.refine, fea_net=args.fea_net, cost_net=args.cost_net,
                 refine_net=args.refine_net, origin_size=args.origin_size, cost_aggregation=args.cost_aggregation,
                 dp_ratio=args.dp_ratio, image_scale=args.image_scale, 
-                max_h=args.max_h, max_w=args.max_w, reg_loss=args.reg_loss, return_depth=args.return_depth, gn=args.gn, pyramid=args.pyramid)
+                max_h=args.max_h, max_w=args.max_w, reg_loss=args.reg_loss, return_depth=args.return_depth, gn=args.gn, pyramid=args.pyramid,
+                depth_chunk_mb=args.depth_chunk_mb, feature_batch=args.feature_batch)
     else: 
         print('input pre-defined model')
 
@@ -182,6 +377,13 @@ def save_depth():
     #model.load_state_dict(pre_dict)
     model.eval()
     
+    # number of reference views of each scan, a scan is complete once all of them are inferred
+    scan_views = Counter(meta[0] for meta in test_dataset.metas)
+    stores = {}
+    pfm_writer = ThreadPoolExecutor(max_workers=1) if args.pipeline and args.save_pfm else None
+    feature_cache = FeatureCache(args.feature_cache_mb * 1024 ** 2) if args.feature_cache_mb > 0 else None
+    featurized, images = 0, 0
+
     count = -1
     total_time = 0
     with torch.no_grad():
@@ -191,7 +393,14 @@ def save_depth():
             sample_cuda = tocuda(sample)
             print('input shape: ', sample_cuda["imgs"].shape, sample_cuda["proj_matrices"].shape, sample_cuda["depth_values"].shape )
             time_s = time.time()
-            outputs = model(sample_cuda["imgs"], sample_cuda["proj_matrices"], sample_cuda["depth_values"])
+            features = None
+            # datasets that do not return the view_ids of their samples run without the cache
+            if feature_cache is not None and 'view_ids' in sample:
+                features, missing = cached_features(model, feature_cache, sample, sample_cuda["imgs"])
+                featurized += missing
+                images += sample_cuda["imgs"].shape[0] * sample_cuda["imgs"].shape[1]
+            outputs = model(sample_cuda["imgs"], sample_cuda["proj_matrices"], sample_cuda["depth_values"],
+                            features=features)
             #prob_volume = outputs['prob_volume']
             #depth_est, photometric_confidence = mvsnet_cls_winner_take_all(prob_volume, sample_cuda["depth_values"])
             one_time = time.time() - time_s
@@ -207,6 +416,29 @@ def save_depth():
                     tmp_outputs[key] = value[0]
                 outputs = tmp_outputs
 
+            if args.pipeline:
+                del sample_cuda
+                print('Iter {}/{}'.format(batch_idx, len(TestImgLoader)))
+                for filename, depth_est, photometric_confidence in zip(sample["filename"], outputs["depth"],
+                                                                       outputs["photometric_confidence"]):
+                    depth_est, photometric_confidence = depth_est.squeeze(), photometric_confidence.squeeze()
+                    # filename: scan/{}/00000000{}
+                    scan, view = filename.rsplit('/', 2)[0], int(filename.rsplit('/', 1)[1][:8])
+                    if pfm_writer is not None:
+                        pfm_writer.submit(save_depth_maps, filename, tensor2numpy(depth_est),
+                                          tensor2numpy(photometric_confidence), scan_views[scan])
+                    if scan not in stores:
+                        stores[scan] = DepthStore(scan_views[scan])
+                    stores[scan].add(view, depth_est, photometric_confidence)
+                    if partitions is not None:
+                        if fuse_ready_chunks(scan, stores[scan], partitions[scan], part_files.setdefault(scan, []),
+                                             os.path.join(save_dir, 'd2hc_rmvsnet_l3.ply')):
+                            stores.pop(scan)
+                    elif stores[scan].complete():
+                        filter_depth(os.path.join(args.testpath, scan), os.path.join(save_dir, scan),
+                                     os.path.join(save_dir, 'd2hc_rmvsnet_l3.ply'), stores.pop(scan))
+                continue
+
             outputs = tensor2numpy(outputs)
             del sample_cuda
             print('Iter {}/{}'.format(batch_idx, len(TestImgLoader)))
@@ -215,127 +447,76 @@ def save_depth():
             # save depth maps and confidence maps
             for filename, depth_est, photometric_confidence in zip(filenames, outputs["depth"],
                                                                    outputs["photometric_confidence"]):
-                depth_filename = os.path.join(save_dir, filename.format('depth_est', '.pfm'))
-                confidence_filename = os.path.join(save_dir, filename.format('confidence', '.pfm'))
-                os.makedirs(depth_filename.rsplit('/', 1)[0], exist_ok=True)
-                os.makedirs(confidence_filename.rsplit('/', 1)[0], exist_ok=True)
-                # save depth maps
                 print(depth_est.shape)
-                save_pfm(depth_filename, depth_est.squeeze())
-                # save confidence maps
-                save_pfm(confidence_filename, photometric_confidence.squeeze())
-
-
-# project the reference point cloud into the source view, then project back
-def reproject_with_depth(depth_ref, intrinsics_ref, extrinsics_ref, depth_src, intrinsics_src, extrinsics_src):
-    width, height = depth_ref.shape[1], depth_ref.shape[0]
-    ## step1. project reference pixels to the source view
-    # reference view x, y
-    x_ref, y_ref = np.meshgrid(np.arange(0, width), np.arange(0, height))
-    x_ref, y_ref = x_ref.reshape([-1]), y_ref.reshape([-1])
-    # reference 3D space
-    xyz_ref = np.matmul(np.linalg.inv(intrinsics_ref),
-                        np.vstack((x_ref, y_ref, np.ones_like(x_ref))) * depth_ref.reshape([-1]))
-    # source 3D space
-    xyz_src = np.matmul(np.matmul(extrinsics_src, np.linalg.inv(extrinsics_ref)),
-                        np.vstack((xyz_ref, np.ones_like(x_ref))))[:3]
-    # source view x, y
-    K_xyz_src = np.matmul(intrinsics_src, xyz_src)
-    xy_src = K_xyz_src[:2] / K_xyz_src[2:3]
-
-    ## step2. reproject the source view points with source view depth estimation
-    # find the depth estimation of the source view
-    x_src = xy_src[0].reshape([height, width]).astype(np.float32)
-    y_src = xy_src[1].reshape([height, width]).astype(np.float32)
-    sampled_depth_src = cv2.remap(depth_src, x_src, y_src, interpolation=cv2.INTER_LINEAR)
-    # mask = sampled_depth_src > 0
-
-    # source 3D space
-    # NOTE that we should use sampled source-view depth_here to project back
-    xyz_src = np.matmul(np.linalg.inv(intrinsics_src),
-                        np.vstack((xy_src, np.ones_like(x_ref))) * sampled_depth_src.reshape([-1]))
-    # reference 3D space
-    xyz_reprojected = np.matmul(np.matmul(extrinsics_ref, np.linalg.inv(extrinsics_src)),
-                                np.vstack((xyz_src, np.ones_like(x_ref))))[:3]
-    # source view x, y, depth
-    depth_reprojected = xyz_reprojected[2].reshape([height, width]).astype(np.float32)
-    K_xyz_reprojected = np.matmul(intrinsics_ref, xyz_reprojected)
-    xy_reprojected = K_xyz_reprojected[:2] / K_xyz_reprojected[2:3]
-    x_reprojected = xy_reprojected[0].reshape([height, width]).astype(np.float32)
-    y_reprojected = xy_reprojected[1].reshape([height, width]).astype(np.float32)
-
-    return depth_reprojected, x_reprojected, y_reprojected, x_src, y_src
-
-
-def check_geometric_consistency(depth_ref, intrinsics_ref, extrinsics_ref, depth_src, intrinsics_src, extrinsics_src):
-    width, height = depth_ref.shape[1], depth_ref.shape[0]
-    x_ref, y_ref = np.meshgrid(np.arange(0, width), np.arange(0, height))
-    depth_reprojected, x2d_reprojected, y2d_reprojected, x2d_src, y2d_src = reproject_with_depth(depth_ref, intrinsics_ref, extrinsics_ref,
-                                                     depth_src, intrinsics_src, extrinsics_src)
-    # check |p_reproj-p_1| < 1
-    dist = np.sqrt((x2d_reprojected - x_ref) ** 2 + (y2d_reprojected - y_ref) ** 2)
-
-    # check |d_reproj-d_1| / d_1 < 0.01
-    depth_diff = np.abs(depth_reprojected - depth_ref)
-    relative_depth_diff = depth_diff / depth_ref
-
-    mask = np.logical_and(dist < 1, relative_depth_diff < 0.01)
-    depth_reprojected[~mask] = 0
-
-    return mask, depth_reprojected, x2d_src, y2d_src
-
-
-def filter_depth(scan_folder, out_folder, plyfilename):
+                save_depth_maps(filename, depth_est.squeeze(), photometric_confidence.squeeze(),
+                                scan_views[filename.rsplit('/', 2)[0]])
+
+    if feature_cache is not None:
+        print("featurized {} of {} images, feature cache hit rate {:.3f}, {} MB".format(
+            featurized, images, feature_cache.hit_rate(), feature_cache.nbytes // 1024 ** 2))
+        feature_cache.clear()
+    if pfm_writer is not None:
+        pfm_writer.shutdown(wait=True)
+    for container in depth_containers.values():
+        container.close()
+
+
+# estimated depth ('depth_est') or confidence ('confidence') map of a view, from the container of the scan
+# when --container wrote one, else from its PFM
+def read_map(cache, out_folder, kind, view):
+    container = os.path.join(out_folder, DEPTH_CONTAINER)
+    if os.path.exists(container):
+        return cache.container_map(container, kind, view_key(view))
+    return cache.pfm(os.path.join(out_folder, '{}/{:0>8}.pfm'.format(kind, view)))
+
+
+# fuse one scan (or its reference views ref_views only) from its PFM files or depth map container, or from the
+# in-memory depth_store of --pipeline
+def filter_depth(scan_folder, out_folder, plyfilename, depth_store=None, ref_views=None):
     # the pair file
     pair_file = os.path.join(scan_folder, "pair.txt")
-    # for the final point cloud
-    vertexs = []
-    vertex_colors = []
+    # for the final point cloud, streamed to disk view by view
+    writer = PlyStreamWriter(plyfilename)
 
     pair_data = read_pair_file(pair_file)
+    if ref_views is not None:
+        ref_views = set(ref_views)
+        pair_data = [(ref_view, src_views) for ref_view, src_views in pair_data if ref_view in ref_views]
     nviews = len(pair_data)
+    cache = ScanCache(args.cache_mb * 1024 ** 2)
     # TODO: hardcode size
     # used_mask = [np.zeros([296, 400], dtype=np.bool) for _ in range(nviews)]
 
     # for each reference view and the corresponding source views
     for ref_view, src_views in pair_data:
         # load the camera parameters
-        ref_intrinsics, ref_extrinsics = read_camera_parameters(
-            os.path.join(scan_folder, 'cams/{:0>8}_cam.txt'.format(ref_view)))
+        ref_intrinsics, ref_extrinsics, ref_intrinsics_inv, ref_extrinsics_inv = cache.camera(
+            os.path.join(scan_folder, 'cams/{:0>8}_cam.txt'.format(ref_view)), read_camera_parameters)
         # load the reference image
         ref_img = read_img(os.path.join(scan_folder, 'images/{:0>8}.{}'.format(ref_view, args.img_ext)))
-        # load the estimated depth of the reference view
-        ref_depth_est = read_pfm(os.path.join(out_folder, 'depth_est/{:0>8}.pfm'.format(ref_view)))[0]
-        # load the photometric mask of the reference view
-        confidence = read_pfm(os.path.join(out_folder, 'confidence/{:0>8}.pfm'.format(ref_view)))[0]
-        photo_mask = confidence > 0.8
-
-        all_srcview_depth_ests = []
-        all_srcview_x = []
-        all_srcview_y = []
-        all_srcview_geomask = []
-
-        # compute the geometric mask
-        geo_mask_sum = 0
-        for src_view in src_views:
-            # camera parameters of the source view
-            src_intrinsics, src_extrinsics = read_camera_parameters(
-                os.path.join(scan_folder, 'cams/{:0>8}_cam.txt'.format(src_view)))
-            # the estimated depth of the source view
-            src_depth_est = read_pfm(os.path.join(out_folder, 'depth_est/{:0>8}.pfm'.format(src_view)))[0]
-
-            geo_mask, depth_reprojected, x2d_src, y2d_src = check_geometric_consistency(ref_depth_est, ref_intrinsics, ref_extrinsics,
-                                                                      src_depth_est,
-                                                                      src_intrinsics, src_extrinsics)
-            geo_mask_sum += geo_mask.astype(np.int32)
-            all_srcview_depth_ests.append(depth_reprojected)
-            all_srcview_x.append(x2d_src)
-            all_srcview_y.append(y2d_src)
-            all_srcview_geomask.append(geo_mask)
-
-        depth_est_averaged = (sum(all_srcview_depth_ests) + ref_depth_est) / (geo_mask_sum + 1)
-        # at least 3 source views matched
-        geo_mask = geo_mask_sum >= 3
+        # camera parameters of the source views, decoded once per scan
+        src_cameras = [cache.camera(os.path.join(scan_folder, 'cams/{:0>8}_cam.txt'.format(src_view)),
+                                    read_camera_parameters) for src_view in src_views]
+        src_intrinsics, src_extrinsics, src_intrinsics_inv, src_extrinsics_inv = stack_cameras(src_cameras)
+
+        # compute the geometric mask, check |p_reproj-p_1| < 1 and |d_reproj-d_1| / d_1 < 0.01
+        # for at least 3 source views
+        if depth_store is not None:
+            src_projs = np.stack([projection_matrix(camera[0], camera[1]) for camera in src_cameras])
+            ref_depth_est, confidence, geo_mask, geo_mask_sum, depth_est_averaged = depth_store.check_geometric_consistency(
+                ref_view, src_views, projection_matrix(ref_intrinsics, ref_extrinsics), src_projs, levels=[(3, 1, 0.01)])
+            photo_mask = confidence > 0.8
+        else:
+            # load the estimated depth and the photometric mask of the reference view
+            ref_depth_est = read_map(cache, out_folder, 'depth_est', ref_view)
+            confidence = read_map(cache, out_folder, 'confidence', ref_view)
+            photo_mask = confidence > 0.8
+            src_depth_ests = np.stack([read_map(cache, out_folder, 'depth_est', src_view) for src_view in src_views])
+            # only for the photometrically valid pixels
+            geo_mask, geo_mask_sum, depth_est_averaged = check_geometric_consistency_batch(
+                ref_depth_est, ref_intrinsics, ref_extrinsics, src_depth_ests, src_intrinsics, src_extrinsics,
+                levels=[(3, 1, 0.01)], inverses=(ref_intrinsics_inv, ref_extrinsics_inv, src_intrinsics_inv, src_extrinsics_inv),
+                pixels=np.flatnonzero(photo_mask))
         final_mask = np.logical_and(photo_mask, geo_mask)
 
         os.makedirs(os.path.join(out_folder, "mask"), exist_ok=True)
@@ -363,12 +544,11 @@ def filter_depth(scan_folder, out_folder, plyfilename):
         print("valid_points", valid_points.mean())
         x, y, depth = x[valid_points], y[valid_points], depth_est_averaged[valid_points]
         color = ref_img[1:-16:4, 1::4, :][valid_points]  # hardcoded for DTU dataset
-        xyz_ref = np.matmul(np.linalg.inv(ref_intrinsics),
+        xyz_ref = np.matmul(ref_intrinsics_inv,
                             np.vstack((x, y, np.ones_like(x))) * depth)
-        xyz_world = np.matmul(np.linalg.inv(ref_extrinsics),
+        xyz_world = np.matmul(ref_extrinsics_inv,
                               np.vstack((xyz_ref, np.ones_like(x))))[:3]
-        vertexs.append(xyz_world.transpose((1, 0)))
-        vertex_colors.append((color * 255).astype(np.uint8))
+        writer.write(xyz_world.transpose((1, 0)), (color * 255).astype(np.uint8))
 
         # # set used_mask[ref_view]
         # used_mask[ref_view][...] = True
@@ -378,29 +558,20 @@ def filter_depth(scan_folder, out_folder, plyfilename):
         #     src_x = all_srcview_x[idx].astype(np.int)
         #     used_mask[src_view][src_y[src_mask], src_x[src_mask]] = True
 
-    vertexs = np.concatenate(vertexs, axis=0)
-    vertex_colors = np.concatenate(vertex_colors, axis=0)
-    vertexs = np.array([tuple(v) for v in vertexs], dtype=[('x', 'f4'), ('y', 'f4'), ('z', 'f4')])
-    vertex_colors = np.array([tuple(v) for v in vertex_colors], dtype=[('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
-
-    vertex_all = np.empty(len(vertexs), vertexs.dtype.descr + vertex_colors.dtype.descr)
-    for prop in vertexs.dtype.names:
-        vertex_all[prop] = vertexs[prop]
-    for prop in vertex_colors.dtype.names:
-        vertex_all[prop] = vertex_colors[prop]
-
-    el = PlyElement.describe(vertex_all, 'vertex')
-    PlyData([el]).write(plyfilename)
+    print("cache hit rate {:.3f}, {} MB".format(cache.hit_rate(), cache.nbytes // 1024 ** 2))
+    writer.close()
     print("saving the final model to", plyfilename)
 
 
 if __name__ == '__main__':
-    # step1. save all the depth maps and the masks in outputs directory
-    if args.save_depth:
+    # step1. save all the depth maps and the masks in outputs directory, --pipeline fuses them on the way
+    if args.save_depth or args.pipeline:
         print('save depth *******************\n')
         save_depth()
     
-    if args.fusion:
+    if args.fusion and args.pipeline:
+        print('--pipeline already fused the scans, skipping --fusion')
+    elif args.fusion:
         print('fusion ************************\n')
         with open(args.testlist) as f:
             scans = f.readlines()
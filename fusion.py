@@ -10,13 +10,21 @@ from torch.autograd import Variable
 import torch.nn.functional as F
 import numpy as np
 import time
+import multiprocessing
+import itertools
+import shutil
 from datasets import find_dataset_def
 from models import *
 from utils import *
 import sys
 from datasets.data_io import read_pfm, save_pfm
+from depthfusion import check_geometric_consistency_batch, ScanCache, stack_cameras, PlyStreamWriter, ChunkedPlyWriter
+from depthfusion import VoxelGrid, SpilledVoxelGrid, UsedMask, source_pixels, FusionManifest, view_entry, file_signature
+from depthfusion import schedule_views, split_segments, expected_hit_rate
+from depthfusion import reprojection_errors, write_sweep_view, write_sweep_index, read_sweep_index, fuse_sweep
+from depthfusion import write_octree_lod, ply_files, DepthMapContainer, DEPTH_CONTAINER, view_key
+from depthfusion import remove_outliers, ply_vertex_memmap, camera_centers, partition_views, merge_partitions
 import cv2
-from plyfile import PlyData, PlyElement
 from PIL import Image
 
 cudnn.benchmark = True
@@ -37,9 +45,48 @@ parser.add_argument('--outdir', default='/data1/wzz/outputs_tnt_1101', help='out
 parser.add_argument('--display', action='store_true', help='display depth images and masks')
 
 parser.add_argument('--test_dataset', default='tanks', help='which dataset to evaluate')
+parser.add_argument('--cache_mb', type=int, default=4096, help='memory cap of the per-scan depth/camera cache in MB')
+parser.add_argument('--workers', type=int, default=1, help='number of fusion processes, 1 fuses serially')
+parser.add_argument('--used_mask', action='store_true', help='skip pixels already fused from an earlier reference view')
+parser.add_argument('--voxel_size', type=float, default=0, help='merge fused points per voxel of this size, 0 disables')
+parser.add_argument('--out_of_core', action='store_true', help='spill the points of --voxel_size merging to disk '
+                    'and merge them slab by slab, bounding memory for very large scenes; only applies to --voxel_size '
+                    'merging, the other outputs are already streamed to disk')
+parser.add_argument('--spill_mb', type=int, default=512, help='points buffered in memory before spilling with --out_of_core, in MB')
+parser.add_argument('--chunk_points', type=int, default=0, help='write the point cloud as a folder of PLY chunks of at '
+                    'most this many points with an index.json instead of a single PLY, 0 disables')
+parser.add_argument('--outliers', default='', choices=['', 'radius', 'statistical'], help='remove outliers from the '
+                    'fused point cloud: points with fewer than --outlier_neighbors others within --outlier_radius, or '
+                    'points whose mean distance to their --outlier_neighbors nearest is --outlier_std deviations above average')
+parser.add_argument('--outlier_radius', type=float, default=0, help='neighbour search radius of --outliers, in scene units')
+parser.add_argument('--outlier_neighbors', type=int, default=16, help='neighbour count of --outliers')
+parser.add_argument('--outlier_std', type=float, default=2.0, help='standard deviation ratio of --outliers statistical')
+parser.add_argument('--lod_points', type=int, default=0, help='also export the point cloud as a level of detail octree '
+                    'in <name>_lod with at most this many points per leaf node, 0 disables')
+parser.add_argument('--lod_depth', type=int, default=10, help='maximum depth of the --lod_points octree')
+parser.add_argument('--schedule', action='store_true', help='order the reference views by their shared source views '
+                    'for cache locality instead of pair.txt order, points are written in that order')
+parser.add_argument('--incremental', action='store_true', help='keep the fused chunk of every reference view and only '
+                    'recompute the views whose depth, confidence, image or camera inputs changed since the last run')
+parser.add_argument('--partition_mb', type=int, default=0, help='fuse each scan in spatial chunks of views whose depth '
+                    'and confidence maps fit in this many MB, then merge the chunks, 0 fuses whole scans')
+parser.add_argument('--partition_tolerance', type=float, default=0, help='drop points of a chunk closer than this to a '
+                    'point of an earlier chunk when merging --partition_mb chunks, in scene units')
+parser.add_argument('--sweep_photo', default='', help='comma separated photo thresholds, fuse every combination with '
+                    '--sweep_pixel and --sweep_depth from a reprojection cache instead of the default fusion')
+parser.add_argument('--sweep_pixel', default='4', help='comma separated pixel threshold denominators, level i uses i/x pixel')
+parser.add_argument('--sweep_depth', default='1300', help='comma separated relative depth threshold denominators, level i uses i/x')
 
 # parse arguments and check
 args = parser.parse_args()
+if args.display and args.workers > 1:
+    parser.error('--display needs --workers 1')
+if args.out_of_core and args.voxel_size <= 0:
+    parser.error('--out_of_core needs --voxel_size')
+if args.outliers and args.outlier_radius <= 0:
+    parser.error('--outliers needs --outlier_radius')
+if args.partition_mb > 0 and (args.incremental or args.sweep_photo):
+    parser.error('--partition_mb does not support --incremental or --sweep_photo')
 print("argv:", sys.argv[1:])
 print_args(args)
 
@@ -148,257 +195,464 @@ def save_depth():
                 save_pfm(confidence_filename, photometric_confidence)
 
 
-# project the reference point cloud into the source view, then project back
-def reproject_with_depth(depth_ref, intrinsics_ref, extrinsics_ref, depth_src, intrinsics_src, extrinsics_src):
-    width, height = depth_ref.shape[1], depth_ref.shape[0]
-    ## step1. project reference pixels to the source view
-    # reference view x, y
-    x_ref, y_ref = np.meshgrid(np.arange(0, width), np.arange(0, height))
-    x_ref, y_ref = x_ref.reshape([-1]), y_ref.reshape([-1])
-    # reference 3D space
-    xyz_ref = np.matmul(np.linalg.inv(intrinsics_ref),
-                        np.vstack((x_ref, y_ref, np.ones_like(x_ref))) * depth_ref.reshape([-1]))
-    # source 3D space
-    xyz_src = np.matmul(np.matmul(extrinsics_src, np.linalg.inv(extrinsics_ref)),
-                        np.vstack((xyz_ref, np.ones_like(x_ref))))[:3]
-    # source view x, y
-    K_xyz_src = np.matmul(intrinsics_src, xyz_src)
-    xy_src = K_xyz_src[:2] / K_xyz_src[2:3]
-
-    ## step2. reproject the source view points with source view depth estimation
-    # find the depth estimation of the source view
-    x_src = xy_src[0].reshape([height, width]).astype(np.float32)
-    y_src = xy_src[1].reshape([height, width]).astype(np.float32)
-    sampled_depth_src = cv2.remap(depth_src, x_src, y_src, interpolation=cv2.INTER_LINEAR)
-    # mask = sampled_depth_src > 0
-
-    # source 3D space
-    # NOTE that we should use sampled source-view depth_here to project back
-    xyz_src = np.matmul(np.linalg.inv(intrinsics_src),
-                        np.vstack((xy_src, np.ones_like(x_ref))) * sampled_depth_src.reshape([-1]))
-    # reference 3D space
-    xyz_reprojected = np.matmul(np.matmul(extrinsics_ref, np.linalg.inv(extrinsics_src)),
-                                np.vstack((xyz_src, np.ones_like(x_ref))))[:3]
-    # source view x, y, depth
-    depth_reprojected = xyz_reprojected[2].reshape([height, width]).astype(np.float32)
-    K_xyz_reprojected = np.matmul(intrinsics_ref, xyz_reprojected)
-    xy_reprojected = K_xyz_reprojected[:2] / K_xyz_reprojected[2:3]
-    x_reprojected = xy_reprojected[0].reshape([height, width]).astype(np.float32)
-    y_reprojected = xy_reprojected[1].reshape([height, width]).astype(np.float32)
-
-    return depth_reprojected, x_reprojected, y_reprojected, x_src, y_src
-
-
-def check_geometric_consistency(depth_ref, intrinsics_ref, extrinsics_ref, depth_src, intrinsics_src, extrinsics_src
-                                ):
-    width, height = depth_ref.shape[1], depth_ref.shape[0]
-    x_ref, y_ref = np.meshgrid(np.arange(0, width), np.arange(0, height))
-    depth_reprojected, x2d_reprojected, y2d_reprojected, x2d_src, y2d_src = reproject_with_depth(depth_ref,
-                                                                                                 intrinsics_ref,
-                                                                                                 extrinsics_ref,
-                                                                                                 depth_src,
-                                                                                                 intrinsics_src,
-                                                                                                 extrinsics_src)
-    # check |p_reproj-p_1| < 1
-    dist = np.sqrt((x2d_reprojected - x_ref) ** 2 + (y2d_reprojected - y_ref) ** 2)
-
-    # check |d_reproj-d_1| / d_1 < 0.01
-    depth_diff = np.abs(depth_reprojected - depth_ref)
-    relative_depth_diff = depth_diff / depth_ref
-    masks=[]
-    for i in range(2,11):
-        mask = np.logical_and(dist < i/4, relative_depth_diff < i/1300)
-        masks.append(mask)
-    depth_reprojected[~mask] = 0
-
-    return masks, mask, depth_reprojected, x2d_src, y2d_src
+# file of the estimated depth ('depth_est') or confidence ('confidence') map of a view: the depth map container of
+# the scan when eval.py wrote one (--container), else its PFM
+def map_filename(out_folder, kind, view):
+    container = os.path.join(out_folder, DEPTH_CONTAINER)
+    if os.path.exists(container):
+        return container
+    return os.path.join(out_folder, '{}_0/{:0>8}.pfm'.format(kind, view))
 
 
-def filter_depth(scan_folder, out_folder, plyfilename, photo_threshold):
-    # the pair file
-    pair_file = os.path.join(scan_folder, "pair.txt")
-    # for the final point cloud
-    vertexs = []
-    vertex_colors = []
-
-    pair_data = read_pair_file(pair_file)
-    score_data = read_score_file(pair_file)
-
-    nviews = len(pair_data)
-    # TODO: hardcode size
-    # used_mask = [np.zeros([296, 400], dtype=np.bool) for _ in range(nviews)]
-
-    # for each reference view and the corresponding source views
-    ct2 = -1
-
-    for ref_view, src_views in pair_data:
-
-        ct2 += 1
-
-
-        # load the reference image
-        ref_img = read_img(os.path.join(scan_folder, 'images/{:0>8}.jpg'.format(ref_view)))
-        # load the estimated depth of the reference view
-        ref_depth_est = read_pfm(os.path.join(out_folder, 'depth_est_0/{:0>8}.pfm'.format(ref_view)))[0]
-
-        import cv2
-
-        # ref_img=cv2.pyrUp(ref_img)
-
-        #ref_depth_est=cv2.pyrUp(ref_depth_est)
-        # ref_depth_est=cv2.pyrUp(ref_depth_est)
-
-        # load the photometric mask of the reference view
-        confidence = read_pfm(os.path.join(out_folder, 'confidence_0/{:0>8}.pfm'.format(ref_view)))[0]
-
-        scale=float(confidence.shape[0])/ref_img.shape[0]
-        index=int((int(ref_img.shape[1]*scale)-confidence.shape[1])/2)
-        flag=0
-        if (confidence.shape[1]/ref_img.shape[1]>scale):
-            scale=float(confidence.shape[1])/ref_img.shape[1]
-            index=int((int(ref_img.shape[0]*scale)-confidence.shape[0])/2)
-            flag=1
-
-        #confidence=cv2.pyrUp(confidence)
-        ref_img=cv2.resize(ref_img,(int(ref_img.shape[1]*scale),int(ref_img.shape[0]*scale)))
-        if (flag==0):
-            ref_img=ref_img[:,index:ref_img.shape[1]-index,:]
-        else:
-            ref_img=ref_img[index:ref_img.shape[0]-index,:,:]
-
-        # load the camera parameters
-        ref_intrinsics, ref_extrinsics = read_camera_parameters(
-            os.path.join(scan_folder, 'cams/{:0>8}_cam.txt'.format(ref_view)),scale,index,flag)
-
-        photo_mask = confidence > photo_threshold
-
-        # photo_mask = confidence>=0
-
-        # photo_mask = confidence > confidence.mean()
-
-        # ref_depth_est=ref_depth_est * photo_mask
+def read_map(cache, out_folder, kind, view):
+    filename = map_filename(out_folder, kind, view)
+    if filename.endswith(DEPTH_CONTAINER):
+        return cache.container_map(filename, kind, view_key(view))
+    return cache.pfm(filename)
 
 
-        all_srcview_depth_ests = []
-        all_srcview_x = []
-        all_srcview_y = []
-        all_srcview_geomask = []
-        # compute the geometric mask
-        geo_mask_sum = 0
-        geo_mask_sums=[]
-        n=1
-        for src_view in src_views:
-          n+=1
-        ct = 0
-        for src_view in src_views:
-                ct = ct + 1
-                # camera parameters of the source view
-                src_intrinsics, src_extrinsics = read_camera_parameters(
-                    os.path.join(scan_folder, 'cams/{:0>8}_cam.txt'.format(src_view)),scale,index,flag)
-                # the estimated depth of the source view
-                src_depth_est = read_pfm(os.path.join(out_folder, 'depth_est_0/{:0>8}.pfm'.format(src_view)))[0]
+# load the reference image cropped to the depth map, the estimated depth and confidence of the reference view,
+# and the cameras and estimated depths of its source views
+def load_view(cache, scan_folder, out_folder, ref_view, src_views):
+    # load the reference image
+    ref_img = read_img(os.path.join(scan_folder, 'images/{:0>8}.jpg'.format(ref_view)))
+    # load the estimated depth of the reference view
+    ref_depth_est = read_map(cache, out_folder, 'depth_est', ref_view)
 
-                #src_depth_est=cv2.pyrUp(src_depth_est)
-                # src_depth_est=cv2.pyrUp(src_depth_est)
+    # ref_img=cv2.pyrUp(ref_img)
 
-                src_confidence = read_pfm(os.path.join(out_folder, 'confidence_0/{:0>8}.pfm'.format(src_view)))[0]
+    #ref_depth_est=cv2.pyrUp(ref_depth_est)
+    # ref_depth_est=cv2.pyrUp(ref_depth_est)
 
-                # src_mask=src_confidence>0.1
-                # src_mask=src_confidence>src_confidence.mean()
+    # load the photometric mask of the reference view
+    confidence = read_map(cache, out_folder, 'confidence', ref_view)
 
-                # src_depth_est=src_depth_est*src_mask
+    scale=float(confidence.shape[0])/ref_img.shape[0]
+    index=int((int(ref_img.shape[1]*scale)-confidence.shape[1])/2)
+    flag=0
+    if (confidence.shape[1]/ref_img.shape[1]>scale):
+        scale=float(confidence.shape[1])/ref_img.shape[1]
+        index=int((int(ref_img.shape[0]*scale)-confidence.shape[0])/2)
+        flag=1
 
+    #confidence=cv2.pyrUp(confidence)
+    ref_img=cv2.resize(ref_img,(int(ref_img.shape[1]*scale),int(ref_img.shape[0]*scale)))
+    if (flag==0):
+        ref_img=ref_img[:,index:ref_img.shape[1]-index,:]
+    else:
+        ref_img=ref_img[index:ref_img.shape[0]-index,:,:]
+
+    # load the camera parameters
+    ref_camera = cache.camera(
+        os.path.join(scan_folder, 'cams/{:0>8}_cam.txt'.format(ref_view)), read_camera_parameters, scale, index, flag)
 
-
-                masks, geo_mask, depth_reprojected, x2d_src, y2d_src = check_geometric_consistency(ref_depth_est, ref_intrinsics,
-                                                                                            ref_extrinsics,
-                                                                                            src_depth_est,
-                                                                                            src_intrinsics, src_extrinsics)
-
-                if (ct==1):
-                    for i in range(2,n):
-                        geo_mask_sums.append(masks[i-2].astype(np.int32))
-                else :
-                    for i in range(2,n):
-                        geo_mask_sums[i-2]+=masks[i-2].astype(np.int32)
-
-                geo_mask_sum+=geo_mask.astype(np.int32)
-
-                all_srcview_depth_ests.append(depth_reprojected)
-
-                # all_srcview_x.append(x2d_src)
-                # all_srcview_y.append(y2d_src)
-                # all_srcview_geomask.append(geo_mask)
-
-        geo_mask=geo_mask_sum>=n
-
-        for i in range (2,n):
-            geo_mask=np.logical_or(geo_mask,geo_mask_sums[i-2]>=i)
-            print(geo_mask.mean())
-
-        depth_est_averaged = (sum(all_srcview_depth_ests) + ref_depth_est) / (geo_mask_sum + 1)
+    # camera parameters and estimated depths of the source views, decoded once per scan
+    src_cameras = [cache.camera(os.path.join(scan_folder, 'cams/{:0>8}_cam.txt'.format(src_view)),
+                                read_camera_parameters, scale, index, flag) for src_view in src_views]
+    src_depth_ests = np.stack([read_map(cache, out_folder, 'depth_est', src_view) for src_view in src_views])
+
+    return ref_img, ref_depth_est, confidence, ref_camera, stack_cameras(src_cameras), src_depth_ests
+
+
+# filter one reference view with photometric confidence and dynamic geometric consistency
+# out: (xyz_world [N, 3], colors [N, 3] uint8) of the fused points, or None
+def filter_view(cache, scan_folder, out_folder, ref_view, src_views, photo_threshold):
+    ref_img, ref_depth_est, confidence, ref_camera, src_cameras, src_depth_ests = load_view(
+        cache, scan_folder, out_folder, ref_view, src_views)
+    ref_intrinsics, ref_extrinsics, ref_intrinsics_inv, ref_extrinsics_inv = ref_camera
+    src_intrinsics, src_extrinsics, src_intrinsics_inv, src_extrinsics_inv = src_cameras
+
+    photo_mask = confidence > photo_threshold
+
+    # photo_mask = confidence>=0
+
+    # photo_mask = confidence > confidence.mean()
+
+    # ref_depth_est=ref_depth_est * photo_mask
+
+    # compute the geometric mask against all source views at once, only for the photometrically valid pixels
+    photo_pixels = np.flatnonzero(photo_mask)
+    geo_mask, geo_mask_sum, depth_est_averaged, src_geo_masks, x2d_src, y2d_src = check_geometric_consistency_batch(
+        ref_depth_est, ref_intrinsics, ref_extrinsics, src_depth_ests, src_intrinsics, src_extrinsics,
+        inverses=(ref_intrinsics_inv, ref_extrinsics_inv, src_intrinsics_inv, src_extrinsics_inv), return_src=True,
+        pixels=photo_pixels)
+
+    final_mask = np.logical_and(photo_mask, geo_mask)
+
+    os.makedirs(os.path.join(out_folder, "mask"), exist_ok=True)
+
+    save_mask(os.path.join(out_folder, "mask/{:0>8}_photo.png".format(ref_view)), photo_mask)
+    save_mask(os.path.join(out_folder, "mask/{:0>8}_geo.png".format(ref_view)), geo_mask)
+    save_mask(os.path.join(out_folder, "mask/{:0>8}_final.png".format(ref_view)), final_mask)
+
+    print("processing {}, ref-view{:0>2}, photo/geo/final-mask:{}/{}/{}".format(scan_folder, ref_view,
+                                                                                photo_mask.mean(),
+                                                                                geo_mask.mean(),
+                                                                                final_mask.mean()))
+
+    if args.display:
+        cv2.imshow('ref_img', ref_img[:, :, ::-1])
+        cv2.imshow('ref_depth', ref_depth_est / 800)
+        cv2.imshow('ref_depth * photo_mask', ref_depth_est * photo_mask.astype(np.float32) / 800)
+        cv2.imshow('ref_depth * geo_mask', ref_depth_est * geo_mask.astype(np.float32) / 800)
+        cv2.imshow('ref_depth * mask', ref_depth_est * final_mask.astype(np.float32) / 800)
+        cv2.waitKey(0)
+
+    height, width = depth_est_averaged.shape[:2]
+    x, y = np.meshgrid(np.arange(0, width), np.arange(0, height))
+    # pixels already used by earlier reference views are dropped in save_point_cloud, in pair.txt order
+    valid_points = final_mask
+    print("valid_points", valid_points.mean())
+    x, y, depth = x[valid_points], y[valid_points], depth_est_averaged[valid_points]
+    color = ref_img[:, :, :][valid_points]  # hardcoded for DTU dataset
+    xyz_ref = np.matmul(ref_intrinsics_inv,
+                        np.vstack((x, y, np.ones_like(x))) * depth)
+    xyz_world = np.matmul(ref_extrinsics_inv,
+                          np.vstack((xyz_ref, np.ones_like(x))))[:3]
+
+    visibility = None
+    if args.used_mask:
+        # columns of the photometrically valid pixels that are also geometrically consistent
+        columns = np.flatnonzero(geo_mask.reshape([-1])[photo_pixels])
+        ref_pixels = photo_pixels[columns]
+        visibility = (ref_view, ref_pixels, src_views,
+                      source_pixels(src_geo_masks, x2d_src, y2d_src, columns, height, width), height * width)
+
+    return xyz_world.transpose((1, 0)), (color * 255).astype(np.uint8), visibility
+
+
+# (scan_folder, out_folder, ref_view, src_views, photo_threshold) for each reference view, in pair.txt order
+def view_tasks(scan_folder, out_folder, photo_threshold):
+    pair_data = read_pair_file(os.path.join(scan_folder, "pair.txt"))
+    return [(scan_folder, out_folder, ref_view, src_views, photo_threshold) for ref_view, src_views in pair_data]
+
+
+# files read by filter_view for one reference view
+def view_input_files(scan_folder, out_folder, ref_view, src_views):
+    input_files = [os.path.join(scan_folder, 'images/{:0>8}.jpg'.format(ref_view)),
+                   map_filename(out_folder, 'confidence', ref_view)]
+    for view in [ref_view] + src_views:
+        input_files.append(map_filename(out_folder, 'depth_est', view))
+        input_files.append(os.path.join(scan_folder, 'cams/{:0>8}_cam.txt'.format(view)))
+    return input_files
+
+
+# bytes of the estimated depth map of a view, the size of each map of the scan
+def map_nbytes(out_folder, view):
+    map_file = map_filename(out_folder, 'depth_est', view)
+    if map_file.endswith(DEPTH_CONTAINER):
+        return DepthMapContainer(map_file).map_nbytes(view_key(view))
+    return os.path.getsize(map_file)
+
+
+# reorder the reference views of a scan for the locality of the depth map cache (--schedule), each worker cache
+# gets its share of --cache_mb. Prints the expected hit rate against the one of pair.txt order.
+def schedule_tasks(scan_folder, out_folder, tasks):
+    pair_data = [(task[2], task[3]) for task in tasks]
+    scores = read_score_file(os.path.join(scan_folder, "pair.txt"))
+    map_bytes = map_nbytes(out_folder, pair_data[0][0])
+    max_bytes = args.cache_mb * 1024 ** 2 // args.workers
+    order = schedule_views(pair_data, scores, map_bytes, max_bytes)
+
+    src_views = dict(pair_data)
+    pair_order = [[ref_view] for ref_view, _ in pair_data] if args.workers > 1 else [[ref_view for ref_view, _ in pair_data]]
+    segments = split_segments(order, args.workers) if args.workers > 1 else [order]
+    print("scheduled {}: expected cache hit rate {:.3f}, {:.3f} in pair.txt order".format(
+        scan_folder, expected_hit_rate(segments, src_views, map_bytes, max_bytes, args.workers),
+        expected_hit_rate(pair_order, src_views, map_bytes, max_bytes, args.workers)))
+    task_of = {task[2]: task for task in tasks}
+    return [task_of[ref_view] for ref_view in order]
+
+
+# fused chunks of all reference views of a scan (or of ref_views only) in pair.txt order (or the --schedule order),
+# compute(tasks) fuses the given views in order. With --incremental only the views whose inputs changed are computed,
+# the others come from the manifest cache
+def scan_chunks(scan_folder, out_folder, photo_threshold, compute, ref_views=None):
+    tasks = view_tasks(scan_folder, out_folder, photo_threshold)
+    if ref_views is not None:
+        ref_views = set(ref_views)
+        tasks = [task for task in tasks if task[2] in ref_views]
+    if args.schedule and len(tasks) > 0:
+        tasks = schedule_tasks(scan_folder, out_folder, tasks)
+    if not args.incremental:
+        return compute(tasks)
+
+    manifest = FusionManifest(os.path.join(out_folder, 'fusion_cache'))
+    params = {'photo_threshold': photo_threshold, 'used_mask': args.used_mask}
+    entries = [view_entry(view_input_files(scan_folder, out_folder, ref_view, src_views), dict(params, src_views=src_views))
+               for _, _, ref_view, src_views, _ in tasks]
+    stale = [not manifest.is_current(task[2], entry) for task, entry in zip(tasks, entries)]
+    print("incremental fusion of {}: {}/{} views to recompute".format(scan_folder, sum(stale), len(tasks)))
+    computed = compute([task for task, is_stale in zip(tasks, stale) if is_stale])
+    return manifest.assemble([task[2] for task in tasks], entries, stale, iter(computed))
+
+
+# each pool worker keeps its own cache, the --cache_mb budget is split between the workers
+worker_cache = None
+
+
+def init_fusion_worker():
+    global worker_cache
+    worker_cache = ScanCache(args.cache_mb * 1024 ** 2 // args.workers)
+
+
+def filter_view_worker(task):
+    return filter_view(worker_cache, *task)
+
+
+# a segment of consecutive scheduled views runs on one worker so they share its cache
+# out: the chunks of the views and the cache hits and misses of the segment
+def filter_segment_worker(tasks):
+    hits, misses = worker_cache.hits, worker_cache.misses
+    view_chunks = [filter_view(worker_cache, *task) for task in tasks]
+    return view_chunks, worker_cache.hits - hits, worker_cache.misses - misses
+
+
+def segment_chunks(scan_folder, segments):
+    hits, misses = 0, 0
+    for view_chunks, segment_hits, segment_misses in segments:
+        hits, misses = hits + segment_hits, misses + segment_misses
+        for chunk in view_chunks:
+            yield chunk
+    print("{} cache hit rate {:.3f}".format(scan_folder, hits / max(hits + misses, 1)))
+
+
+# remove the outliers of a written point cloud (--outliers), rewriting its PLY or chunk folder in place
+def filter_outliers(plyfilename):
+    vertices = np.concatenate([np.array(ply_vertex_memmap(filename)) for filename in ply_files(plyfilename)])
+    xyz = np.stack([vertices['x'], vertices['y'], vertices['z']], axis=1)
+    keep = remove_outliers(xyz, args.outliers, args.outlier_radius, args.outlier_neighbors, args.outlier_neighbors,
+                           args.outlier_std, args.workers)
+    if os.path.isdir(plyfilename):
+        for filename in ply_files(plyfilename):
+            os.remove(filename)
+        writer = ChunkedPlyWriter(plyfilename, args.chunk_points)
+    else:
+        writer = PlyStreamWriter(plyfilename)
+    with writer:
+        writer.write_vertex(vertices[keep])
+    print("removed {} outliers from {}, points: {}".format(len(keep) - keep.sum(), plyfilename, keep.sum()))
+
+
+# stream the per-view (vertices, colors, visibility) chunks in order into one point cloud,
+# optionally skipping used pixels (--used_mask) and merging points per voxel (--voxel_size), on disk with --out_of_core.
+# with chunk_points the cloud goes to a <name>_chunks folder instead of a single PLY, whose name is returned
+def write_point_cloud(plyfilename, view_chunks, chunk_points=0):
+    used_mask = UsedMask() if args.used_mask else None
+    voxels = None
+    if args.voxel_size > 0 and args.out_of_core:
+        voxels = SpilledVoxelGrid(os.path.splitext(plyfilename)[0] + '_spill', args.voxel_size, args.spill_mb * 1024 ** 2)
+    elif args.voxel_size > 0:
+        voxels = VoxelGrid(args.voxel_size)
+    if chunk_points > 0:
+        plyfilename = os.path.splitext(plyfilename)[0] + '_chunks'
+        writer = ChunkedPlyWriter(plyfilename, chunk_points)
+    else:
+        writer = PlyStreamWriter(plyfilename)
+    with writer:
+        for chunk in view_chunks:
+            if chunk is None:
+                continue
+            vertices, colors, visibility = chunk
+            if used_mask is not None:
+                keep = used_mask.update(visibility)
+                vertices, colors = vertices[keep], colors[keep]
+            if voxels is not None:
+                voxels.add(vertices, colors)
+            else:
+                writer.write(vertices, colors)
+        if voxels is not None:
+            for vertices, colors in voxels.chunks():
+                writer.write(vertices, colors)
+        print("saving the final model to", plyfilename, "points:", writer.count)
+    return plyfilename
+
+
+# --outliers filters a written point cloud and --lod_points also exports it as an octree in lod_folder
+def export_point_cloud(plyfilename, lod_folder):
+    if args.outliers:
+        filter_outliers(plyfilename)
+    if args.lod_points > 0:
+        nodes = write_octree_lod(ply_files(plyfilename), lod_folder, args.lod_points, max_depth=args.lod_depth)
+        print("saving the level of detail octree to", lod_folder, "nodes:", len(nodes))
+
+
+# write a point cloud as write_point_cloud (in chunks with --chunk_points) and export it, the octree goes to <name>_lod
+def save_point_cloud(plyfilename, view_chunks):
+    lod_folder = os.path.splitext(plyfilename)[0] + '_lod'
+    export_point_cloud(write_point_cloud(plyfilename, view_chunks, args.chunk_points), lod_folder)
+
+
+# spatial chunks of the reference views of a scan for --partition_mb: the depth and confidence maps of the views
+# of a chunk fit in the budget, see partition_views
+def partition_scan(scan_folder, out_folder, photo_threshold):
+    pair_data = [(task[2], task[3]) for task in view_tasks(scan_folder, out_folder, photo_threshold)]
+    if len(pair_data) == 0:
+        return []
+    extrinsics = [read_camera_parameters(os.path.join(scan_folder, 'cams/{:0>8}_cam.txt'.format(ref_view)), 1, 0, 0)[1]
+                  for ref_view, _ in pair_data]
+    centers = dict(zip([ref_view for ref_view, _ in pair_data], camera_centers(np.stack(extrinsics))))
+    max_views = args.partition_mb * 1024 ** 2 // (2 * map_nbytes(out_folder, pair_data[0][0]))
+    chunks = partition_views(pair_data, centers, max_views)
+    print("partitioned {}: {} chunks of at most {} views, {} views read in total for {} reference views".format(
+        scan_folder, len(chunks), max_views, sum(len(views) for _, views in chunks), len(pair_data)))
+    return chunks
+
+
+# --partition_mb: fuse the chunks of a scan one after another into <name>_parts, each with its own --used_mask and
+# --voxel_size state, then merge them into the point cloud with --partition_tolerance dedup along the chunk
+# boundaries and export it as save_point_cloud. compute(tasks) fuses the given views in order
+def save_partitioned_point_cloud(scan_folder, out_folder, plyfilename, photo_threshold, compute):
+    lod_folder = os.path.splitext(plyfilename)[0] + '_lod'
+    part_folder = os.path.splitext(plyfilename)[0] + '_parts'
+    os.makedirs(part_folder, exist_ok=True)
+    part_files = []
+    for i, (ref_views, _) in enumerate(partition_scan(scan_folder, out_folder, photo_threshold)):
+        part_files.append(write_point_cloud(os.path.join(part_folder, 'part{:0>3}.ply'.format(i)),
+                                            scan_chunks(scan_folder, out_folder, photo_threshold, compute, ref_views)))
+    merged = os.path.join(part_folder, 'merged.ply') if args.chunk_points > 0 else plyfilename
+    count = merge_partitions(part_files, merged, args.partition_tolerance)
+    if args.chunk_points > 0:
+        vertices = ply_vertex_memmap(merged)
+        plyfilename = os.path.splitext(plyfilename)[0] + '_chunks'
+        with ChunkedPlyWriter(plyfilename, args.chunk_points) as writer:
+            for start in range(0, len(vertices), args.chunk_points):
+                writer.write_vertex(np.array(vertices[start:start + args.chunk_points]))
+        del vertices
+    shutil.rmtree(part_folder)
+    print("merged {} chunks into {}, points: {}".format(len(part_files), plyfilename, count))
+    export_point_cloud(plyfilename, lod_folder)
 
 
-        if (not isinstance(geo_mask, bool)):
+def filter_depth(scan_folder, out_folder, plyfilename, photo_threshold):
+    cache = ScanCache(args.cache_mb * 1024 ** 2)
 
-            final_mask = np.logical_and(photo_mask, geo_mask)
+    # for each reference view and the corresponding source views
+    compute = lambda tasks: (filter_view(cache, *task) for task in tasks)
+    if args.partition_mb > 0:
+        save_partitioned_point_cloud(scan_folder, out_folder, plyfilename, photo_threshold, compute)
+    else:
+        save_point_cloud(plyfilename, scan_chunks(scan_folder, out_folder, photo_threshold, compute))
+    print("cache hit rate {:.3f}, {} MB".format(cache.hit_rate(), cache.nbytes // 1024 ** 2))
 
-            os.makedirs(os.path.join(out_folder, "mask"), exist_ok=True)
 
-            save_mask(os.path.join(out_folder, "mask/{:0>8}_photo.png".format(ref_view)), photo_mask)
-            save_mask(os.path.join(out_folder, "mask/{:0>8}_geo.png".format(ref_view)), geo_mask)
-            save_mask(os.path.join(out_folder, "mask/{:0>8}_final.png".format(ref_view)), final_mask)
-
-            print("processing {}, ref-view{:0>2}, photo/geo/final-mask:{}/{}/{}".format(scan_folder, ref_view,
-                                                                                        photo_mask.mean(),
-                                                                                        geo_mask.mean(),
-                                                                                        final_mask.mean()))
-
-            if args.display:
-                import cv2
-                cv2.imshow('ref_img', ref_img[:, :, ::-1])
-                cv2.imshow('ref_depth', ref_depth_est / 800)
-                cv2.imshow('ref_depth * photo_mask', ref_depth_est * photo_mask.astype(np.float32) / 800)
-                cv2.imshow('ref_depth * geo_mask', ref_depth_est * geo_mask.astype(np.float32) / 800)
-                cv2.imshow('ref_depth * mask', ref_depth_est * final_mask.astype(np.float32) / 800)
-                cv2.waitKey(0)
+# fuse all scans over a process pool. Reference views are spread over the workers and the next scan is queued
+# while the current one is collected, chunks come back in pair.txt order so the output matches the serial run
+def filter_depth_parallel(jobs):
+    pool = multiprocessing.Pool(args.workers, initializer=init_fusion_worker)
 
-            height, width = depth_est_averaged.shape[:2]
-            x, y = np.meshgrid(np.arange(0, width), np.arange(0, height))
-            # valid_points = np.logical_and(final_mask, ~used_mask[ref_view])
-            valid_points = final_mask
-            print("valid_points", valid_points.mean())
-            x, y, depth = x[valid_points], y[valid_points], depth_est_averaged[valid_points]
-            color = ref_img[:, :, :][valid_points]  # hardcoded for DTU dataset
-            xyz_ref = np.matmul(np.linalg.inv(ref_intrinsics),
-                                np.vstack((x, y, np.ones_like(x))) * depth)
-            xyz_world = np.matmul(np.linalg.inv(ref_extrinsics),
-                                  np.vstack((xyz_ref, np.ones_like(x))))[:3]
-            vertexs.append(xyz_world.transpose((1, 0)))
-            vertex_colors.append((color * 255).astype(np.uint8))
-
-            # # set used_mask[ref_view]
-            # used_mask[ref_view][...] = True
-            # for idx, src_view in enumerate(src_views):
-            #     src_mask = np.logical_and(final_mask, all_srcview_geomask[idx])
-            #     src_y = all_srcview_y[idx].astype(np.int)
-            #     src_x = all_srcview_x[idx].astype(np.int)
-            #     used_mask[src_view][src_y[src_mask], src_x[src_mask]] = True
-
-    vertexs = np.concatenate(vertexs, axis=0)
-    vertex_colors = np.concatenate(vertex_colors, axis=0)
-    vertexs = np.array([tuple(v) for v in vertexs], dtype=[('x', 'f4'), ('y', 'f4'), ('z', 'f4')])
-    vertex_colors = np.array([tuple(v) for v in vertex_colors], dtype=[('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
+    def compute(scan_folder):
+        if args.schedule:
+            return lambda tasks: segment_chunks(
+                scan_folder, pool.imap(filter_segment_worker, split_segments(tasks, args.workers)))
+        return lambda tasks: pool.imap(filter_view_worker, tasks)
 
-    vertex_all = np.empty(len(vertexs), vertexs.dtype.descr + vertex_colors.dtype.descr)
-    for prop in vertexs.dtype.names:
-        vertex_all[prop] = vertexs[prop]
-    for prop in vertex_colors.dtype.names:
-        vertex_all[prop] = vertex_colors[prop]
+    def queue_scan(job):
+        scan_folder, out_folder, _, photo_threshold = job
+        return scan_chunks(scan_folder, out_folder, photo_threshold, compute(scan_folder))
 
-    el = PlyElement.describe(vertex_all, 'vertex')
-    PlyData([el]).write(plyfilename)
-    print("saving the final model to", plyfilename)
+    if args.partition_mb > 0:
+        # the chunks of a scan are fused one after another, each over all workers
+        for scan_folder, out_folder, plyfilename, photo_threshold in jobs:
+            save_partitioned_point_cloud(scan_folder, out_folder, plyfilename, photo_threshold, compute(scan_folder))
+    else:
+        view_chunks = queue_scan(jobs[0]) if len(jobs) > 0 else None
+        for i, job in enumerate(jobs):
+            next_view_chunks = queue_scan(jobs[i + 1]) if i + 1 < len(jobs) else None
+            save_point_cloud(job[2], view_chunks)
+            view_chunks = next_view_chunks
+    pool.close()
+    pool.join()
+
+
+# reprojection errors and relative depth differences of one reference view against its source views, cached for
+# the pixels above the lowest photo threshold of the sweep
+# out: the index entry of the view
+def cache_sweep_view(cache, scan_folder, out_folder, ref_view, src_views, photo_threshold):
+    ref_img, ref_depth_est, confidence, ref_camera, src_cameras, src_depth_ests = load_view(
+        cache, scan_folder, out_folder, ref_view, src_views)
+    ref_intrinsics, ref_extrinsics, ref_intrinsics_inv, ref_extrinsics_inv = ref_camera
+    src_intrinsics, src_extrinsics, src_intrinsics_inv, src_extrinsics_inv = src_cameras
+
+    pixels = np.flatnonzero(confidence > photo_threshold)
+    dist, depth_reprojected, depth, _, _ = reprojection_errors(
+        ref_depth_est, ref_intrinsics, ref_extrinsics, src_depth_ests, src_intrinsics, src_extrinsics,
+        inverses=(ref_intrinsics_inv, ref_extrinsics_inv, src_intrinsics_inv, src_extrinsics_inv), pixels=pixels)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        relative_diff = (depth_reprojected - depth) / depth
+    colors = (ref_img.reshape([-1, 3])[pixels] * 255).astype(np.uint8)
+    write_sweep_view(os.path.join(out_folder, 'sweep_cache'), ref_view, pixels, confidence.reshape([-1])[pixels],
+                     depth, colors, dist, relative_diff)
+    print("caching {}, ref-view{:0>2}, pixels: {}".format(scan_folder, ref_view, len(pixels)))
+
+    # (x*d, y*d, d, 1) -> world
+    world_from_pixel = np.eye(4)
+    world_from_pixel[:3, :3] = ref_intrinsics_inv
+    world_from_pixel = np.matmul(ref_extrinsics_inv, world_from_pixel)
+    return {'ref_view': ref_view, 'width': confidence.shape[1], 'world_from_pixel': world_from_pixel.tolist()}
+
+
+def cache_sweep_view_worker(task):
+    return cache_sweep_view(worker_cache, *task)
+
+
+# signatures of the files the sweep cache of a scan is computed from: pair.txt, which picks the source views, and
+# the depth, confidence, image and camera files filter_view reads for every reference view
+def sweep_inputs(scan_folder, out_folder):
+    input_files = {os.path.join(scan_folder, 'pair.txt')}
+    for _, _, ref_view, src_views, _ in view_tasks(scan_folder, out_folder, 0):
+        input_files.update(view_input_files(scan_folder, out_folder, ref_view, src_views))
+    return {filename: file_signature(filename) for filename in sorted(input_files)}
+
+
+# the cache is rebuilt when the size or modification time of one of its inputs changed, as the --incremental
+# manifest, or when it was built for a higher threshold
+def sweep_cache_valid(cache_dir, inputs, photo_threshold):
+    index = read_sweep_index(cache_dir)
+    if index is None or index['photo_threshold'] > photo_threshold:
+        return False
+    return index.get('inputs') == inputs
+
+
+# threshold sweep of one scan: reproject once into the cache, then fuse every (photo threshold, pixel denominator,
+# depth denominator) combination from it, one combination per worker
+def sweep_scan(pool, scan_folder, out_folder, photo_thresholds, pixel_denominators, depth_denominators):
+    cache_dir = os.path.join(out_folder, 'sweep_cache')
+    min_threshold = min(photo_thresholds)
+    inputs = sweep_inputs(scan_folder, out_folder)
+    if not sweep_cache_valid(cache_dir, inputs, min_threshold):
+        os.makedirs(cache_dir, exist_ok=True)
+        tasks = view_tasks(scan_folder, out_folder, min_threshold)
+        views = pool.map(cache_sweep_view_worker, tasks) if pool is not None else [cache_sweep_view_worker(t) for t in tasks]
+        write_sweep_index(cache_dir, views, min_threshold, inputs)
+
+    sweep_folder = os.path.join(out_folder, 'sweep')
+    os.makedirs(sweep_folder, exist_ok=True)
+    combinations = [(cache_dir, os.path.join(sweep_folder, 'photo{:g}_pixel{:g}_depth{:g}.ply'.format(*thresholds))) +
+                    thresholds for thresholds in itertools.product(photo_thresholds, pixel_denominators, depth_denominators)]
+    counts = pool.starmap(fuse_sweep, combinations) if pool is not None else [fuse_sweep(*c) for c in combinations]
+
+    with open(os.path.join(sweep_folder, 'points.txt'), 'w') as f:
+        f.write('photo_threshold pixel_denominator depth_denominator points filename\n')
+        for (_, plyfilename, photo_threshold, pixel_denominator, depth_denominator), count in zip(combinations, counts):
+            f.write('{:g} {:g} {:g} {} {}\n'.format(photo_threshold, pixel_denominator, depth_denominator, count,
+                                                   os.path.basename(plyfilename)))
+            print("sweep {} photo {:g} pixel 1/{:g} depth 1/{:g} points: {}".format(scan_folder, photo_threshold,
+                                                                                   pixel_denominator, depth_denominator, count))
+
+
+def filter_depth_sweep(jobs):
+    pool = multiprocessing.Pool(args.workers, initializer=init_fusion_worker) if args.workers > 1 else None
+    if pool is None:
+        init_fusion_worker()
+    photo_thresholds = [float(v) for v in args.sweep_photo.split(',')]
+    pixel_denominators = [float(v) for v in args.sweep_pixel.split(',')]
+    depth_denominators = [float(v) for v in args.sweep_depth.split(',')]
+    for scan_folder, out_folder, _, _ in jobs:
+        sweep_scan(pool, scan_folder, out_folder, photo_thresholds, pixel_denominators, depth_denominators)
+    if pool is not None:
+        pool.close()
+        pool.join()
 
 
 if __name__ == '__main__':
@@ -408,7 +662,8 @@ if __name__ == '__main__':
     with open(args.testlist) as f:
         scans = f.readlines()
         scans = [line.rstrip() for line in scans]
-    
+
+    jobs = []
     for scan in scans:
         scan_folder = os.path.join(args.testpath, scan)
         out_folder = os.path.join(args.outdir, scan)
@@ -416,7 +671,15 @@ if __name__ == '__main__':
         if (args.test_dataset=='dtu'):
             scan_id = int(scan[4:])
             photo_threshold=0.35
-            filter_depth(scan_folder, out_folder, os.path.join(args.outdir, 'mvsnet_{:0>3}_l3.ply'.format(scan_id) ), photo_threshold)
+            jobs.append((scan_folder, out_folder, os.path.join(args.outdir, 'mvsnet_{:0>3}_l3.ply'.format(scan_id) ), photo_threshold))
         if (args.test_dataset=='tanks'):
             photo_threshold=0.3
-            filter_depth(scan_folder, out_folder, os.path.join(args.outdir, scan + '.ply'), photo_threshold)
+            jobs.append((scan_folder, out_folder, os.path.join(args.outdir, scan + '.ply'), photo_threshold))
+
+    if args.sweep_photo:
+        filter_depth_sweep(jobs)
+    elif args.workers > 1:
+        filter_depth_parallel(jobs)
+    else:
+        for job in jobs:
+            filter_depth(*job)
@@ -0,0 +1,45 @@
+import argparse
+import os
+import sys
+import numpy as np
+from depthfusion import merge_clouds, PointCloudIndex, PlyStreamWriter
+
+parser = argparse.ArgumentParser(description='Merge the fused point clouds of several scans into one spatially '
+                                 'indexed cloud, and query it by bounding box or radius')
+parser.add_argument('--inputs', nargs='+', default=[], help='fused PLY files to merge, earlier files win duplicates')
+parser.add_argument('--index', required=True, help='folder of the merged, indexed point cloud')
+parser.add_argument('--tolerance', type=float, default=0, help='drop points closer than this to a point of an '
+                    'earlier input, 0 keeps every point')
+parser.add_argument('--cell_size', type=float, default=1.0, help='size of the index cells, at least --tolerance; '
+                    'queries read whole cells')
+parser.add_argument('--spill_mb', type=int, default=512, help='points buffered in memory before spilling while merging, in MB')
+
+parser.add_argument('--query_bbox', type=float, nargs=6, default=None, help='min x y z and max x y z of a box query')
+parser.add_argument('--query_radius', type=float, nargs=4, default=None, help='center x y z and radius of a radius query')
+parser.add_argument('--query_out', default='query.ply', help='PLY file the query result is written to')
+
+# parse arguments and check
+args = parser.parse_args()
+if args.tolerance > args.cell_size:
+    parser.error('--cell_size must be at least --tolerance')
+if args.query_bbox is not None and args.query_radius is not None:
+    parser.error('give one of --query_bbox and --query_radius')
+print("argv:", sys.argv[1:])
+
+
+if __name__ == '__main__':
+    if args.inputs:
+        os.makedirs(args.index, exist_ok=True)
+        count = merge_clouds(args.inputs, args.index, args.tolerance, args.cell_size,
+                             spill_bytes=args.spill_mb * 1024 ** 2)
+        print("merged {} point clouds into {} points in {}".format(len(args.inputs), count, args.index))
+
+    if args.query_bbox is not None or args.query_radius is not None:
+        index = PointCloudIndex(args.index)
+        if args.query_bbox is not None:
+            points = index.query_box(args.query_bbox[:3], args.query_bbox[3:])
+        else:
+            points = index.query_radius(args.query_radius[:3], args.query_radius[3])
+        with PlyStreamWriter(args.query_out) as writer:
+            writer.write_vertex(points)
+        print("query returned {} of {} points, saved to {}".format(len(points), len(index), args.query_out))
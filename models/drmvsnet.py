@@ -16,9 +16,10 @@ from .vamvsnet import *
 class DrMVSNet(MVSNet):
     def __init__(self, refine=True, fea_net='FeatureNet', cost_net='CostRegNet', refine_net='RefineNet',
                  origin_size=False, cost_aggregation=0, dp_ratio=0.0, image_scale=0.25, max_h=960, max_w=480,
-                 reg_loss=False, return_depth=False, gn=True, pyramid=-1):
+                 reg_loss=False, return_depth=False, gn=True, pyramid=-1, depth_chunk_mb=0, feature_batch=0):
         super(DrMVSNet, self).__init__(refine=True, fea_net='FeatureNet', cost_net='CostRegNet', refine_net='RefineNet',
-                 origin_size=False, cost_aggregation=0, dp_ratio=0.0, image_scale=0.25) # parent init
+                 origin_size=False, cost_aggregation=0, dp_ratio=0.0, image_scale=0.25,
+                 feature_batch=feature_batch) # parent init
         
         self.gn = gn
         self.cost_aggregation = cost_aggregation
@@ -108,10 +109,44 @@ class DrMVSNet(MVSNet):
 
         self.reg_loss = reg_loss
         self.return_depth = return_depth
+        # memory budget of the batched cost slices, 0 computes them one depth plane at a time
+        self.depth_chunk_mb = depth_chunk_mb
 
         print('init DrMVSNet: ', fea_net, ', ', cost_net , 'ca: ', self.cost_aggregation, 'normGN: ', self.gn)
 
-    def forward(self, imgs, proj_matrices, depth_values):
+    # depth planes per batched cost slice pass under depth_chunk_mb: about two [B, C, H, W] float volumes per plane
+    # and source view (the warped features and their squared difference) and the running sum are alive in a pass
+    def depth_chunk(self, ref_feature, num_src):
+        if self.depth_chunk_mb <= 0:
+            return 1
+        return max(1, self.depth_chunk_mb * 1024 ** 2 // ((2 * num_src + 1) * 4 * ref_feature.numel()))
+
+    # aggregated cost slices volume_variance [B, C, H, W] of all depth planes in order: the gate reweighted squared
+    # differences of the warped source features, averaged over the source views. They do not depend on the recurrent
+    # state, so the planes are computed depth_chunk at a time: all source views and depths are warped in one
+    # grid_sample, reweighted in one gatenet call with both folded into the batch, and summed in place
+    def cost_slices(self, ref_feature, src_features, homography, depth_values, depth_chunk):
+        batch, channels, height, width = ref_feature.shape
+        num_src = len(src_features)
+        src_features = torch.stack(src_features)  # [S, B, C, H, W]
+        for start in range(0, depth_values.shape[1], depth_chunk):
+            chunk_values = depth_values[:, start:start + depth_chunk]
+            num_depth = chunk_values.shape[1]
+            warped_volumes = homography.warp_views(src_features, chunk_values).transpose(2, 3).contiguous()  # [S, B, K, C, H, W]
+            warped_volumes.sub_(ref_feature.view(1, batch, 1, channels, height, width)).pow_(2)
+            warped_volumes = warped_volumes.view(num_src * batch * num_depth, channels, height, width)
+            reweight = self.gatenet(warped_volumes) + 1 # saliency
+            warped_volumes = warped_volumes.view(num_src, batch * num_depth, channels, height, width)
+            reweight = reweight.view(num_src, batch * num_depth, 1, height, width)
+            volume_variance = warped_volumes[0] * reweight[0]
+            for src_index in range(1, num_src):
+                volume_variance.addcmul_(warped_volumes[src_index], reweight[src_index])
+            volume_variance = volume_variance.div_(num_src).view(batch, num_depth, channels, height, width)
+            for d in range(num_depth):
+                yield volume_variance[:, d]
+
+    # features: per view the feature maps [B, C, H, W] as extract_features, computed from imgs when None
+    def forward(self, imgs, proj_matrices, depth_values, features=None):
         imgs = torch.unbind(imgs, 1)
         proj_matrices = torch.unbind(proj_matrices, 1)
         assert len(imgs) == len(proj_matrices), "Different number of images and projection matrices"
@@ -123,10 +158,15 @@ class DrMVSNet(MVSNet):
 
         # step 1. feature extraction
         # in: images; out: 32-channel feature maps
-        features = [self.feature(img) for img in imgs]
+        if features is None:
+            features = self.extract_features(imgs)
 
         ref_feature, src_features = features[0], features[1:]
         ref_proj, src_projs = proj_matrices[0], proj_matrices[1:]
+        # view pair geometry of the homography warping, shared by all depth planes
+        homography = DepthwiseHomography(ref_proj, src_projs, ref_feature.shape[2], ref_feature.shape[3])
+        cost_slices = self.cost_slices(ref_feature, src_features, homography, depth_values,
+                                       self.depth_chunk(ref_feature, len(src_features)))
         
         # Recurrent process i-th depth layer
         # initialization for drmvsnet # recurrent module
@@ -135,19 +175,8 @@ class DrMVSNet(MVSNet):
         if not self.return_depth: # Training Phase; 
             for d in range(num_depth):
                 # step 2. differentiable homograph, build cost volume
+                volume_variance = next(cost_slices)
 
-                ref_volume = ref_feature
-                warped_volumes = None
-                for src_fea, src_proj in zip(src_features, src_projs):
-                        warped_volume = homo_warping_depthwise(src_fea, src_proj, ref_proj, depth_values[:, d])
-                        warped_volume = (warped_volume - ref_volume).pow_(2)
-                        reweight = self.gatenet(warped_volume) 
-                        if warped_volumes is None:
-                            warped_volumes = (reweight + 1) * warped_volume
-                        else:
-                            warped_volumes = warped_volumes + (reweight + 1) * warped_volume
-                volume_variance = warped_volumes / len(src_features)
-                
                 # step 3. cost volume regularization
                 cost_reg, hidden_state= self.cost_regularization(-1 * volume_variance, hidden_state, d)
                 cost_reg_list.append(cost_reg)
@@ -176,20 +205,8 @@ class DrMVSNet(MVSNet):
 
             for d in range(num_depth):
                 # step 2. differentiable homograph, build cost volume
-               
-
-                ref_volume = ref_feature
-                warped_volumes = None
-                for src_fea, src_proj in zip(src_features, src_projs):
-                        warped_volume = homo_warping_depthwise(src_fea, src_proj, ref_proj, depth_values[:, d])
-                        warped_volume = (warped_volume - ref_volume).pow_(2)
-                        reweight = self.gatenet(warped_volume) # saliency 
-                        if warped_volumes is None:
-                            warped_volumes = (reweight + 1) * warped_volume
-                        else:
-                            warped_volumes = warped_volumes + (reweight + 1) * warped_volume
-                volume_variance = warped_volumes / len(src_features)
-                
+                volume_variance = next(cost_slices)
+
                 # step 3. cost volume regularization
                 cost_reg, hidden_state= self.cost_regularization(-1 * volume_variance, hidden_state, d)
 
@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import inspect
 
 class ConvBnReLU(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size=3, stride=1, padding=1, bias=True):
@@ -183,41 +184,83 @@ class Hourglass3d(nn.Module):
         return dconv1
 
 
+# per view pair geometry of depthwise homography warping, computed once per forward pass instead of once per depth
+# plane: the reference pixel rays rotated into every source view (rot_xyz) and the source translations. Warping a
+# source feature to one depth plane (or a chunk of planes) is then a scale, an add and a divide of the rays before
+# grid_sample.
+# ref_proj: [B, 4, 4]
+# src_projs: list of [B, 4, 4]
+class DepthwiseHomography(object):
+    def __init__(self, ref_proj, src_projs, height, width):
+        self.height, self.width = height, width
+        with torch.no_grad():
+            proj = torch.matmul(torch.stack(src_projs), torch.inverse(ref_proj).unsqueeze(0))  # [S, B, 4, 4]
+            rot = proj[:, :, :3, :3]  # [S, B, 3, 3]
+            self.trans = proj[:, :, :3, 3:4].contiguous()  # [S, B, 3, 1]
+
+            y, x = torch.meshgrid([torch.arange(0, height, dtype=torch.float32, device=ref_proj.device),
+                                   torch.arange(0, width, dtype=torch.float32, device=ref_proj.device)])
+            y, x = y.contiguous(), x.contiguous()
+            y, x = y.view(height * width), x.view(height * width)
+            xyz = torch.stack((x, y, torch.ones_like(x)))  # [3, H*W]
+            self.rot_xyz = torch.matmul(rot, xyz)  # [S, B, 3, H*W]
+
+    # normalized sampling grid [S, B, K, H*W, 2] of all source views, or [B, K, H*W, 2] of source view src_index,
+    # for the depth planes depth_values [B, K]
+    def grid(self, depth_values, src_index=None):
+        rot_xyz, trans = self.rot_xyz, self.trans
+        if src_index is not None:
+            rot_xyz, trans = rot_xyz[src_index], trans[src_index]
+        batch, num_depth = depth_values.shape
+        with torch.no_grad():
+            proj_xyz = rot_xyz.unsqueeze(-2) * depth_values.view(batch, 1, num_depth, 1) + \
+                trans.unsqueeze(-2)  # [(S,) B, 3, K, H*W]
+            proj_z = proj_xyz[..., 2:3, :, :]
+            proj_z = torch.where(proj_z == 0, proj_z + 0.0001, proj_z)  # WHY BUG
+            proj_xy = proj_xyz[..., :2, :, :] / proj_z  # [(S,) B, 2, K, H*W]
+            proj_x_normalized = proj_xy[..., 0, :, :] / ((self.width - 1) / 2) - 1
+            proj_y_normalized = proj_xy[..., 1, :, :] / ((self.height - 1) / 2) - 1
+            return torch.stack((proj_x_normalized, proj_y_normalized), dim=-1)  # [(S,) B, K, H*W, 2]
+
+    # src_fea: [B, C, H, W] of source view src_index
+    # depth_values: [B, K], the K depth planes are stacked along the height of one grid_sample
+    # out: [B, C, K, H, W]
+    def warp_depths(self, src_index, src_fea, depth_values):
+        batch, channels = src_fea.shape[0], src_fea.shape[1]
+        num_depth = depth_values.shape[1]
+        grid = self.grid(depth_values, src_index)
+        warped_src_fea = F.grid_sample(src_fea, grid.view(batch, num_depth * self.height, self.width, 2), mode='bilinear',
+                                       padding_mode='zeros').type(torch.float32)
+        return warped_src_fea.view(batch, channels, num_depth, self.height, self.width)
+
+    # all source views in one grid_sample, the views folded into its batch
+    # src_feas: [S, B, C, H, W]
+    # depth_values: [B, K]
+    # out: [S, B, C, K, H, W]
+    def warp_views(self, src_feas, depth_values):
+        num_src, batch, channels = src_feas.shape[:3]
+        num_depth = depth_values.shape[1]
+        grid = self.grid(depth_values)
+        warped_src_feas = F.grid_sample(src_feas.reshape(num_src * batch, channels, self.height, self.width),
+                                        grid.view(num_src * batch, num_depth * self.height, self.width, 2),
+                                        mode='bilinear', padding_mode='zeros').type(torch.float32)
+        return warped_src_feas.view(num_src, batch, channels, num_depth, self.height, self.width)
+
+    # src_fea: [B, C, H, W] of source view src_index
+    # depth_value: [B]
+    # out: [B, C, H, W]
+    def warp(self, src_index, src_fea, depth_value):
+        return self.warp_depths(src_index, src_fea, depth_value.view(-1, 1)).squeeze(2)
+
+
 def homo_warping_depthwise(src_fea, src_proj, ref_proj, depth_value):
     # src_fea: [B, C, H, W]
     # src_proj: [B, 4, 4]
     # ref_proj: [B, 4, 4]
     # depth_value: [B] # TODO: B, 1
     # out: [B, C, H, W]
-    batch, channels = src_fea.shape[0], src_fea.shape[1]
-    height, width = src_fea.shape[2], src_fea.shape[3]
-    
-    with torch.no_grad():
-        proj = torch.matmul(src_proj, torch.inverse(ref_proj))
-        rot = proj[:, :3, :3]  # [B,3,3]
-        trans = proj[:, :3, 3:4]  # [B,3,1]
-
-        y, x = torch.meshgrid([torch.arange(0, height, dtype=torch.float32, device=src_fea.device),
-                               torch.arange(0, width, dtype=torch.float32, device=src_fea.device)])
-        y, x = y.contiguous(), x.contiguous()
-        y, x = y.view(height * width), x.view(height * width)
-        xyz = torch.stack((x, y, torch.ones_like(x)))  # [3, H*W]
-        xyz = torch.unsqueeze(xyz, 0).repeat(batch, 1, 1)  # [B, 3, H*W]
-        rot_xyz = torch.matmul(rot, xyz)  # [B, 3, H*W]
-        rot_depth_xyz = rot_xyz.repeat(1, 1, 1) * depth_value.view(batch, 1, 1)
-        proj_xyz = rot_depth_xyz + trans.view(batch, 3, 1)  # [B, 3, Ndepth, H*W]
-        proj_xyz[:,2:3,:][proj_xyz[:, 2:3,:] == 0] += 0.0001 # WHY BUG
-        proj_xy = proj_xyz[:, :2, :] / proj_xyz[:, 2:3, :]  # [B, 2, Ndepth, H*W]
-        proj_x_normalized = proj_xy[:, 0, :] / ((width - 1) / 2) - 1
-        proj_y_normalized = proj_xy[:, 1, :] / ((height - 1) / 2) - 1
-        proj_xy = torch.stack((proj_x_normalized, proj_y_normalized), dim=2)  # [B, Ndepth, H*W, 2]
-        grid = proj_xy
-        
-    warped_src_fea = F.grid_sample(src_fea, grid.view(batch, 1 * height, width, 2), mode='bilinear',
-                                   padding_mode='zeros').type(torch.float32)
-    #warped_src_fea = warped_src_fea.view(batch, channels, height, width) # B, C, H, W
-    #warped_src_fea = warped_src_fea.type(torch.float32)
-    return warped_src_fea
+    homography = DepthwiseHomography(ref_proj, [src_proj], src_fea.shape[2], src_fea.shape[3])
+    return homography.warp(0, src_fea, depth_value)
 
 def homo_warping_depthwise_ori(src_fea, src_proj, ref_proj, depth_value):
     # src_fea: [B, C, H, W]
@@ -377,6 +420,54 @@ def homo_warping3(src_fea, src_proj, ref_proj, depth_values):
     return warped_src_fea
 
 
+# geometric check of a reference depth map against a batch of source depth maps, with the projection math of
+# homo_warping: src_proj * ref_proj^-1 maps (x*d, y*d, d, 1) of a reference pixel into a source view,
+# and ref_proj * src_proj^-1 maps the source pixel back with the sampled source depth
+# depth_ref: [H, W]
+# ref_proj: [4, 4]
+# depths_src: [S, H, W]
+# src_proj: [S, 4, 4]
+# out: depth_reprojected, x_reprojected, y_reprojected, x_src, y_src: [S, H*W]
+# grid_sample with pixel centers at integer coordinates: the only behaviour before torch 1.3, which added the
+# align_corners keyword and changed its default
+GRID_SAMPLE_ALIGNED = {'align_corners': True} if 'align_corners' in inspect.signature(F.grid_sample).parameters else {}
+
+
+def reproject_with_depth(depth_ref, ref_proj, depths_src, src_proj):
+    num_src, height, width = depths_src.shape
+    with torch.no_grad():
+        # compose the per-pair matrices in double, camera matrices are badly conditioned in float
+        proj = torch.matmul(src_proj.double(), torch.inverse(ref_proj.double()).unsqueeze(0)).float()
+        proj_back = torch.matmul(ref_proj.double().unsqueeze(0), torch.inverse(src_proj.double())).float()
+
+        y, x = torch.meshgrid([torch.arange(0, height, dtype=torch.float32, device=depth_ref.device),
+                               torch.arange(0, width, dtype=torch.float32, device=depth_ref.device)])
+        y, x = y.contiguous(), x.contiguous()
+        y, x = y.view(height * width), x.view(height * width)
+        xyz = torch.stack((x, y, torch.ones_like(x)))  # [3, H*W]
+
+        # reference pixels to the source views
+        proj_xyz = torch.matmul(proj[:, :3, :3], xyz) * depth_ref.view(1, 1, -1) + proj[:, :3, 3:4]  # [S, 3, H*W]
+        x_src = proj_xyz[:, 0, :] / proj_xyz[:, 2, :]
+        y_src = proj_xyz[:, 1, :] / proj_xyz[:, 2, :]
+
+        # sample the source depths, pixel centers at integer coordinates (GRID_SAMPLE_ALIGNED)
+        proj_x_normalized = x_src / ((width - 1) / 2) - 1
+        proj_y_normalized = y_src / ((height - 1) / 2) - 1
+        grid = torch.stack((proj_x_normalized, proj_y_normalized), dim=2)  # [S, H*W, 2]
+        grid = torch.where(torch.isfinite(grid), grid, torch.full_like(grid, -2))
+        sampled_depth_src = F.grid_sample(depths_src.unsqueeze(1), grid.view(num_src, height, width, 2), mode='bilinear',
+                                          padding_mode='zeros', **GRID_SAMPLE_ALIGNED).view(num_src, 1, height * width)
+
+        # source points back to the reference view
+        xy1_src = torch.stack((x_src, y_src, torch.ones_like(x_src)), dim=1)  # [S, 3, H*W]
+        proj_xyz_back = torch.matmul(proj_back[:, :3, :3], xy1_src * sampled_depth_src) + proj_back[:, :3, 3:4]
+        depth_reprojected = proj_xyz_back[:, 2, :]
+        x_reprojected = proj_xyz_back[:, 0, :] / depth_reprojected
+        y_reprojected = proj_xyz_back[:, 1, :] / depth_reprojected
+    return depth_reprojected, x_reprojected, y_reprojected, x_src, y_src
+
+
 # p: probability volume [B, D, H, W]
 # depth_values: discrete depth values [B, D]
 def depth_regression(p, depth_values):
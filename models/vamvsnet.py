@@ -346,9 +346,11 @@ class CostRegNet(nn.Module):
 
 class MVSNet(nn.Module):
     def __init__(self, refine=True, fea_net='FeatureNet', cost_net='CostRegNet', refine_net='RefineNet',
-                 origin_size=False, cost_aggregation=0, dp_ratio=0.0, image_scale=0.25):
+                 origin_size=False, cost_aggregation=0, dp_ratio=0.0, image_scale=0.25, feature_batch=0):
         super(MVSNet, self).__init__()
         self.refine = refine
+        # images per feature network call, 0 runs all views of a sample in one call
+        self.feature_batch = feature_batch
         
         self.origin_size = origin_size
         self.cost_aggregation = cost_aggregation
@@ -391,7 +393,24 @@ class MVSNet(nn.Module):
                 volumegatelight(64, kernel_size=3, dilation=[1,3,5,7], bias=True),
                 volumegatelight(64, kernel_size=3, dilation=[1,3,5,7], bias=True)]) 
         
-    def forward(self, imgs, proj_matrices, depth_values):
+    # features of all views [B, 3, H, W] with the views folded into the batch of the feature network, feature_batch
+    # images per call. Convolutions and GroupNorm work per image, so the features are those of one call per view;
+    # a BatchNorm feature network in training would mix the statistics of the views and keeps one call per view.
+    # out: per view the output of self.feature, a feature map or a list of them for the multi-scale networks
+    # forward takes them precomputed as features, e.g. from a cache of the features of the images of a scan
+    def extract_features(self, imgs):
+        if self.training and any(isinstance(module, nn.modules.batchnorm._BatchNorm) for module in self.feature.modules()):
+            return [self.feature(img) for img in imgs]
+        batch = imgs[0].shape[0]
+        images = torch.cat(imgs, 0)
+        step = self.feature_batch if self.feature_batch > 0 else len(images)
+        outputs = [self.feature(images[i:i + step]) for i in range(0, len(images), step)]
+        if isinstance(outputs[0], (list, tuple)):
+            scales = [torch.cat([output[i] for output in outputs], 0).split(batch) for i in range(len(outputs[0]))]
+            return [list(view_features) for view_features in zip(*scales)]
+        return list(torch.cat(outputs, 0).split(batch))
+
+    def forward(self, imgs, proj_matrices, depth_values, features=None):
         
         imgs = torch.unbind(imgs, 1)
         proj_matrices = torch.unbind(proj_matrices, 1)
@@ -402,7 +421,8 @@ class MVSNet(nn.Module):
         if ('High' in self.fea_net) and ('Coarse2Fine' in self.cost_net) :
             # step 1. feature extraction
             # in: images; out: 32-channel feature maps
-            features = [self.feature(img) for img in imgs] #ref_num * 3
+            if features is None:
+                features = self.extract_features(imgs) #ref_num * 3
             ref_features, src_features_o = features[0], features[1:]
             ref_proj_o, src_projs_o = proj_matrices[0], proj_matrices[1:]
             # proj_mat[:3, :4] = proj_mat[:3, :4]  * sample_scale
@@ -489,7 +509,8 @@ class MVSNet(nn.Module):
         else:
             # step 1. feature extraction
             # in: images; out: 32-channel feature maps
-            features = [self.feature(img) for img in imgs]
+            if features is None:
+                features = self.extract_features(imgs)
             ref_feature, src_features = features[0], features[1:]
             ref_proj, src_projs = proj_matrices[0], proj_matrices[1:]
 
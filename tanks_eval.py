@@ -0,0 +1,69 @@
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+from depthfusion.evaluation import TANKS_THRESHOLDS, CropVolume, stream_evaluation_cloud, tanks_scores
+
+parser = argparse.ArgumentParser(description='Evaluate fused Tanks and Temples point clouds: precision, recall and '
+                                 'F-score against the ground truth, as the official toolbox')
+parser.add_argument('--plydir', nargs='+', required=True, help='fusion.py output dirs, e.g. one per checkpoint')
+parser.add_argument('--gtpath', required=True, help='ground truth with <scene>/<scene>.ply, <scene>_trans.txt and <scene>.json')
+parser.add_argument('--testlist', default='./lists/tp_list.txt', help='testing scene list')
+parser.add_argument('--ply_name', default='{}.ply', help='point cloud name of a scene in --plydir')
+
+parser.add_argument('--threshold', type=float, default=0, help='distance threshold in meters, 0 uses the standard '
+                    'threshold of the scene')
+parser.add_argument('--workers', type=int, default=-1, help='KD-tree query threads, -1 for all cores')
+parser.add_argument('--chunk_points', type=int, default=1 << 22, help='vertices streamed and points queried per chunk')
+
+# parse arguments and check
+args = parser.parse_args()
+print("argv:", sys.argv[1:])
+
+
+# precision, recall and F-score of one fused point cloud: the reconstruction is aligned with <scene>_trans.txt,
+# both clouds are cropped to <scene>.json and averaged per voxel of the threshold while they are streamed in
+def evaluate_scene(plyfilename, scene, threshold):
+    scene_folder = os.path.join(args.gtpath, scene)
+    crop = CropVolume.from_json(os.path.join(scene_folder, scene + '.json'))
+    transform = np.loadtxt(os.path.join(scene_folder, scene + '_trans.txt')).reshape([4, 4])
+    data = stream_evaluation_cloud(plyfilename, threshold, crop.data_region, transform, args.chunk_points)
+    gt = stream_evaluation_cloud(os.path.join(scene_folder, scene + '.ply'), threshold, crop.completeness,
+                                 chunk_points=args.chunk_points)
+    return tanks_scores(data, gt, threshold, args.workers, args.chunk_points)
+
+
+if __name__ == '__main__':
+    with open(args.testlist) as f:
+        scenes = [line.rstrip() for line in f.readlines() if line.strip()]
+    for scene in scenes:
+        if args.threshold <= 0 and scene not in TANKS_THRESHOLDS:
+            parser.error('no standard threshold for {}, give --threshold'.format(scene))
+
+    summary = {}
+    for plydir in args.plydir:
+        results = {}
+        for scene in scenes:
+            plyfilename = os.path.join(plydir, args.ply_name.format(scene))
+            if not os.path.exists(plyfilename):
+                print("missing", plyfilename)
+                continue
+            threshold = args.threshold if args.threshold > 0 else TANKS_THRESHOLDS[scene]
+            time_s = time.time()
+            precision, recall, fscore = evaluate_scene(plyfilename, scene, threshold)
+            results[scene] = {'threshold': threshold, 'precision': precision, 'recall': recall, 'fscore': fscore}
+            print("{} {} @ {}: precision {:.4f} recall {:.4f} F-score {:.4f} ({:.1f}s)".format(
+                plydir, scene, threshold, precision, recall, fscore, time.time() - time_s))
+
+        if results:
+            results['mean'] = {key: float(np.mean([result[key] for result in results.values()]))
+                               for key in ('precision', 'recall', 'fscore')}
+            summary[plydir] = results['mean']
+        with open(os.path.join(plydir, 'tanks_scores.json'), 'w') as f:
+            json.dump(results, f, indent=2)
+
+    print("| plydir | Precision | Recall | F-score |")
+    for plydir, mean in summary.items():
+        print("| {} | {:.4f} | {:.4f} | {:.4f} |".format(plydir, mean['precision'], mean['recall'], mean['fscore']))
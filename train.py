@@ -19,6 +19,7 @@ import sys
 import datetime
 import ast
 from datasets.data_io import *
+from depthfusion.container import DepthMapWriter, DepthMapContainer, DEPTH_CONTAINER
 
 from third_party.sync_batchnorm import patch_replication_callback
 from third_party.sync_batchnorm import convert_model
@@ -50,6 +51,9 @@ parser.add_argument('--origin_size', help='True or False flag, input should be e
     type=ast.literal_eval, default=False)
 parser.add_argument('--save_depth', help='True or False flag, input should be either "True" or "False".',
     type=ast.literal_eval, default=False)
+parser.add_argument('--depth_container', help='with --save_depth, write the depth and probability maps of each '
+    'folder to one depth_maps.dmap container instead of PFM files, evaluate reads it when present. True or False.',
+    type=ast.literal_eval, default=False)
 
 ##### Distributed Sync BN
 parser.add_argument('--using_apex', action='store_true', help='using apex, need to install apex')
@@ -487,6 +491,8 @@ def val():
     #     module.register_forward_hook(forward_hook)
 
     avg_test_scalars = DictAverageMeter()
+    # depth map container of each output folder with --depth_container
+    containers = {}
     for batch_idx, sample in enumerate(ImgLoader):
         # if batch_idx > 0:
         #     break
@@ -514,6 +520,11 @@ def val():
                 if not os.path.exists(sub_dir):
                     print('make dir: ', sub_dir)
                     os.makedirs(sub_dir)
+                if args.depth_container:
+                    if sub_dir not in containers:
+                        containers[sub_dir] = DepthMapWriter(os.path.join(sub_dir, DEPTH_CONTAINER))
+                    containers[sub_dir].add(name_split[-1], depth_est[j], prob_map_est[j])
+                    continue
                 save_depth_path = os.path.join(sub_dir, 'init_'+name_split[-1])
                 save_depth_png_path = os.path.join(sub_dir, 'init_'+name_split[-1][:-3]+'png')
                 save_prob_path = os.path.join(sub_dir, 'prob_'+name_split[-1])
@@ -536,6 +547,8 @@ def val():
 
             if batch_idx % 100 == 0:
                 print("Iter {}/{}, val results = {}".format(batch_idx, len(ImgLoader), avg_test_scalars.mean()))
+    for container in containers.values():
+        container.close()
     if (not is_distributed) or (dist.get_rank() == 0):
         print("avg_{}_scalars:".format(args.mode), avg_test_scalars.mean())
 
@@ -860,6 +873,10 @@ def test_sample_coarse2fine(sample, detailed_summary=True):
     return tensor2float(loss), tensor2float(scalar_outputs), image_outputs
 
 
+# depth map containers opened by test_load_sample
+loaded_containers = {}
+
+
 @make_nograd_func
 def test_load_sample(sample, detailed_summary=True):
     model.eval()
@@ -874,9 +891,17 @@ def test_load_sample(sample, detailed_summary=True):
     for one_depth_name in depth_name:
         name_split = str.split(one_depth_name, '/')
         sub_dir = os.path.join(save_dir, name_split[-2])
+        container_path = os.path.join(sub_dir, DEPTH_CONTAINER)
+        if container_path in loaded_containers or os.path.exists(container_path):
+            if container_path not in loaded_containers:
+                loaded_containers[container_path] = DepthMapContainer(container_path)
+            print('load est depth map: ', container_path, name_split[-1])
+            depth_est_list.append(loaded_containers[container_path].read_map('depth_est', name_split[-1]))
+            continue
         depth_path = os.path.join(sub_dir, 'init_'+name_split[-1])
         print('load est depth map: ', depth_path)
-        depth_est_list.append(np.array(read_pfm(depth_path)[0], dtype=np.float32))
+        depth_est_list.append(read_pfm(depth_path, mmap=True)[0])
+    # mapped PFMs are copied once, straight into the batch
     depth_est = torch.from_numpy(np.stack(depth_est_list, axis=0)).cuda()
     
     if args.loss == 'mvsnet_loss_divby_interval':